@@ -0,0 +1,83 @@
+"""Benchmark of converting a column of dates of birth to ages.
+
+Compares the per-row `apply` the transform used to do with
+`utils.age_utils.ages_from_dob`, checks they agree, and reports rows per
+second for each. The per-row version is timed on the first `--legacy-rows`
+rows only, as it takes minutes over the whole column.
+
+    python -m benchmarks.bench_age [--rows 10000000] [--legacy-rows 200000]
+"""
+
+import argparse
+import math
+import time
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from utils.age_utils import ages_from_dob
+
+
+def legacy_convert_dob_to_age(dob: str):
+    """The per-row conversion used before ages_from_dob, kept for comparison"""
+    if not math.isnan(float(dob)):
+        dob = int(dob)
+        epoch_in_seconds = dob / 1000
+        formatted_dob = dt.fromtimestamp(epoch_in_seconds)
+        epoch_age = dt.now() - formatted_dob
+        age = math.floor(epoch_age.days / 365)
+        return age
+    return dob
+
+
+def sample_dobs(rows: int, seed: int = 1) -> pd.Series:
+    """Dates of birth as the USERS table stores them, ms strings with some missing
+
+    Args:
+        rows (int): number of rows
+        seed (int): random seed
+
+    Returns:
+        pd.Series: dates of birth
+    """
+    rng = np.random.default_rng(seed)
+    dobs = pd.Series(
+        rng.integers(-600000000000, 900000000000, rows).astype(str), dtype=object
+    )
+    dobs[rng.random(rows) < 0.01] = np.nan
+    return dobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--legacy-rows", type=int, default=200_000)
+    args = parser.parse_args()
+
+    dobs = sample_dobs(args.rows)
+    legacy_sample = dobs.iloc[: args.legacy_rows]
+
+    start = time.perf_counter()
+    legacy = legacy_sample.apply(legacy_convert_dob_to_age)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ages = ages_from_dob(dobs)
+    vector_seconds = time.perf_counter() - start
+
+    expected = legacy.astype("float64").to_numpy()
+    mismatches = np.count_nonzero(
+        ~np.isclose(ages[: len(expected)], expected, equal_nan=True)
+    )
+
+    print(f"rows: {args.rows:,} ({args.legacy_rows:,} for the per-row apply)")
+    print(
+        f"    per-row apply: {len(legacy_sample) / legacy_seconds:>14,.0f} rows/s, "
+        f"{args.rows / (len(legacy_sample) / legacy_seconds):.1f}s projected"
+    )
+    print(
+        f"    ages_from_dob: {args.rows / vector_seconds:>14,.0f} rows/s, "
+        f"{vector_seconds:.1f}s"
+    )
+    print(f"       mismatches: {mismatches} of {len(expected):,}")
@@ -0,0 +1,107 @@
+"""Micro-benchmark of turning parsed readings into staging rows.
+
+Compares building a one-row DataFrame per RIDES row, with the time formatted
+per message as it used to be, against the NamedTuple rows buffered by `StagingWriter` and
+turned into a COPY payload on flush. Reports time per message and the peak
+memory allocated while doing it, as traced by tracemalloc.
+
+    python -m benchmarks.bench_ingest_rows [--messages 20000] [--flush-rows 500]
+"""
+
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import pandas as pd
+
+import utils.extract_utils as util
+from utils.staging_writer import StagingWriter
+
+
+def legacy_rows(readings: list, flush_rows: int):
+    """The row building done before row records existed, kept for comparison"""
+    frames = []
+    for ride_id, ride, telemetry in readings:
+        frames.append(
+            pd.DataFrame(
+                {
+                    "ride_id": [ride_id],
+                    "duration": [ride.duration],
+                    "resistance": [ride.resistance],
+                    "heart_rate": [telemetry.heart_rate],
+                    "rotations_pm": [telemetry.rotations_pm],
+                    "power": [telemetry.power],
+                    "time": [datetime.now().strftime("%d/%m/%Y %H:%M:%S")],
+                }
+            )
+        )
+        if len(frames) >= flush_rows:
+            pd.concat(frames)
+            frames = []
+    if frames:
+        pd.concat(frames)
+
+
+def record_rows(readings: list, flush_rows: int):
+    """NamedTuple rows through a dry-run StagingWriter"""
+    writer = StagingWriter(None, None, max_rows=flush_rows, dry_run=True)
+    for ride_id, ride, telemetry in readings:
+        writer.add(
+            "RIDES",
+            [
+                util.process_ride_telemetry_data(
+                    ride, telemetry, ride_id, datetime.now(timezone.utc)
+                )
+            ],
+        )
+    writer.close()
+
+
+def measure(build, readings: list, flush_rows: int) -> tuple:
+    """Times `build` over the readings, then runs it again under tracemalloc
+
+    Args:
+        build (Callable): function taking the readings and the flush size
+        readings (list): (ride_id, RideReading, TelemetryReading) tuples
+        flush_rows (int): rows per flush
+
+    Returns:
+        tuple: microseconds per message, peak bytes allocated
+    """
+    start = time.perf_counter()
+    build(readings, flush_rows)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    build(readings, flush_rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed / len(readings) * 1e6, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--flush-rows", type=int, default=500)
+    args = parser.parse_args()
+
+    readings = [
+        (
+            i // 200,
+            util.RideReading(float(i % 200), i % 100),
+            util.TelemetryReading(i % 180, i % 120, i * 1.5),
+        )
+        for i in range(args.messages)
+    ]
+
+    print(f"messages: {args.messages}, flush every {args.flush_rows} rows")
+    for label, build in [
+        ("one-row DataFrames", legacy_rows),
+        ("row records", record_rows),
+    ]:
+        per_message, peak = measure(build, readings, args.flush_rows)
+        print(
+            f"{label:>18}: {per_message:>8.2f} us/msg | peak {peak / 1024:>8,.0f} KiB"
+        )
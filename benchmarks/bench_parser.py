@@ -0,0 +1,129 @@
+"""Micro-benchmark of the Kafka log-line parser.
+
+Compares the split/eval based parsing the extractor used to do, on its own and
+followed by the int/float conversion of its string fields, with
+`utils.extract_utils.parse_message`, reporting messages per second for each.
+
+    python -m benchmarks.bench_parser [--sample recorded.jsonl] [--repeat 5]
+
+The sample is a JSONL file of kafka message values ({"log": "..."}), gzip is
+accepted. Without one, a sample of rides is generated.
+"""
+
+import argparse
+import gzip
+import json
+import time
+
+import utils.extract_utils as util
+from utils.message_sources import generate_ride_lines
+
+
+def legacy_parse(msg: str):
+    """The parsing done per message before parse_message existed, kept for comparison"""
+    if "SYSTEM" in msg:
+        user_details = eval(msg.split("= ")[-1])
+        if len(user_details["name"].split(" ")) == 3:
+            name = [
+                user_details["name"].split(" ")[1],
+                user_details["name"].split(" ")[2],
+            ]
+        elif len(user_details["name"].split(" ")) == 2:
+            name = [
+                user_details["name"].split(" ")[0],
+                user_details["name"].split(" ")[1],
+            ]
+        return [
+            user_details["user_id"],
+            name[0],
+            name[1],
+            user_details["gender"],
+            user_details["date_of_birth"],
+            user_details["height_cm"],
+            user_details["weight_kg"],
+            user_details["email_address"],
+        ]
+    elif "Ride" in msg:
+        info = msg.split("[INFO]: ")[1][:-1].split("= ")
+        return [info[-1], info[1].split(";")[0]]
+    elif "Telemetry" in msg:
+        info = msg.split("[INFO]: ")[1][:-1].split("= ")
+        return [info[-1], info[1].split(";")[0], info[2].split(";")[0]]
+
+
+def legacy_parse_numeric(msg: str):
+    """legacy_parse plus the int/float conversion parse_message does up front"""
+    values = legacy_parse(msg)
+    if "SYSTEM" in msg:
+        return values
+    elif "Ride" in msg:
+        return [int(values[0]), float(values[1])]
+    elif "Telemetry" in msg:
+        return [float(values[0]), int(values[1]), int(values[2])]
+
+
+def load_sample(path: str) -> list:
+    """Reads recorded kafka message values from a JSONL file
+
+    Args:
+        path (str): path to a .jsonl or .jsonl.gz file
+
+    Returns:
+        list: log lines
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line)["log"] for line in f if line.strip()]
+
+
+def messages_per_second(parsers: list, lines: list, repeat: int) -> list:
+    """Best throughput of each parser over the sample across `repeat` rounds.
+    Each round runs every parser in turn, so a slower or faster spell of the
+    machine falls on all of them alike.
+
+    Args:
+        parsers (list): functions taking one log line
+        lines (list): log lines
+        repeat (int): number of timed rounds
+
+    Returns:
+        list: messages per second of each parser
+    """
+    best = [float("inf")] * len(parsers)
+    for _ in range(repeat):
+        for i, parse in enumerate(parsers):
+            start = time.perf_counter()
+            for line in lines:
+                parse(line)
+            best[i] = min(best[i], time.perf_counter() - start)
+    return [len(lines) / seconds for seconds in best]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sample", help="recorded JSONL of kafka message values")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    lines = load_sample(args.sample) if args.sample else generate_ride_lines()
+    system_lines = [line for line in lines if "[SYSTEM]" in line]
+    info_lines = [line for line in lines if "[SYSTEM]" not in line]
+
+    print(f"messages: {len(lines)} ({len(system_lines)} SYSTEM)")
+    for label, sample in [
+        ("all", lines),
+        ("SYSTEM", system_lines),
+        ("Ride/Telemetry", info_lines),
+    ]:
+        if not sample:
+            continue
+        before, numeric, after = messages_per_second(
+            [legacy_parse, legacy_parse_numeric, util.parse_message],
+            sample,
+            args.repeat,
+        )
+        print(
+            f"{label:>15}: split/eval {before:>10,.0f} msg/s | "
+            f"split/eval + int/float {numeric:>10,.0f} msg/s | "
+            f"parse_message {after:>10,.0f} msg/s"
+        )
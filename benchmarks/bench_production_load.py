@@ -0,0 +1,159 @@
+"""Benchmark of writing production rows with `to_sql` against the COPY bulk loader.
+
+Without `--database` only the client side is timed: `to_sql` inserting
+into an in-memory SQLite database stands in for the row by row INSERTs it
+issues, against the CSV payload `copy_frame` builds for COPY. With
+`--database` both are loaded into scratch tables in PRODUCTION_SCHEMA
+through the DB_* connection settings, the COPY load finishing with the
+rename swap the transform does. COPY payloads are built `--chunk-rows` at a
+time, as the transform writes them. The `to_sql` path is timed on the first
+`--legacy-rows` rows only, as it takes far longer over the whole frame.
+
+    python -m benchmarks.bench_production_load [--rows 10000000] [--legacy-rows 200000]
+        [--chunk-rows 50000] [--database]
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from utils.production_table import (
+    PRODUCTION_COLUMNS,
+    apply_production_dtypes,
+    copy_frame,
+    create_production_table,
+    ensure_partitions,
+    frame_to_csv,
+    load_table_name,
+    partition_days,
+    swap_production_table,
+)
+
+BENCH_TABLE = "BENCH_PRODUCTION_LOAD"
+
+
+def sample_frame(rows: int, seed: int = 1) -> pd.DataFrame:
+    """Production rows as the transform writes them, 200 readings to a ride
+
+    Args:
+        rows (int): number of rows
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: rows with the production columns and types
+    """
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(1, 5000, rows // 200 + 1).repeat(200)[:rows]
+    df = pd.DataFrame(
+        {
+            "user_id": user_ids,
+            "first_name": pd.Series(user_ids % 300).astype(str),
+            "last_name": pd.Series(user_ids % 700).astype(str),
+            "gender": np.where(user_ids % 2, "male", "female"),
+            "age": rng.integers(18, 80, rows),
+            "height": rng.integers(150, 200, rows),
+            "weight": rng.integers(50, 110, rows),
+            "email": pd.Series(user_ids).astype(str) + "@example.com",
+            "ride_id": np.arange(rows) // 200,
+            "time_elapsed": (np.arange(rows) % 200 + 1).astype(float),
+            "resistance": rng.integers(0, 100, rows),
+            "heart_rate": rng.integers(0, 190, rows),
+            "rotations_pm": rng.integers(0, 120, rows),
+            "power": rng.random(rows) * 300,
+            "time": pd.Timestamp("2026-01-01", tz="UTC")
+            + pd.to_timedelta(np.arange(rows), unit="s"),
+        }
+    )
+    return apply_production_dtypes(df)[list(PRODUCTION_COLUMNS)]
+
+
+def client_to_sql(df: pd.DataFrame) -> float:
+    """Times `to_sql` with its default INSERTs into in-memory SQLite"""
+    engine = create_engine("sqlite://")
+    start = time.perf_counter()
+    df.to_sql(BENCH_TABLE, engine, index=False, chunksize=10000)
+    return time.perf_counter() - start
+
+
+def chunks(df: pd.DataFrame, chunk_rows: int):
+    """Splits a frame into the chunks the transform would write"""
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start : start + chunk_rows]
+
+
+def client_copy_frame(df: pd.DataFrame, chunk_rows: int) -> float:
+    """Times building the CSV payloads `copy_frame` streams through COPY"""
+    start = time.perf_counter()
+    for chunk in chunks(df, chunk_rows):
+        frame_to_csv(chunk)
+    return time.perf_counter() - start
+
+
+def database_to_sql(df: pd.DataFrame, engine, schema: str) -> float:
+    """Times `to_sql` replacing a scratch table, as the transform used to"""
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        df.to_sql(BENCH_TABLE, conn, schema=schema, if_exists="replace", index=False)
+    elapsed = time.perf_counter() - start
+
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE "{schema}"."{BENCH_TABLE}"'))
+    return elapsed
+
+
+def database_copy_frame(
+    df: pd.DataFrame, chunk_rows: int, engine, schema: str
+) -> float:
+    """Times COPYing into a load table swapped over a scratch table"""
+    load_name = load_table_name(BENCH_TABLE)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        create_production_table(conn, schema, load_name)
+        ensure_partitions(conn, schema, load_name, partition_days(df["time"]))
+        for chunk in chunks(df, chunk_rows):
+            copy_frame(conn, schema, load_name, chunk)
+        swap_production_table(conn, schema, BENCH_TABLE)
+    elapsed = time.perf_counter() - start
+
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE "{schema}"."{BENCH_TABLE}"'))
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--legacy-rows", type=int, default=200_000)
+    parser.add_argument("--chunk-rows", type=int, default=50000)
+    parser.add_argument("--database", action="store_true")
+    args = parser.parse_args()
+
+    df = sample_frame(args.rows)
+    legacy_sample = df.iloc[: args.legacy_rows]
+
+    if args.database:
+        from utils.db import get_engine
+
+        engine = get_engine()
+        schema = os.environ["PRODUCTION_SCHEMA"]
+        legacy_seconds = database_to_sql(legacy_sample, engine, schema)
+        copy_seconds = database_copy_frame(df, args.chunk_rows, engine, schema)
+    else:
+        legacy_seconds = client_to_sql(legacy_sample)
+        copy_seconds = client_copy_frame(df, args.chunk_rows)
+
+    where = "into aurora" if args.database else "client side only"
+    print(f"rows: {args.rows:,} ({args.legacy_rows:,} for to_sql), {where}")
+    print(
+        f"           to_sql: {len(legacy_sample) / legacy_seconds:>14,.0f} rows/s, "
+        f"{args.rows / (len(legacy_sample) / legacy_seconds):.1f}s projected"
+    )
+    label = "copy_frame+swap" if args.database else "copy_frame"
+    print(
+        f"{label:>17}: {args.rows / copy_seconds:>14,.0f} rows/s, "
+        f"{copy_seconds:.1f}s"
+    )
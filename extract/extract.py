@@ -1,137 +1,307 @@
+import argparse
+import json
+import logging
+import multiprocessing
 import os
-import uuid
-from datetime import datetime
+import time
+from functools import partial
 
 import pandas as pd
-from confluent_kafka import Consumer, cimpl
+from confluent_kafka import Consumer, KafkaException, TopicPartition, cimpl
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
 
-import utils.extract_utils as util
-from utils.dash_app_pages_live_utils import create_row
+from utils.dead_letter import DeadLetterFile
+from utils.dash_app_pages_live_utils import ensure_current_ride_table
+from utils.db import get_engine
+from utils.extract_pipeline import (
+    ExtractPipeline,
+    batch_fill,
+    batch_seconds,
+    messages_consumed,
+    stage_report,
+)
+from utils.known_users import KnownUsers
+from utils.message_sources import OfflineSource, read_recording, synthetic_messages
+from utils.metrics import serve_metrics
+from utils.ride_ids import LocalRideIdAllocator, RideIdAllocator
+from utils.ride_states import load_ride_states
+from utils.staging_tables import ensure_ride_summary_table, ensure_rides_table
+from utils.staging_writer import StagingWriter
 
+UPSERT_KEYS = {"USERS": ("user_id",), "RIDE_SUMMARY": ("ride_id",)}
 
-def user_ride_length() -> int:
-    """Find the number of rides that have occurred
+logger = logging.getLogger(__name__)
 
-    Returns:
-        length (int): length of table from aurora
+
+def get_messages(
+    consumer: cimpl.Consumer,
+    writer: StagingWriter,
+    ride_ids: RideIdAllocator,
+    batch_size: int = 100,
+    batch_timeout: float = 0.5,
+    update_live: bool = True,
+    known_users: KnownUsers = None,
+    dead_letters: DeadLetterFile = None,
+    ride_states: dict = None,
+) -> pd.DataFrame:
     """
+    Connect to kafka topic and get messages in batches,
+    extracts data through the consume, parse, write and live stages of an
+    ExtractPipeline, and pushes the rows to tables on aurora in batches
+
+     Args:
+         consumer (cimpl.Consumer): kafka consumer, or an offline source
+         writer (StagingWriter): buffered writer for the staging tables
+         ride_ids (RideIdAllocator): allocator for the ids of new rides
+         batch_size (int): most messages to consume at once
+         batch_timeout (float): seconds to wait for a batch to fill
+         update_live (bool): whether to upsert each bike's latest reading into CURRENT_RIDE
+         known_users (KnownUsers): cache of users already in USERS, None writes every one
+         dead_letters (DeadLetterFile): quarantine for messages that can't be decoded or parsed,
+                                        None stops on the first one
+         ride_states (dict): bike key to the RideState of its ride in progress
 
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
+     Returns:
+         String: when function is stopped
+    """
+    pipeline = ExtractPipeline(
+        consumer,
+        writer,
+        ride_ids,
+        kafka_topic_name,
+        staging_schema,
+        batch_size,
+        batch_timeout,
+        queue_size,
+        update_live,
+        known_users,
+        dead_letters,
+        log_sample_rate,
+        lag_interval,
+        ride_states,
     )
+
     try:
-        with engine.connect() as conn:
-            user_ride_df = pd.read_sql_table("USER_RIDES", conn, schema=staging_schema)
-            length = len(user_ride_df)
-    except:
-        length = 0
+        pipeline.run()
+
+    except KeyboardInterrupt:
         pass
+
     finally:
-        return length
+        if dead_letters is not None:
+            dead_letters.flush()
+            print(dead_letters.summary())
+        writer.close()
+        for histogram in [
+            batch_fill,
+            batch_seconds,
+            writer.flush_rows,
+            writer.flush_seconds,
+        ]:
+            print(histogram.summary())
+        for line in stage_report():
+            print(line)
+        consumer.close()
 
+    return "Stopped Streaming From Kafka"
 
-def write_df_to_sql_staging(df: pd.DataFrame, table_name: str):
-    """Save the pandas dataframe to tables in staging schema,
-       appends if table exists
+
+def commit_offsets(consumer: cimpl.Consumer, offsets: dict) -> bool:
+    """Commits the offsets of messages whose rows have been flushed to aurora.
+    A commit that fails, e.g. because it overlapped a rebalance, is logged and
+    left to the next flush to retry, as the rows are already safely written.
 
     Args:
-        df (pd.dataframe): dataframe created from kafka stream
-        table_name (_type_): name of table on aurora we want to write to
+        consumer (cimpl.Consumer): kafka consumer
+        offsets (dict): (topic, partition) to the next offset to consume
+
+    Returns:
+        bool: whether the offsets were committed
     """
+    try:
+        consumer.commit(
+            offsets=[
+                TopicPartition(topic, partition, offset)
+                for (topic, partition), offset in offsets.items()
+            ],
+            asynchronous=False,
+        )
+    except KafkaException as error:
+        logger.warning(json.dumps({"event": "commit_failed", "error": str(error)}))
+        return False
+    return True
+
+
+def create_consumer(group_id: str) -> cimpl.Consumer:
+    """Creates a kafka consumer in the given consumer group
 
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
+    Args:
+        group_id (str): consumer group shared by every worker
+
+    Returns:
+        cimpl.Consumer: kafka consumer
+    """
+    return Consumer(
+        {
+            "bootstrap.servers": bootstrap_servers,
+            "security.protocol": security_protocol,
+            "sasl.mechanisms": sasl_mechanisms,
+            "sasl.username": sasl_username,
+            "sasl.password": sasl_password,
+            "group.id": group_id,
+            "auto.offset.reset": "latest",
+            "enable.auto.commit": False,
+        }
     )
-    print("Created engine")
-    with engine.connect() as conn:
-        df.to_sql(
-            table_name, conn, schema=staging_schema, if_exists="append", index=False
-        )
 
-        print("Dataframe pushed")
 
+def run_consumer(group_id: str, metrics_port: int = 0) -> str:
+    """Runs one extract worker: its own consumer, staging writer and ride id block.
+    Each bike's ride in progress is restored from the staging tables first, so
+    the messages replayed from the last committed offsets carry on those rides
+
+    Args:
+        group_id (str): consumer group shared by every worker
+        metrics_port (int): port to serve /metrics on, 0 to not serve them
 
-def get_messages(consumer: cimpl.Consumer) -> pd.DataFrame:
+    Returns:
+        String: when the worker is stopped
     """
-    Connect to kafka topic and get messages,
-    extracts data, and puts into a new df,
-    push to table on aurora
+    if metrics_port:
+        serve_metrics(metrics_port)
+    engine = get_engine()
+    consumer = create_consumer(group_id)
+    writer = StagingWriter(
+        engine,
+        staging_schema,
+        flush_rows,
+        flush_seconds,
+        on_flush=partial(commit_offsets, consumer),
+        upsert_keys=UPSERT_KEYS,
+    )
+    ride_ids = RideIdAllocator(engine, staging_schema, ride_id_block_size)
+    known_users = KnownUsers(engine, staging_schema, known_users_size)
+    known_users.warm()
 
-     Args:
-         consumer (cimpl.Consumer): kafka consumer
+    return get_messages(
+        consumer,
+        writer,
+        ride_ids,
+        batch_size,
+        batch_timeout,
+        known_users=known_users,
+        dead_letters=DeadLetterFile(dead_letter_path),
+        ride_states=load_ride_states(engine, staging_schema),
+    )
 
-     Returns:
-         String: when function is stopped
+
+def run_offline(source: OfflineSource, dry_run: bool) -> str:
+    """Runs the extractor over an offline source instead of the kafka topic
+
+    Args:
+        source (OfflineSource): recorded or synthetic messages
+        dry_run (bool): parse and buffer as normal but skip every database write
+
+    Returns:
+        String: when the source runs out
     """
-    consumer.subscribe([kafka_topic_name])
+    if dry_run:
+        writer = StagingWriter(
+            None, staging_schema, flush_rows, flush_seconds, dry_run=True
+        )
+        ride_ids = LocalRideIdAllocator()
+        known_users = KnownUsers(None, staging_schema, known_users_size)
+    else:
+        engine = get_engine()
+        writer = StagingWriter(
+            engine,
+            staging_schema,
+            flush_rows,
+            flush_seconds,
+            upsert_keys=UPSERT_KEYS,
+        )
+        ride_ids = RideIdAllocator(engine, staging_schema, ride_id_block_size)
+        known_users = KnownUsers(engine, staging_schema, known_users_size)
+        known_users.warm()
 
-    is_initial_system = False
+    start = time.perf_counter()
+    result = get_messages(
+        source,
+        writer,
+        ride_ids,
+        batch_size,
+        batch_timeout,
+        not dry_run,
+        known_users,
+        DeadLetterFile(dead_letter_path),
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"{messages_consumed.value} messages in {elapsed:.2f}s, "
+        f"{messages_consumed.value / elapsed:,.0f} msg/s end to end"
+    )
+    return result
 
-    try:
-        while True:
-            consumer_poll = consumer.poll(0.5)
-
-            if consumer_poll is None:
-                print("Waiting for new messages")
-                continue
-            if consumer_poll.error():
-                print("Error!")
-
-            msg_dict = util.decode_message(consumer_poll)
-
-            msg = msg_dict["log"]
-
-            print(msg)
-
-            if "SYSTEM" in msg:
-                ride_id = user_ride_length() + 1
-                user_ride_data, user_data = util.process_system_message(msg, ride_id)
-                user_ride_df, user_df = util.process_system_data(
-                    user_ride_data, user_data
-                )
-
-                write_df_to_sql_staging(user_ride_df, "USER_RIDES")
-                write_df_to_sql_staging(user_df, "USERS")
-                is_initial_system = True
-            elif "Ride" in msg:
-                resistance_duration = util.process_ride_message(msg)
-            elif "Telemetry" in msg:
-                power_hrt_rpm = util.process_telemetry_message(msg)
-
-                if is_initial_system:
-                    ride_df = util.process_ride_telemetry_data(
-                        resistance_duration, power_hrt_rpm, ride_id
-                    )
-                    write_df_to_sql_staging(ride_df, "RIDES")
-                    create_row(
-                        ride_df[0],
-                        user_data[1],
-                        user_data[2],
-                        user_data[3],
-                        str(user_data[4]),
-                        ride_df[1],
-                        ride_df[3],
-                        user_data[7],
-                        user,
-                        password,
-                        hostname,
-                        port,
-                        db_name,
-                        staging_schema,
-                    )
 
+def run_workers(workers: int, group_id: str):
+    """Runs several extract workers as separate processes in one consumer group,
+       kafka shares the topic's partitions out between them, each worker
+       serves its metrics on the next port up from METRICS_PORT. Exits with
+       an error once every worker has stopped if any of them failed
+
+    Args:
+        workers (int): number of worker processes
+        group_id (str): consumer group shared by every worker
+    """
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=run_consumer,
+            args=(group_id, metrics_port + i if metrics_port else 0),
+            name=f"extract-{i}",
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
     except KeyboardInterrupt:
-        pass
+        for process in processes:
+            process.join()
 
-    finally:
-        consumer.close()
-        return "Stopped Streaming From Kafka"
+    failed = [process.name for process in processes if process.exitcode]
+    if failed:
+        raise SystemExit(f"Extract workers failed: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
     load_dotenv()
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(message)s")
+
+    parser = argparse.ArgumentParser(description="Deloton kafka extractor")
+    parser.add_argument(
+        "--replay", help="run from a recorded JSONL file (.gz, .bz2, .xz accepted)"
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="BIKES",
+        help="run from a local stand-in producer with this many bikes",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="replay at the recorded pace instead of as fast as possible",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="offline runs only: skip every database write",
+    )
+    args = parser.parse_args()
 
     bootstrap_servers = os.environ.get("KAFKA_SERVER")
     security_protocol = "SASL_SSL"
@@ -139,10 +309,49 @@ if __name__ == "__main__":
     sasl_username = os.environ.get("KAFKA_USERNAME")
     sasl_password = os.environ.get("KAFKA_PASSWORD")
     kafka_topic_name = os.environ.get("KAFKA_TOPIC")
+    group_id = os.environ.get("KAFKA_GROUP_ID", "deloton-extract")
+
+    staging_schema = os.environ.get("STAGING_SCHEMA")
+    flush_rows = int(os.environ.get("STAGING_FLUSH_ROWS", 500))
+    flush_seconds = float(os.environ.get("STAGING_FLUSH_SECONDS", 5))
+    ride_id_block_size = int(os.environ.get("RIDE_ID_BLOCK_SIZE", 20))
+    batch_size = int(os.environ.get("KAFKA_BATCH_SIZE", 100))
+    batch_timeout = float(os.environ.get("KAFKA_BATCH_TIMEOUT", 0.5))
+    queue_size = int(os.environ.get("EXTRACT_QUEUE_SIZE", 8))
+    known_users_size = int(os.environ.get("KNOWN_USERS_CACHE_SIZE", 100000))
+    dead_letter_path = os.environ.get("DEAD_LETTER_PATH", "dead_letters.jsonl")
+    workers = int(os.environ.get("EXTRACT_WORKERS", 1))
+    metrics_port = int(os.environ.get("METRICS_PORT", 9100))
+    log_sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+    lag_interval = float(os.environ.get("CONSUMER_LAG_INTERVAL", 10))
+
+    if args.replay or args.synthetic:
+        if args.replay:
+            messages = read_recording(args.replay)
+        else:
+            messages = synthetic_messages(bikes=args.synthetic)
+        source = OfflineSource(messages, realtime=args.realtime)
+        if not args.dry_run:
+            RideIdAllocator(
+                get_engine(), staging_schema, ride_id_block_size
+            ).ensure_sequence()
+            KnownUsers(get_engine(), staging_schema).ensure_table()
+            ensure_rides_table(get_engine(), staging_schema)
+            ensure_ride_summary_table(get_engine(), staging_schema)
+            ensure_current_ride_table(staging_schema)
+        if metrics_port:
+            serve_metrics(metrics_port)
+        print(run_offline(source, args.dry_run))
+    else:
+        RideIdAllocator(
+            get_engine(), staging_schema, ride_id_block_size
+        ).ensure_sequence()
+        KnownUsers(get_engine(), staging_schema).ensure_table()
+        ensure_rides_table(get_engine(), staging_schema)
+        ensure_ride_summary_table(get_engine(), staging_schema)
+        ensure_current_ride_table(staging_schema)
 
-    user = os.environ["DB_USER"]
-    password = os.environ["DB_PASSWORD"]
-    hostname = os.environ["DB_HOST"]
-    db_name = os.environ["DB_NAME"]
-    port = os.environ["DB_PORT"]
-    staging_schema = os.environ["STAGING_SCHEMA"]
+        if workers > 1:
+            run_workers(workers, group_id)
+        else:
+            print(run_consumer(group_id, metrics_port))
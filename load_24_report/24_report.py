@@ -1,5 +1,6 @@
 import os
 from datetime import datetime as dt
+from datetime import timedelta, timezone
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -10,41 +11,66 @@ import plotly.express as px
 import PyPDF2
 from dotenv import load_dotenv
 from fpdf import FPDF
-from sqlalchemy import create_engine
 
 import utils.report_utils as report_utils
+from utils.db import get_engine
+from utils.production_table import apply_production_dtypes
+from utils.ride_summaries import mean_by_user, overall_mean, read_ride_summaries
+from utils.snapshot import read_snapshot
 
 load_dotenv()
-user = os.environ["DB_USER"]
-password = os.environ["DB_PASSWORD"]
-hostname = os.environ["DB_HOST"]
-db_name = os.environ["DB_NAME"]
-port = os.environ["DB_PORT"]
 production_schema = os.environ["PRODUCTION_SCHEMA"]
 production_table = os.environ["PRODUCTION_TABLE"]
+staging_schema = os.environ["STAGING_SCHEMA"]
 name = os.environ["NAME"]
 sender_email = os.environ["SENDER_EMAIL"]
 recipient_email = os.environ["RECIPIENT_EMAIL"]
+snapshot_path = os.environ.get("SNAPSHOT_PATH")
+
+REPORT_COLUMNS = [
+    "user_id",
+    "ride_id",
+    "gender",
+    "age",
+    "time_elapsed",
+    "heart_rate",
+    "power",
+    "time",
+]
 
 
 def fetch_dashboard_data() -> pd.DataFrame:
-    """Connect to AWS Aurora database and read the dashboard data as a Pandas Dataframe
+    """Connect to AWS Aurora database and read the dashboard data as a Pandas Dataframe.
+    With SNAPSHOT_PATH set, the last 23 hours are read from the Parquet snapshot
+    of the production table instead, falling back to aurora until one exists.
 
     Returns:
         pd.DataFrame: Dataframe from production schema to be used for visualizations
     """
+    if snapshot_path:
+        since = dt.now(timezone.utc) - timedelta(hours=23)
+        df = read_snapshot(snapshot_path, REPORT_COLUMNS, since)
+        if df is not None:
+            return df
+
     query = f"""
             SELECT * FROM {production_schema}.{production_table}
-            WHERE to_timestamp(time, 'DD-MM-YYYY HH24:MI:SS') > (NOW() - INTERVAL '23 HOUR')
+            WHERE "time" > (NOW() - INTERVAL '23 HOUR')
             """
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
-    )
-
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         df = pd.read_sql_query(query, conn)
 
-    return df
+    return apply_production_dtypes(df)
+
+
+def fetch_ride_summaries() -> pd.DataFrame:
+    """Reads the summaries of the rides with a reading in the last 23 hours
+
+    Returns:
+        pd.DataFrame: one row per ride, None until RIDE_SUMMARY exists
+    """
+    since = dt.now(timezone.utc) - timedelta(hours=23)
+    return read_ride_summaries(get_engine(), staging_schema, since)
 
 
 def create_multipart_message(
@@ -123,16 +149,35 @@ def send_mail(
 
 
 def handler(event, context):
-    df_24 = fetch_dashboard_data()
-
-    total_rides = len(df_24["ride_id"].unique())
-    avg_heart_rate = (
-        df_24["heart_rate"].astype(float).agg({"heart_rate": "mean"}).round().values[0]
-    )
-    avg_power = df_24["power"].astype(float).agg({"power": "mean"}).round().values[0]
-    total_power = df_24["power"].astype(float).agg({"power": "sum"}).round().values[0]
-
-    df_unique_rides = df_24[(df_24["time_elapsed"] == "1.0")]
+    summaries = fetch_ride_summaries()
+
+    if summaries is not None:
+        total_rides = len(summaries)
+        avg_heart_rate = round(overall_mean(summaries, "heart_rate"), 0)
+        avg_power = round(overall_mean(summaries, "power"), 0)
+        total_power = round(summaries["power_sum"].sum(), 0)
+        df_unique_rides = summaries
+        df_hr = mean_by_user(summaries, "heart_rate")
+        df_power = mean_by_user(summaries, "power")
+    else:
+        df_24 = fetch_dashboard_data()
+        total_rides = len(df_24["ride_id"].unique())
+        avg_heart_rate = (
+            df_24["heart_rate"]
+            .astype(float)
+            .agg({"heart_rate": "mean"})
+            .round()
+            .values[0]
+        )
+        avg_power = (
+            df_24["power"].astype(float).agg({"power": "mean"}).round().values[0]
+        )
+        total_power = (
+            df_24["power"].astype(float).agg({"power": "sum"}).round().values[0]
+        )
+        df_unique_rides = df_24[(df_24["time_elapsed"] == 1)]
+        df_hr = df_24.groupby("user_id").agg({"heart_rate": "mean"}).reset_index()
+        df_power = df_24.groupby("user_id").agg({"power": "mean"}).reset_index()
 
     df_gender = df_unique_rides.groupby("gender").count().reset_index()
 
@@ -200,12 +245,6 @@ def handler(event, context):
         )
     )
 
-    df_hr_cleaned = df_24.copy()
-    df_hr_cleaned["heart_rate"] = df_hr_cleaned["heart_rate"].apply(
-        lambda x: report_utils.convert_HR_column(x)
-    )
-    df_hr = df_hr_cleaned.groupby("user_id").agg({"heart_rate": "mean"}).reset_index()
-
     my_colors3 = [(x / 10.0, x / 20.0, 0.9) for x in range(len(df_hr))]
 
     avg_hr_fig = (
@@ -239,12 +278,6 @@ def handler(event, context):
         .update_layout(title_font_color="#00898a", title_x=0.46, width=650, height=500)
     )
 
-    df_power_cleaned = df_24.copy()
-    df_power_cleaned["power"] = df_power_cleaned["power"].apply(
-        lambda x: report_utils.convert_power_column(x)
-    )
-    df_power = df_power_cleaned.groupby("user_id").agg({"power": "mean"}).reset_index()
-
     avg_power_fig = (
         px.bar(
             df_power,
@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-from dash_extract import df
+from dash_extract import df, summary_df
 
 
 def change_seconds_to_minutes(x: int) -> int:
@@ -47,6 +47,28 @@ def duration_by_gender_df(df: pd.DataFrame) -> pd.DataFrame:
     return total_duration_by_gender
 
 
+def duration_by_gender_from_summaries(summaries: pd.DataFrame) -> pd.DataFrame:
+    """Shows the total duration of bike rides taken by males and females from
+    the ride summaries, one row per ride, and changes duration from seconds to hours
+
+    Args:
+        summaries (pd.DataFrame): ride id, gender and duration of each ride
+
+    Returns:
+        pd.DataFrame: total duration and gender with duration augmented
+    """
+
+    total_duration_by_gender = (
+        summaries.groupby("gender")[["duration"]]
+        .sum()
+        .rename(columns={"duration": "time_elapsed"})
+    )
+    total_duration_by_gender.time_elapsed = total_duration_by_gender.time_elapsed.apply(
+        lambda x: change_seconds_to_minutes(x)
+    )
+    return total_duration_by_gender
+
+
 age_bins = [
     "0-18",
     "19-25",
@@ -116,8 +138,12 @@ def time_power_output_df(df: pd.DataFrame) -> pd.DataFrame:
     return df[["time", "power"]]
 
 
-id_gender_duration_df = generate_id_gender_duration_df(df)
-total_duration_by_gender = duration_by_gender_df(id_gender_duration_df)
+if summary_df is not None:
+    id_gender_duration_df = summary_df[["ride_id", "gender", "duration"]]
+    total_duration_by_gender = duration_by_gender_from_summaries(id_gender_duration_df)
+else:
+    id_gender_duration_df = generate_id_gender_duration_df(df)
+    total_duration_by_gender = duration_by_gender_df(id_gender_duration_df)
 age_rides_df_with_bins = rides_across_age_groups(df)
 duration_by_age = duration_of_rides_across_age_groups(df)
 time_power_df = time_power_output_df(df)
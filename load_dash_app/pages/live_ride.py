@@ -8,8 +8,8 @@ import dash
 import dash_bootstrap_components as dbc
 import pandas as pd
 from utils.dash_app_pages_live_utils import (
+    get_current_ride,
     get_current_ride_data,
-    get_new_df,
     send_email,
 )
 from dash import Input, Output, callback, dash_table, dcc, html
@@ -17,11 +17,6 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-user = os.environ["DB_USER"]
-password = os.environ["DB_PASSWORD"]
-hostname = os.environ["DB_HOST"]
-db_name = os.environ["DB_NAME"]
-port = os.environ["DB_PORT"]
 staging_schema = os.environ["STAGING_SCHEMA"]
 
 html_text = """<html>
@@ -106,9 +101,7 @@ def update_table(n: int) -> pd.DataFrame:
         pd.DataFrame: Returns dataframe of new data.
     """
     try:
-        df = get_new_df(
-            "CURRENT_RIDE", user, password, hostname, port, db_name, staging_schema
-        )
+        df = get_current_ride(staging_schema)
         df["GENDER"] = df["GENDER"][0].capitalize()
     except TypeError as te:
         print(te)
@@ -168,8 +161,6 @@ def update_graph(n: int, data: dict) -> px.pie:
         px.pie: Plotly express pie chart
     """
     ride_id = data[0]["RIDE_ID"]
-    df = get_current_ride_data(
-        ride_id, user, password, hostname, port, db_name, staging_schema, "RIDES"
-    )
+    df = get_current_ride_data(ride_id, staging_schema, "RIDES")
     figure = px.line(df, x="duration", y="heart_rate")
     return figure
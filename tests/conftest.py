@@ -0,0 +1,10 @@
+import os
+
+# The modules under test read these when they are imported
+for name, value in {
+    "SENDER": "sender@example.com",
+    "STAGING_SCHEMA": "staging",
+    "PRODUCTION_SCHEMA": "production",
+    "PRODUCTION_TABLE": "EZ_PRODUCTION_TABLE",
+}.items():
+    os.environ.setdefault(name, value)
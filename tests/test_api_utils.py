@@ -0,0 +1,75 @@
+import contextlib
+import importlib
+import json
+import sys
+
+import pandas as pd
+import pytest
+
+import utils.db
+import utils.ride_summaries
+from utils.production_table import apply_production_dtypes
+
+
+class FakeEngine:
+    def connect(self):
+        return contextlib.nullcontext()
+
+
+RIDE_SUMMARIES = pd.DataFrame(
+    {"user_id": [1, 2], "heart_rate_count": [1, 0], "heart_rate_sum": [120, 0]}
+)
+
+
+@pytest.fixture(params=[RIDE_SUMMARIES, None], ids=["summaries", "no_summaries"])
+def api_utils(request, monkeypatch):
+    """utils.api_utils imported over two rides, the second rider with no age,
+    with and without a RIDE_SUMMARY table to read heart rates from"""
+    tables = {
+        "EZ_PRODUCTION_TABLE": apply_production_dtypes(
+            pd.DataFrame(
+                {
+                    "user_id": [1, 2],
+                    "ride_id": [10, 11],
+                    "first_name": ["Ann", "Eve"],
+                    "last_name": ["Smith", "Brown"],
+                    "gender": ["female", "female"],
+                    "age": [34, None],
+                    "email": ["ann@example.com", "eve@example.com"],
+                    "time_elapsed": [1.0, 1.0],
+                    "heart_rate": [120, 0],
+                    "time": pd.to_datetime(
+                        ["2022-10-13 13:00:00", "2022-10-13 14:00:00"], utc=True
+                    ),
+                }
+            )
+        ),
+    }
+    monkeypatch.delenv("SNAPSHOT_PATH", raising=False)
+    monkeypatch.setattr(utils.db, "get_engine", FakeEngine)
+    monkeypatch.setattr(
+        pd, "read_sql_table", lambda table_name, conn, schema: tables[table_name]
+    )
+    monkeypatch.setattr(
+        utils.ride_summaries,
+        "read_ride_summaries",
+        lambda engine, schema, since=None: request.param,
+    )
+    monkeypatch.delitem(sys.modules, "utils.api_utils", raising=False)
+    return importlib.import_module("utils.api_utils")
+
+
+def test_rides_with_a_missing_age_serialise(api_utils):
+    rides = json.loads(json.dumps(api_utils.get_ride_by_id(["10", "11"])))
+
+    assert rides["all_rides_available"]
+    assert [ride["age"] for ride in rides["rides"]] == [34, None]
+
+
+def test_riders_with_a_missing_age_serialise(api_utils):
+    riders = json.loads(json.dumps(api_utils.get_rider_info(["1", "2"])))
+
+    assert [(rider["age"], rider["avg_heart_rate"]) for rider in riders] == [
+        (34, 120),
+        (None, None),
+    ]
@@ -0,0 +1,31 @@
+from functools import partial
+
+from confluent_kafka import KafkaError, KafkaException
+
+from extract.extract import commit_offsets
+from utils.message_sources import OfflineSource
+from utils.staging_writer import StagingWriter
+
+
+class RebalancingConsumer(OfflineSource):
+    """Consumer whose commits fail as they do while a rebalance is in progress"""
+
+    def commit(self, offsets: list = None, asynchronous: bool = True):
+        raise KafkaException(KafkaError(KafkaError.REBALANCE_IN_PROGRESS))
+
+
+def test_failed_commit_is_kept_for_the_next_flush():
+    consumer = RebalancingConsumer([])
+    writer = StagingWriter(
+        None, "staging", on_flush=partial(commit_offsets, consumer), dry_run=True
+    )
+
+    writer.add_batch({}, {("deloton", 0): 5})
+    writer.flush()
+    assert writer._offsets == {("deloton", 0): 5}
+
+    writer.add_batch({}, {("deloton", 1): 9})
+    writer.on_flush = partial(commit_offsets, OfflineSource([]))
+    writer.flush()
+    assert writer._offsets == {}
+    assert writer.on_flush.args[0].committed == {("deloton", 0): 5, ("deloton", 1): 9}
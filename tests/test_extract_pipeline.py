@@ -0,0 +1,232 @@
+import asyncio
+import json
+
+import pytest
+from confluent_kafka import TopicPartition
+
+from utils.dead_letter import DeadLetterFile
+from utils.extract_pipeline import ExtractPipeline, by_partition
+from utils.extract_utils import (
+    RideReading,
+    RideState,
+    RideSummary,
+    TelemetryReading,
+    UserDetails,
+)
+from utils.known_users import KnownUsers
+from utils.message_sources import ReplayMessage
+from utils.ride_ids import LocalRideIdAllocator
+
+PREFIX = "2022-10-13 13:00:00.000000 mendoza v9:"
+
+
+def make_message(value, offset: int, key: bytes = b"bike-1") -> ReplayMessage:
+    """A consumed message carrying a log line, or `value` as it is when it isn't a str"""
+    if isinstance(value, str):
+        value = json.dumps({"log": value}).encode("utf-8")
+    return ReplayMessage(value, key, "deloton", 0, offset, 1665666000000)
+
+
+def make_pipeline(tmp_path) -> ExtractPipeline:
+    return ExtractPipeline(
+        consumer=None,
+        writer=None,
+        ride_ids=LocalRideIdAllocator(),
+        topic="deloton",
+        staging_schema="staging",
+        update_live=False,
+        dead_letters=DeadLetterFile(str(tmp_path / "dead_letters.jsonl")),
+    )
+
+
+def read_dead_letters(tmp_path) -> list:
+    with open(tmp_path / "dead_letters.jsonl") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_message_without_value_is_quarantined(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+
+    batch, _ = pipeline._parse_batch([make_message(None, offset=7)])
+    pipeline.dead_letters.flush()
+
+    [record] = read_dead_letters(tmp_path)
+    assert record["error_type"] == "AttributeError"
+    assert record["offset"] == 7
+    assert record["value"] is None
+    assert batch.offsets == {("deloton", 0): 8}
+
+
+@pytest.mark.parametrize("log", [None, 5, ["a log line"]])
+def test_message_whose_log_is_not_a_str_is_quarantined(tmp_path, log):
+    pipeline = make_pipeline(tmp_path)
+    value = json.dumps({"log": log}).encode("utf-8")
+
+    batch, _ = pipeline._parse_batch([make_message(value, offset=3)])
+    pipeline.dead_letters.flush()
+
+    [record] = read_dead_letters(tmp_path)
+    assert record["error_type"] == "TypeError"
+    assert batch.offsets == {("deloton", 0): 4}
+
+
+def system_line(user_id: int, name: str) -> str:
+    user = {
+        "user_id": user_id,
+        "name": name,
+        "gender": "female",
+        "date_of_birth": 631152000000,
+        "email_address": f"rider{user_id}@example.com",
+        "height_cm": 170,
+        "weight_kg": 60,
+    }
+    return f"{PREFIX} [SYSTEM] data = {json.dumps(user)}"
+
+
+def ride_lines(second: int) -> list:
+    return [
+        f"{PREFIX} [INFO]: Ride - duration = {second}.0; resistance = 50",
+        f"{PREFIX} [INFO]: Telemetry - hrt = 120; rpm = 80; power = 150.5",
+    ]
+
+
+def test_quarantined_system_message_ends_the_ride(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    lines = [
+        system_line(1, "Ann Smith"),
+        *ride_lines(1),
+        system_line(2, "Dr Ann Mary Smith"),
+        *ride_lines(1),
+        *ride_lines(2),
+    ]
+
+    batch, _ = pipeline._parse_batch(
+        [make_message(line, offset) for offset, line in enumerate(lines)]
+    )
+    pipeline.dead_letters.flush()
+
+    assert [row.ride_id for row in batch.rows["RIDES"]] == [1]
+    assert [row.ride_id for row in batch.rows["RIDE_SUMMARY"]] == [1]
+    assert batch.rows["RIDE_SUMMARY"][0].readings == 1
+    assert [record["error_type"] for record in read_dead_letters(tmp_path)] == [
+        "UserDetailsError"
+    ]
+
+    batch, _ = pipeline._parse_batch(
+        [make_message(line, offset) for offset, line in enumerate(ride_lines(3))]
+    )
+    assert batch.rows["RIDES"] == []
+
+
+class RecordingWriter:
+    """Stand-in for the StagingWriter, keeping what it is handed"""
+
+    def __init__(self):
+        self.batches = []
+        self.offsets = {}
+        self.flushes = 0
+
+    def add_batch(self, rows: dict, offsets: dict = None):
+        self.batches.append(rows)
+        self.offsets.update(offsets or {})
+
+    def flush(self):
+        self.flushes += 1
+
+    def discard_offsets(self, partitions: set):
+        for partition in partitions:
+            self.offsets.pop(partition, None)
+
+
+def test_batches_from_revoked_partitions_are_dropped(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.writer = RecordingWriter()
+    pipeline.writer.offsets[("deloton", 0)] = 3
+    lines = [system_line(1, "Ann Smith"), *ride_lines(1)]
+    messages = [make_message(line, offset) for offset, line in enumerate(lines)]
+    for message in messages[len(lines) - 1 :]:
+        message._partition = 1
+    consumed_at = pipeline._revocations
+
+    batches = []
+    for partition, partition_messages in by_partition(messages).items():
+        batch, _ = pipeline._parse_batch(partition_messages)
+        batches.append(batch._replace(partition=partition, consumed_at=consumed_at))
+    pipeline._on_revoke(None, [TopicPartition("deloton", 0)])
+    pipeline._add_batches(batches)
+
+    assert pipeline.writer.flushes == 1
+    assert pipeline.writer.offsets == {("deloton", 1): 3}
+    assert len(pipeline.writer.batches) == 1
+
+
+def parse(pipeline: ExtractPipeline, messages: list, consumed_at: int) -> list:
+    """Runs one consumed batch through the parse stage, returning its ParsedBatches"""
+
+    async def run():
+        inbox, outbox, live = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+        inbox.put_nowait((messages, consumed_at))
+        inbox.put_nowait(None)
+        await pipeline._parse(inbox, outbox, live)
+        return outbox.get_nowait()
+
+    return asyncio.run(run())
+
+
+def test_revoked_partition_is_consumed_again_from_the_accepted_state(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.writer = RecordingWriter()
+    pipeline.known_users = KnownUsers(None, "staging")
+    lines = [
+        system_line(1, "Ann Smith"),
+        *ride_lines(1),
+        *ride_lines(2),
+        system_line(2, "Eve Brown"),
+        *ride_lines(1),
+    ]
+    messages = [make_message(line, offset) for offset, line in enumerate(lines)]
+
+    pipeline._add_batches(parse(pipeline, messages[:3], consumed_at=0))
+    in_flight = parse(pipeline, messages[3:5], consumed_at=0)
+    pipeline._on_revoke(None, [TopicPartition("deloton", 0)])
+    # Consumed before the revocation, but only reaches the parse stage after it
+    in_flight += parse(pipeline, messages[5:], consumed_at=0)
+    pipeline._add_batches(in_flight)
+
+    assert len(pipeline.writer.batches) == 1
+    assert pipeline.writer.offsets == {}
+
+    pipeline._add_batches(parse(pipeline, messages[3:], consumed_at=1))
+
+    [first, replayed] = pipeline.writer.batches
+    assert [row.ride_id for row in first["RIDES"]] == [1]
+    assert [row.duration for row in replayed["RIDES"]] == [2.0, 1.0]
+    assert {row.ride_id: row.readings for row in replayed["RIDE_SUMMARY"]} == {
+        1: 2,
+        replayed["USER_RIDES"][0].ride_id: 1,
+    }
+    assert [row.user_id for row in replayed["USERS"]] == [2]
+    assert pipeline.writer.offsets == {("deloton", 0): 8}
+
+
+def test_restored_ride_carries_on_after_a_restart(tmp_path):
+    user = UserDetails(1, "Ann", "Smith", "female", 631152000000, 170, 60, "a@b.c")
+    state = RideState()
+    state.start_ride(41, user)
+    summary = state.summary
+    summary.add(RideReading(1.0, 50), TelemetryReading(100, 80, 100.0), None)
+    state.summary = RideSummary.from_row(summary.row())
+
+    pipeline = make_pipeline(tmp_path)
+    pipeline.states = {"bike-1": state}
+    lines = [f"{PREFIX} [INFO]: Telemetry - hrt = 110; rpm = 80; power = 90.0"]
+    lines += ride_lines(2)
+    batch, _ = pipeline._parse_batch(
+        [make_message(line, offset) for offset, line in enumerate(lines)]
+    )
+
+    # The first reading has no Ride message to pair with after the restart
+    assert [(row.ride_id, row.duration) for row in batch.rows["RIDES"]] == [(41, 2.0)]
+    [row] = batch.rows["RIDE_SUMMARY"]
+    assert (row.ride_id, row.user_id, row.readings) == (41, 1, 2)
+    assert row.heart_rate_sum == 220
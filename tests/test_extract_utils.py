@@ -0,0 +1,198 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from utils.extract_utils import (
+    MessageParseError,
+    RideReading,
+    RideSummary,
+    RideSummaryRow,
+    TelemetryReading,
+    UserDetails,
+    UserDetailsError,
+    extract_user_name,
+    parse_message,
+)
+
+PREFIX = "2022-10-13 13:00:00.000000 mendoza v9:"
+USER = {
+    "user_id": 7,
+    "name": "Mr Jack Jones",
+    "gender": "male",
+    "date_of_birth": -600000000000,
+    "email_address": "jack@example.com",
+    "height_cm": 180,
+    "weight_kg": 80,
+}
+
+
+def test_parse_system_message():
+    line = f"{PREFIX} [SYSTEM] data = {json.dumps(USER)}\n"
+
+    assert parse_message(line) == UserDetails(
+        7, "Jack", "Jones", "male", -600000000000, 180, 80, "jack@example.com"
+    )
+
+
+def test_parse_system_message_with_python_literal_payload():
+    line = f"{PREFIX} [SYSTEM] data = {USER!r}\n"
+
+    assert parse_message(line).user_id == 7
+
+
+def test_parse_ride_message():
+    line = f"{PREFIX} [INFO]: Ride - duration = 12.0; resistance = 40\n"
+
+    assert parse_message(line) == RideReading(12.0, 40)
+
+
+def test_parse_telemetry_message():
+    line = f"{PREFIX} [INFO]: Telemetry - hrt = 120; rpm = 80; power = 150.5\n"
+
+    assert parse_message(line) == TelemetryReading(120, 80, 150.5)
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        (
+            f"{PREFIX} [INFO]: Telemetry - hrt = 0; rpm = 1500; power = 0.0",
+            TelemetryReading(0, 1500, 0.0),
+        ),
+        (
+            f"{PREFIX} [INFO]: Telemetry - hrt = -1; rpm = 80; power = 1e3\n",
+            TelemetryReading(-1, 80, 1000.0),
+        ),
+        (f"{PREFIX} [INFO]: Ride - duration = 5; resistance = 0", RideReading(5.0, 0)),
+    ],
+)
+def test_parse_readings_outside_the_usual_range(line, expected):
+    reading = parse_message(line)
+
+    assert type(reading) is type(expected)
+    assert reading == expected
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        f"{PREFIX} [INFO]: Ride started\n",
+        f"{PREFIX} [WARNING]: Bike restarting\n",
+        "not a log line\n",
+        "",
+    ],
+)
+def test_other_lines_are_ignored(line):
+    assert parse_message(line) is None
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        f"{PREFIX} [INFO]: Ride - duration = ; resistance = 40\n",
+        f"{PREFIX} [INFO]: Ride - duration = 12.0\n",
+        f"{PREFIX} [INFO]: Ride - duration = 12.0; resistance = high\n",
+        f"{PREFIX} [INFO]: Telemetry - hrt = 120; rpm = 80\n",
+        f"{PREFIX} [INFO]: Telemetry - hrt = 120.5; rpm = 80; power = 150.5\n",
+        f"{PREFIX} [INFO]: Telemetry - hrt = 120; rpm = 80; power = 150.5; x = 1\n",
+    ],
+)
+def test_malformed_readings_raise(line):
+    with pytest.raises(MessageParseError):
+        parse_message(line)
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        "{not a dict",
+        json.dumps(
+            {key: value for key, value in USER.items() if key != "email_address"}
+        ),
+        json.dumps({**USER, "name": "Jack"}),
+        json.dumps([USER]),
+    ],
+)
+def test_malformed_system_messages_raise(payload):
+    with pytest.raises(UserDetailsError):
+        parse_message(f"{PREFIX} [SYSTEM] data = {payload}\n")
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("Jack Jones", ("Jack", "Jones")),
+        ("Mr Jack Jones", ("Jack", "Jones")),
+        ("Dr  Eve Brown", ("Eve", "Brown")),
+    ],
+)
+def test_extract_user_name(name, expected):
+    assert extract_user_name(name) == expected
+
+
+@pytest.mark.parametrize("name", ["Jack", "", "Mr Jack van Jones"])
+def test_extract_user_name_rejects_other_shapes(name):
+    with pytest.raises(UserDetailsError):
+        extract_user_name(name)
+
+
+def test_ride_summary_aggregates_readings_leaving_out_zeroes():
+    start = datetime(2022, 10, 13, 13, tzinfo=timezone.utc)
+    summary = RideSummary(10, 7)
+    summary.add(RideReading(1.0, 40), TelemetryReading(120, 60, 100.0), start)
+    summary.add(
+        RideReading(3.0, 40),
+        TelemetryReading(0, 60, 50.0),
+        start + timedelta(seconds=2),
+    )
+    summary.add(
+        RideReading(2.0, 40),
+        TelemetryReading(140, 0, 0.0),
+        start + timedelta(seconds=3),
+    )
+
+    assert summary.row() == RideSummaryRow(
+        ride_id=10,
+        user_id=7,
+        started_at=start,
+        last_reading_at=start + timedelta(seconds=3),
+        duration=3.0,
+        readings=3,
+        heart_rate_count=2,
+        heart_rate_sum=260,
+        heart_rate_min=120,
+        heart_rate_max=140,
+        power_count=2,
+        power_sum=150.0,
+        power_min=50.0,
+        power_max=100.0,
+        total_work=200.0,
+    )
+
+
+def test_ride_summary_carries_on_from_its_row():
+    start = datetime(2022, 10, 13, 13, tzinfo=timezone.utc)
+    summary = RideSummary(10, 7)
+    summary.add(RideReading(1.0, 40), TelemetryReading(120, 60, 100.0), start)
+
+    carried_on = RideSummary.from_row(summary.row())
+    copy = summary.copy()
+    carried_on.add(
+        RideReading(2.0, 40),
+        TelemetryReading(130, 60, 80.0),
+        start + timedelta(seconds=1),
+    )
+
+    assert copy.row() == summary.row()
+    assert carried_on.row()._replace(last_reading_at=start) == summary.row()._replace(
+        duration=2.0,
+        readings=2,
+        heart_rate_count=2,
+        heart_rate_sum=250,
+        heart_rate_max=130,
+        power_count=2,
+        power_sum=180.0,
+        power_min=80.0,
+        total_work=180.0,
+    )
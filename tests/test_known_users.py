@@ -0,0 +1,35 @@
+from utils.extract_utils import UserRow
+from utils.known_users import KnownUsers
+
+ANN = UserRow(1, "Ann", "Smith", "female", "100", 160, 60, "ann@example.com")
+EVE = UserRow(2, "Eve", "Brown", "female", "200", 170, 65, "eve@example.com")
+
+
+def test_users_are_new_until_remembered():
+    users = KnownUsers(None, "staging")
+
+    assert users.is_new_or_changed(ANN)
+    assert users.is_new_or_changed(ANN)
+
+    users.remember([ANN])
+    assert not users.is_new_or_changed(ANN)
+    assert users.is_new_or_changed(EVE)
+
+
+def test_changed_details_need_writing_again():
+    users = KnownUsers(None, "staging")
+    users.remember([ANN])
+
+    assert users.is_new_or_changed(ANN._replace(email="ann@example.org"))
+
+
+def test_least_recently_remembered_user_is_forgotten():
+    users = KnownUsers(None, "staging", max_size=2)
+    carol = EVE._replace(user_id=3, first_name="Carol")
+    users.remember([ANN, EVE])
+    users.remember([ANN, carol])
+
+    assert len(users) == 2
+    assert not users.is_new_or_changed(ANN)
+    assert users.is_new_or_changed(EVE)
+    assert not users.is_new_or_changed(carol)
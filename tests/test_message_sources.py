@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+from utils.message_sources import OfflineSource, ReplayMessage, SourceExhausted
+
+
+def make_messages(*timestamps):
+    return [
+        ReplayMessage(b"{}", None, "replay", 0, offset, timestamp)
+        for offset, timestamp in enumerate(timestamps)
+    ]
+
+
+def test_realtime_consume_returns_what_arrived_when_the_timeout_expires():
+    first, second = make_messages(1665666000000, 1665666010000)
+    source = OfflineSource([first, second], realtime=True)
+
+    started = time.monotonic()
+    assert source.consume(10, timeout=0.05) == [first]
+    assert source.consume(10, timeout=0.05) == []
+    assert time.monotonic() - started < 1
+
+    # The message held back by the timeout is still served once it is due
+    source._started_at -= 10
+    assert source.consume(10, timeout=0.05) == [second]
+    with pytest.raises(SourceExhausted):
+        source.consume(10, timeout=0.05)
+
+
+def test_consume_without_realtime_ignores_recorded_pace():
+    messages = make_messages(1665666000000, 1665666010000)
+    source = OfflineSource(messages)
+
+    assert source.consume(10, timeout=0.05) == messages
+    with pytest.raises(SourceExhausted):
+        source.consume(10)
@@ -0,0 +1,41 @@
+from utils.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_render_describes_each_metric_once_in_prometheus_format():
+    registry = Registry()
+    for metric in (
+        Counter("test_errors", "Errors seen", {"error_type": "KeyError"}),
+        Counter("test_errors", "Errors seen", {"error_type": 'Bad "quote"'}),
+        Gauge("test_lag", "Consumer lag", function=lambda: 7),
+        Histogram("test_seconds", "Seconds taken", (0.1, 1)),
+    ):
+        registry.register(metric)
+    metric.observe(0.5)
+    metric.observe(2)
+
+    assert registry.render() == (
+        "# HELP test_errors Errors seen\n"
+        "# TYPE test_errors counter\n"
+        'test_errors_total{error_type="Bad \\"quote\\""} 0\n'
+        'test_errors_total{error_type="KeyError"} 0\n'
+        "# HELP test_lag Consumer lag\n"
+        "# TYPE test_lag gauge\n"
+        "test_lag 7\n"
+        "# HELP test_seconds Seconds taken\n"
+        "# TYPE test_seconds histogram\n"
+        'test_seconds_bucket{le="0.1"} 0\n'
+        'test_seconds_bucket{le="1"} 1\n'
+        'test_seconds_bucket{le="+Inf"} 2\n'
+        "test_seconds_sum 2.5\n"
+        "test_seconds_count 2\n"
+    )
+
+
+def test_metric_replaces_one_with_the_same_name_and_labels():
+    registry = Registry()
+    registry.register(Counter("test_restarts", "Restarts"))
+    restarts = Counter("test_restarts", "Restarts")
+    restarts.inc(3)
+    registry.register(restarts)
+
+    assert registry.render().splitlines()[2:] == ["test_restarts_total 3"]
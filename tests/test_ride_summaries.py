@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+from utils.ride_summaries import mean_by_user, overall_mean
+
+SUMMARIES = pd.DataFrame(
+    {
+        "user_id": [1, 1, 2],
+        "heart_rate_count": [1, 3, 0],
+        "heart_rate_sum": [100, 360, 0],
+    }
+)
+
+
+def test_mean_by_user_weights_rides_by_their_readings():
+    means = mean_by_user(SUMMARIES, "heart_rate")
+
+    assert means["user_id"].tolist() == [1, 2]
+    assert means["heart_rate"][0] == 115
+    assert np.isnan(means["heart_rate"][1])
+
+
+def test_overall_mean_of_rides_without_readings_is_nan():
+    assert overall_mean(SUMMARIES, "heart_rate") == 115
+    assert np.isnan(overall_mean(SUMMARIES[SUMMARIES["user_id"] == 2], "heart_rate"))
@@ -0,0 +1,76 @@
+from typing import NamedTuple
+
+import pytest
+
+import utils.staging_writer
+from utils.staging_writer import StagingWriter
+
+
+class Row(NamedTuple):
+    user_id: int
+    name: str
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Rows each dry run flush would have copied, one list per table per flush"""
+    written = []
+    monkeypatch.setattr(
+        utils.staging_writer, "rows_to_csv", lambda rows: written.append(list(rows))
+    )
+    return written
+
+
+def test_flushes_once_max_rows_are_buffered(written):
+    writer = StagingWriter(None, "staging", max_rows=3, max_seconds=60, dry_run=True)
+
+    writer.add("USERS", [Row(1, "Ann"), Row(2, "Eve")])
+    assert written == []
+
+    writer.add("USERS", [Row(3, "Bob")])
+    assert written == [[Row(1, "Ann"), Row(2, "Eve"), Row(3, "Bob")]]
+
+
+def test_flushes_once_the_oldest_row_is_max_seconds_old(written, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(utils.staging_writer.time, "monotonic", lambda: now[0])
+    writer = StagingWriter(None, "staging", max_rows=100, max_seconds=5, dry_run=True)
+
+    writer.add("USERS", [Row(1, "Ann")])
+    now[0] += 4
+    assert not writer.flush_if_due()
+
+    now[0] += 1
+    assert writer.flush_if_due()
+    assert written == [[Row(1, "Ann")]]
+    assert not writer.flush_if_due()
+
+
+def test_offsets_are_handed_on_after_their_rows_and_kept_when_refused(written):
+    handed = []
+    refuse = [True]
+
+    def on_flush(offsets):
+        handed.append((len(written), offsets))
+        return not refuse[0]
+
+    writer = StagingWriter(None, "staging", max_rows=1, on_flush=on_flush, dry_run=True)
+    writer.add_batch({"USERS": [Row(1, "Ann")]}, {("rides", 0): 11})
+    refuse[0] = False
+    writer.add_batch({"USERS": [Row(2, "Eve")]}, {("rides", 1): 5})
+
+    assert handed == [
+        (1, {("rides", 0): 11}),
+        (2, {("rides", 0): 11, ("rides", 1): 5}),
+    ]
+
+
+def test_dry_run_upserts_only_the_last_row_for_each_key(written):
+    writer = StagingWriter(
+        None, "staging", dry_run=True, upsert_keys={"USERS": ("user_id",)}
+    )
+    writer.add("USERS", [Row(1, "Ann"), Row(2, "Eve"), Row(1, "Anne")])
+    writer.add("RIDES", [Row(1, "Ann"), Row(1, "Ann")])
+    writer.flush()
+
+    assert written == [[Row(1, "Anne"), Row(2, "Eve")], [Row(1, "Ann"), Row(1, "Ann")]]
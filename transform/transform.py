@@ -1,102 +1,340 @@
-import math
+import argparse
 import os
-from datetime import datetime as dt
-from typing import Union
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta, timezone
+from typing import NamedTuple
 
-import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-
+from sqlalchemy import text
+
+from utils.age_utils import ages_from_dob
+from utils.db import get_engine
+from utils.production_table import (
+    PRODUCTION_COLUMNS,
+    apply_production_dtypes,
+    copy_frame,
+    create_production_indexes,
+    create_production_table,
+    detach_partitions_before,
+    ensure_partitions,
+    ensure_production_table,
+    load_table_name,
+    partition_days,
+    swap_production_table,
+)
+from utils.snapshot import current_snapshot, snapshot_watermark, write_snapshot
 
 load_dotenv()
 
-user = os.environ["DB_USER"]
-password = os.environ["DB_PASSWORD"]
-hostname = os.environ["DB_HOST"]
-db_name = os.environ["DB_NAME"]
-port = os.environ["DB_PORT"]
 staging_schema = os.environ["STAGING_SCHEMA"]
 production_schema = os.environ["PRODUCTION_SCHEMA"]
+transform_mode = os.environ.get("TRANSFORM_MODE", "incremental")
+chunk_rows = int(os.environ.get("TRANSFORM_CHUNK_ROWS", 50000))
+transform_engine = os.environ.get("TRANSFORM_ENGINE", "pandas")
+retention_days = int(os.environ.get("TRANSFORM_RETENTION_DAYS", 0))
+transform_workers = int(os.environ.get("TRANSFORM_WORKERS", 1))
+snapshot_path = os.environ.get("SNAPSHOT_PATH")
+snapshot_versions = int(os.environ.get("SNAPSHOT_VERSIONS", 3))
+
+PRODUCTION_TABLE = "EZ_PRODUCTION_TABLE"
+WATERMARK_TABLE = "TRANSFORM_WATERMARK"
+
+AGE_SQL = (
+    r"CASE WHEN u.dob::text ~ '^-?[0-9]+(\.[0-9]+)?$' THEN "
+    "floor(floor((extract(epoch FROM now()) * 1000 - u.dob::text::double precision)"
+    " / 86400000) / 365)::smallint END"
+)
+PRODUCTION_SELECT = {
+    "user_id": "u.user_id",
+    "first_name": "u.first_name::text",
+    "last_name": "u.last_name::text",
+    "gender": "u.gender::text",
+    "age": AGE_SQL,
+    "height": "u.height",
+    "weight": "u.weight",
+    "email": "u.email",
+    "ride_id": "r.ride_id",
+    "time_elapsed": "r.duration",
+    "resistance": "NULLIF(r.resistance, 0)",
+    "heart_rate": "NULLIF(r.heart_rate, 0)",
+    "rotations_pm": "NULLIF(r.rotations_pm, 0)",
+    "power": "NULLIF(r.power, 0)",
+    "time": 'r."time"',
+}
+
+
+class Watermark(NamedTuple):
+    """How far the transform has got through RIDES: every row staged by a
+    transaction with an id below `staged_txid` has been transformed.
+
+    Watermarks saved before RIDES recorded the transaction that staged each
+    row only have the event time and ride id of the last row transformed.
+    """
 
+    staged_txid: int = None
+    event_time: datetime = None
+    ride_id: int = None
 
-def read_table_from_schema(table_name: str, schema_name: str) -> pd.DataFrame:
-    """Connects to aurora and reads the sql table in a given schema, returns pandas df
+
+def ensure_watermark_table(conn):
+    """Creates the table holding the transform's high-water mark if it doesn't
+    exist, and adds staged_txid to one from before it was recorded
 
     Args:
-        table_name (str): the sql table name to be accessed
-        schema (str): the schema where the table lies
+        conn (sqlalchemy.engine.Connection): connection to aurora
+    """
+    table = f'"{production_schema}"."{WATERMARK_TABLE}"'
+    conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                table_name TEXT PRIMARY KEY,
+                staged_txid BIGINT,
+                event_time TIMESTAMPTZ,
+                ride_id BIGINT,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """))
+
+    has_staged_txid = conn.execute(
+        text("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = :schema AND table_name = :table_name
+                AND column_name = 'staged_txid'
+            """),
+        {"schema": production_schema, "table_name": WATERMARK_TABLE},
+    ).first()
+    if not has_staged_txid:
+        conn.execute(
+            text(
+                f"ALTER TABLE {table} ADD COLUMN staged_txid BIGINT, "
+                "ALTER COLUMN event_time DROP NOT NULL, "
+                "ALTER COLUMN ride_id DROP NOT NULL"
+            )
+        )
+
+
+def lock_watermark(conn, table_name: str) -> Watermark:
+    """Takes the transaction level advisory lock on a table's watermark, so
+    overlapping runs wait for each other rather than transforming the same
+    rows twice, then reads the watermark
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform
+                                             transaction, which saves the new
+                                             watermark before the lock is released
+        table_name (str): production table name
 
     Returns:
-        pd.DataFrame: DataFrame containing information from table
+        Watermark: the watermark, None if the table has never been transformed
     """
+    conn.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(:lock_name))"),
+        {"lock_name": f"{WATERMARK_TABLE}.{table_name}"},
+    )
+    ensure_watermark_table(conn)
+    row = conn.execute(
+        text(
+            "SELECT staged_txid, event_time, ride_id "
+            f'FROM "{production_schema}"."{WATERMARK_TABLE}" '
+            "WHERE table_name = :table_name"
+        ),
+        {"table_name": table_name},
+    ).first()
+
+    return Watermark(*row) if row else None
+
+
+def save_watermark(conn, table_name: str, watermark: Watermark):
+    """Moves a table's high-water mark on, in the transaction that wrote the rows it covers
 
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
+    Args:
+        conn (sqlalchemy.engine.Connection): connection the rows were written on
+        table_name (str): production table name
+        watermark (Watermark): watermark covering the rows written
+    """
+    conn.execute(
+        text(f"""
+            INSERT INTO "{production_schema}"."{WATERMARK_TABLE}"
+                (table_name, staged_txid, updated_at)
+            VALUES (:table_name, :staged_txid, now())
+            ON CONFLICT (table_name) DO UPDATE SET
+                staged_txid = EXCLUDED.staged_txid,
+                event_time = NULL,
+                ride_id = NULL,
+                updated_at = EXCLUDED.updated_at
+            """),
+        {"table_name": table_name, "staged_txid": watermark.staged_txid},
     )
 
-    with engine.connect() as conn:
-        df = pd.read_sql_table(table_name, conn, schema=schema_name)
 
-    return df
+def retention_cutoff():
+    """Finds the first UTC day kept in the production table
+
+    Returns:
+        date: first day kept, None when TRANSFORM_RETENTION_DAYS is unset
+    """
+    if not retention_days:
+        return None
+    return datetime.now(timezone.utc).date() - timedelta(days=retention_days - 1)
+
+
+def new_rides_filter(watermark: Watermark = None) -> tuple:
+    """Builds the WHERE clause selecting the RIDES rows to transform: those
+    staged since the watermark, and with TRANSFORM_RETENTION_DAYS set, no older
+    than the retention cutoff
+
+    Args:
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+
+    Returns:
+        tuple: SQL condition on RIDES columns and its parameters
+    """
+    conditions = []
+    params = {}
+    if watermark is not None and watermark.staged_txid is not None:
+        conditions.append("staged_txid >= :staged_txid")
+        params["staged_txid"] = watermark.staged_txid
+    elif watermark is not None:
+        conditions.append('("time", ride_id) > (:event_time, :ride_id)')
+        params.update(event_time=watermark.event_time, ride_id=watermark.ride_id)
+
+    cutoff = retention_cutoff()
+    if cutoff is not None:
+        conditions.append('"time" >= :retain_from')
+        params["retain_from"] = datetime.combine(cutoff, time(), timezone.utc)
+    return " AND ".join(conditions) or "TRUE", params
+
+
+def new_rides_between(
+    watermark: Watermark, new_watermark: Watermark = None, shard: tuple = None
+) -> tuple:
+    """Builds the WHERE clause selecting the RIDES rows to transform up to
+    `new_watermark`, optionally only those of one shard of rides
 
+    Args:
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+        new_watermark (Watermark): watermark the rows are transformed up to,
+                                   None for no upper bound
+        shard (tuple): first and end ride_id of a shard of rides, the end
+                       not included
 
-def get_users_rides_data() -> tuple:
-    """Creates DataFrames from the 3 tables in aurora
+    Returns:
+        tuple: SQL condition on RIDES columns and its parameters
+    """
+    condition, params = new_rides_filter(watermark)
+    if new_watermark is not None:
+        condition += " AND staged_txid < :new_staged_txid"
+        params["new_staged_txid"] = new_watermark.staged_txid
+    if shard is not None:
+        condition += " AND ride_id >= :shard_start AND ride_id < :shard_end"
+        params.update(shard_start=shard[0], shard_end=shard[1])
+    return condition, params
+
+
+def get_users_user_rides_data(
+    watermark: Watermark = None, new_watermark: Watermark = None, shard: tuple = None
+) -> tuple:
+    """Reads the users and user rides belonging to the RIDES rows to transform,
+    which are small next to RIDES itself
+
+    Args:
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+        new_watermark (Watermark): watermark to transform the rows up to,
+                                   None for no upper bound
+        shard (tuple): first and end ride_id of a shard, None for every ride
 
     Returns:
-        tuple: 3 Panda df's, one for user data, one for ride data and one for user ride data
+        tuple: 2 Panda df's, one for user data and one for user ride data
     """
+    condition, params = new_rides_between(watermark, new_watermark, shard)
+    new_ride_ids = f'SELECT ride_id FROM "{staging_schema}"."RIDES" WHERE {condition}'
+
+    with get_engine().connect() as conn:
+        user_rides_df = pd.read_sql_query(
+            text(
+                f'SELECT * FROM "{staging_schema}"."USER_RIDES" '
+                f"WHERE ride_id IN ({new_ride_ids})"
+            ),
+            conn,
+            params=params,
+        )
+        users_df = pd.read_sql_query(
+            text(
+                f'SELECT * FROM "{staging_schema}"."USERS" '
+                "WHERE user_id = ANY(:user_ids)"
+            ),
+            conn,
+            params={
+                "user_ids": [
+                    int(user_id) for user_id in user_rides_df["user_id"].unique()
+                ]
+            },
+        )
 
-    users_df = read_table_from_schema("USERS", staging_schema)
+    return users_df, user_rides_df
 
-    rides_df = read_table_from_schema("RIDES", staging_schema)
 
-    user_rides_df = read_table_from_schema("USER_RIDES", staging_schema)
+def read_rides_chunks(
+    conn,
+    watermark: Watermark = None,
+    chunksize: int = 50000,
+    new_watermark: Watermark = None,
+    shard: tuple = None,
+):
+    """Streams the RIDES rows to transform through a server-side cursor
 
-    return users_df, rides_df, user_rides_df
+    Args:
+        conn (sqlalchemy.engine.Connection): connection to read on, kept open while iterating
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+        chunksize (int): rows per chunk
+        new_watermark (Watermark): watermark to transform the rows up to,
+                                   None for no upper bound
+        shard (tuple): first and end ride_id of a shard, None for every ride
+
+    Returns:
+        Iterator[pd.DataFrame]: chunks of RIDES rows
+    """
+    condition, params = new_rides_between(watermark, new_watermark, shard)
+    return pd.read_sql_query(
+        text(f'SELECT * FROM "{staging_schema}"."RIDES" WHERE {condition}'),
+        conn.execution_options(stream_results=True),
+        params=params,
+        chunksize=chunksize,
+    )
 
 
-def merge_dataframes(
-    users_df: pd.DataFrame, rides_df: pd.DataFrame, junction_df: pd.DataFrame
+def join_users_user_rides(
+    users_df: pd.DataFrame, junction_df: pd.DataFrame
 ) -> pd.DataFrame:
-    """Takes 3 dataframes and merges them into and returns it
+    """Attaches each user's details to their ride ids, to be joined with RIDES chunks
 
     Args:
         users_df (pd.Dataframe): df with data of user
-        rides_df (pd.Dataframe): df with data from individual rides
         junction_df (pd.Dataframe): df with data of user id attached with ride id
 
     Returns:
-        joined df (pd.Dataframe): columns time, user_id, first_name, last_name, gender, age, height,
-        weight, ride_id, duration, resistance, heart_rate, rotations_pm
+        pd.DataFrame: user details with a row per ride
     """
+    return users_df.merge(junction_df)
 
-    users_df = users_df.drop_duplicates()
-    users_df_with_ride_id = users_df.merge(junction_df)
-    joined_df = users_df_with_ride_id.merge(rides_df)
-
-    return joined_df
 
-
-def convert_dob_to_age(dob: str) -> Union[None, int]:
-    """Takes the dob in ms, and converts to age in years
+def clean_chunk(joined_df: pd.DataFrame) -> pd.DataFrame:
+    """Applies every cleaning step to a chunk of joined rows
 
     Args:
-        dob (int): ms from 01/01/1970
+        joined_df (pd.DataFrame): users joined with their rides
 
     Returns:
-        age in years (int): age in years
+        pd.DataFrame: rows ready for the production table
     """
-
-    if not math.isnan(float(dob)):
-        dob = int(dob)
-        epoch_in_seconds = dob / 1000
-        formatted_dob = dt.fromtimestamp(epoch_in_seconds)
-        epoch_age = dt.now() - formatted_dob
-        age = math.floor(epoch_age.days / 365)
-        return age
-    return dob
+    joined_df["dob"] = ages_from_dob(joined_df["dob"])
+    joined_df = rename_age_duration(joined_df)
+    joined_df = apply_production_dtypes(joined_df)
+    return joined_df[list(PRODUCTION_COLUMNS)]
 
 
 def rename_age_duration(df: pd.DataFrame) -> pd.DataFrame:
@@ -113,77 +351,436 @@ def rename_age_duration(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def change_dtypes(df: pd.DataFrame) -> pd.DataFrame:
-    """Changes column type of joined df to be of type string
+def next_watermark(conn, watermark: Watermark = None) -> Watermark:
+    """Finds the watermark to transform the new RIDES rows up to: the oldest
+    transaction still in progress, as every row staged by an earlier one has
+    been committed, however late it arrived, and can be read
 
     Args:
-        df (pd.Dataframe): joined df with all data
+        conn (sqlalchemy.engine.Connection): connection to aurora
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
 
     Returns:
-        df (pd.Dataframe): df with some columns retyped
+        Watermark: new watermark, None if there are no new rows below it
     """
+    new_watermark = Watermark(
+        conn.execute(
+            text("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        ).scalar()
+    )
+    condition, params = new_rides_between(watermark, new_watermark)
+    has_new_rows = conn.execute(
+        text(
+            f'SELECT EXISTS (SELECT 1 FROM "{staging_schema}"."RIDES" '
+            f"WHERE {condition})"
+        ),
+        params,
+    ).scalar()
+    return new_watermark if has_new_rows else None
 
-    for col in [
-        "first_name",
-        "last_name",
-        "gender",
-        "heart_rate",
-        "resistance",
-        "rotations_pm",
-        "power",
-    ]:
-        df[col] = df[col].astype("string")
 
-    return df
+def new_ride_days(conn, watermark: Watermark, new_watermark: Watermark) -> list:
+    """Finds the UTC days of the RIDES rows between two watermarks
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection to aurora
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+        new_watermark (Watermark): watermark to transform the rows up to
+
+    Returns:
+        list: distinct days, as dates
+    """
+    condition, params = new_rides_between(watermark, new_watermark)
+    return list(
+        conn.execute(
+            text(
+                """SELECT DISTINCT ("time" AT TIME ZONE 'UTC')::date """
+                f'FROM "{staging_schema}"."RIDES" WHERE {condition}'
+            ),
+            params,
+        ).scalars()
+    )
+
+
+def production_select(watermark: Watermark, new_watermark: Watermark) -> tuple:
+    """Builds the SELECT that joins the RIDES rows between two watermarks with
+    their users and applies the same cleaning as `clean_chunk`: dob to age,
+    zero readings to NULL and renamed columns
 
+    Args:
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+        new_watermark (Watermark): watermark to transform the rows up to
 
-def replace_zeroes_with_nulls(df: pd.DataFrame) -> pd.DataFrame:
-    """Checks specified columns to for 0 values and replaces with null
+    Returns:
+        tuple: SQL query and its parameters
+    """
+    condition, params = new_rides_between(watermark, new_watermark)
+    columns = ", ".join(
+        f'{expression} AS "{column}"'
+        for column, expression in PRODUCTION_SELECT.items()
+    )
+    query = f"""
+        SELECT {columns}
+        FROM (
+            SELECT * FROM "{staging_schema}"."RIDES" WHERE {condition}
+        ) AS r
+        JOIN (
+            SELECT DISTINCT user_id, ride_id FROM "{staging_schema}"."USER_RIDES"
+        ) AS ur ON ur.ride_id = r.ride_id
+        JOIN "{staging_schema}"."USERS" AS u ON u.user_id = ur.user_id
+        """
+    return query, params
+
+
+def transform_in_sql(conn, watermark: Watermark = None) -> Watermark:
+    """Joins, cleans and writes the new RIDES rows to the production table in
+    one INSERT ... SELECT, so no rows leave aurora. A run without a watermark
+    fills a load table that is then swapped in.
 
     Args:
-        df (pd.Dataframe): joined df
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        watermark (Watermark): watermark of the rows already transformed,
+                               None to rebuild the table
 
     Returns:
-        df (pd.Dataframe): df with 0's replaced
+        Watermark: watermark of the rows written, None if there were no new
+                   rows to transform
     """
+    new_watermark = next_watermark(conn, watermark)
+    if new_watermark is None:
+        return None
+
+    query, params = production_select(watermark, new_watermark)
+    table_name = prepare_production_table(conn, rebuild=watermark is None)
+
+    ensure_partitions(
+        conn,
+        production_schema,
+        table_name,
+        new_ride_days(conn, watermark, new_watermark),
+    )
 
-    columns_to_change = ["heart_rate", "resistance", "rotations_pm", "power"]
-    for column in columns_to_change:
-        df[column] = np.where(df[column] == "0", np.nan, df[column])
-        df[column] = np.where(df[column] == "0.0", np.nan, df[column])
+    columns = ", ".join(f'"{column}"' for column in PRODUCTION_SELECT)
+    conn.execute(
+        text(f'INSERT INTO "{production_schema}"."{table_name}" ({columns}) {query}'),
+        params,
+    )
 
-    return df
+    finish_production_write(conn, new_watermark, rebuild=watermark is None)
+    return new_watermark
 
 
-def write_df_to_sql_production(df: pd.DataFrame, table_name: str):
-    """Save the pandas dataframe to tables in production schema,
-        appends to table if the table exists already
+def prepare_production_table(conn, rebuild: bool) -> str:
+    """Creates an empty load table for a full run, or brings the types of the
+    existing production table up to date before rows are appended to it
 
     Args:
-        df (pd.Dataframe): df that needs to be push to production
-        table_name (str): name of the table in the schema
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        rebuild (bool): whether the table is being rebuilt from every row
+
+    Returns:
+        str: name of the table to write the rows to
     """
+    if rebuild:
+        table_name = load_table_name(PRODUCTION_TABLE)
+        create_production_table(conn, production_schema, table_name)
+        return table_name
 
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
-    )
-    with engine.connect() as conn:
-        df.to_sql(
-            table_name, conn, schema=production_schema, if_exists="replace", index=False
+    ensure_production_table(conn, production_schema, PRODUCTION_TABLE)
+    return PRODUCTION_TABLE
+
+
+def finish_production_write(conn, watermark: Watermark, rebuild: bool):
+    """Swaps a rebuilt table in, or makes sure an appended one is indexed, and
+    moves the watermark on in the same transaction. With
+    TRANSFORM_RETENTION_DAYS set, the partitions of older days are detached.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection the rows were written on
+        watermark (Watermark): watermark of the rows written
+        rebuild (bool): whether the rows were written to the load table
+    """
+    if rebuild:
+        swap_production_table(conn, production_schema, PRODUCTION_TABLE)
+    else:
+        create_production_indexes(conn, production_schema, PRODUCTION_TABLE)
+    save_watermark(conn, PRODUCTION_TABLE, watermark)
+
+    cutoff = retention_cutoff()
+    if cutoff is not None:
+        detached = detach_partitions_before(
+            conn, production_schema, PRODUCTION_TABLE, cutoff
         )
+        if detached:
+            print(f"Detached partitions {', '.join(detached)}")
 
-        print("Dataframe transformed")
+    print("Dataframe transformed")
 
 
-def handler(event, context):
-    users_df, rides_df, junction_df = get_users_rides_data()
-    joined_df = merge_dataframes(users_df, rides_df, junction_df)
+def ride_id_shards(
+    conn, watermark: Watermark, new_watermark: Watermark, shards: int
+) -> list:
+    """Splits the ride_ids of the RIDES rows between two watermarks into
+    contiguous ranges, so each shard reads its rows through the ride_id index
 
-    joined_df["dob"] = joined_df["dob"].apply(lambda x: convert_dob_to_age(x))
-    joined_df = rename_age_duration(joined_df)
-    joined_df = change_dtypes(joined_df)
-    joined_df = replace_zeroes_with_nulls(joined_df)
+    Args:
+        conn (sqlalchemy.engine.Connection): connection to aurora
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+        new_watermark (Watermark): watermark to transform the rows up to
+        shards (int): most ranges to split the ride_ids into
+
+    Returns:
+        list: first and end ride_id of each range, the end not included
+    """
+    condition, params = new_rides_between(watermark, new_watermark)
+    first, last = conn.execute(
+        text(
+            "SELECT min(ride_id), max(ride_id) "
+            f'FROM "{staging_schema}"."RIDES" WHERE {condition}'
+        ),
+        params,
+    ).one()
+    if first is None:
+        return []
+
+    size = -(-(last - first + 1) // shards)
+    return [
+        (start, min(start + size, last + 1)) for start in range(first, last + 1, size)
+    ]
+
+
+def transform_shard(
+    shard: tuple, watermark: Watermark, new_watermark: Watermark, table_name: str
+) -> int:
+    """Transforms one shard of the new rides in a worker process, through the
+    worker's own connections, into a table whose partitions already exist
+
+    Args:
+        shard (tuple): first and end ride_id of the shard, the end not included
+        watermark (Watermark): watermark of the rows already transformed,
+                               None for every row
+        new_watermark (Watermark): watermark to transform the rows up to
+        table_name (str): table in the production schema to write the rows to
+
+    Returns:
+        int: rows written
+    """
+    users_df, junction_df = get_users_user_rides_data(watermark, new_watermark, shard)
+    users_with_rides_df = join_users_user_rides(users_df, junction_df)
+
+    rows = 0
+    with get_engine().connect() as read_conn, get_engine().begin() as write_conn:
+        for rides_df in read_rides_chunks(
+            read_conn, watermark, chunk_rows, new_watermark, shard
+        ):
+            joined_df = clean_chunk(users_with_rides_df.merge(rides_df))
+            copy_frame(write_conn, production_schema, table_name, joined_df)
+            rows += len(joined_df)
+    return rows
+
+
+def transform_in_parallel(conn, watermark: Watermark, workers: int) -> Watermark:
+    """Splits the new rides into `workers` ranges of ride_id and transforms them
+    in a pool of processes, for backfilling on a machine with many cores.
+
+    Each worker commits its own shard, so the workers write to a separate
+    partitioned table. A full run then swaps that table in. An incremental run
+    copies it into the production table inside aurora. Either way this happens
+    in the transform transaction, with the watermark, so a failed worker leaves
+    the production table as it was.
 
-    write_df_to_sql_production(joined_df, "EZ_PRODUCTION_TABLE")
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        watermark (Watermark): watermark of the rows already transformed,
+                               None to rebuild the table
+        workers (int): number of worker processes
+
+    Returns:
+        Watermark: watermark of the rows written, None if there were no new
+                   rows to transform
+    """
+    rebuild = watermark is None
+    if rebuild:
+        table_name = load_table_name(PRODUCTION_TABLE)
+    else:
+        table_name = f"{PRODUCTION_TABLE}_increment"
+
+    new_watermark = next_watermark(conn, watermark)
+    if new_watermark is None:
+        return None
+    days = new_ride_days(conn, watermark, new_watermark)
+    shards = ride_id_shards(conn, watermark, new_watermark, workers)
+
+    with get_engine().begin() as setup_conn:
+        create_production_table(setup_conn, production_schema, table_name)
+        ensure_partitions(setup_conn, production_schema, table_name, days)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        shard_rows = pool.map(
+            transform_shard,
+            shards,
+            [watermark] * len(shards),
+            [new_watermark] * len(shards),
+            [table_name] * len(shards),
+        )
+        print(f"Transformed {sum(shard_rows)} rows in {len(shards)} shards")
+
+    if not rebuild:
+        ensure_production_table(conn, production_schema, PRODUCTION_TABLE)
+        ensure_partitions(conn, production_schema, PRODUCTION_TABLE, days)
+        columns = ", ".join(f'"{column}"' for column in PRODUCTION_COLUMNS)
+        conn.execute(
+            text(
+                f'INSERT INTO "{production_schema}"."{PRODUCTION_TABLE}" '
+                f"({columns}) SELECT {columns} "
+                f'FROM "{production_schema}"."{table_name}"'
+            )
+        )
+        conn.execute(text(f'DROP TABLE "{production_schema}"."{table_name}"'))
+    finish_production_write(conn, new_watermark, rebuild)
+
+    return new_watermark
+
+
+def refresh_snapshot(watermark: Watermark, rebuild: bool):
+    """Writes a new version of the Parquet snapshot of the production table to
+    SNAPSHOT_PATH, if it is set, once the transform has committed. Only the
+    days of the RIDES rows staged since the current version are exported again.
+
+    Args:
+        watermark (Watermark): watermark of the rows written
+        rebuild (bool): whether the table was rebuilt, so every day is exported
+    """
+    if not snapshot_path:
+        return
+
+    changed_days = None
+    previous = current_snapshot(snapshot_path)
+    since = snapshot_watermark(previous) if previous and not rebuild else None
+    if since is not None:
+        with get_engine().connect() as conn:
+            changed_days = new_ride_days(conn, Watermark(since), watermark)
+
+    version_path = write_snapshot(
+        get_engine(),
+        production_schema,
+        PRODUCTION_TABLE,
+        snapshot_path,
+        watermark.staged_txid,
+        changed_days,
+        chunk_rows=chunk_rows,
+        keep_versions=snapshot_versions,
+    )
+    print(f"Wrote snapshot {version_path}")
 
+
+def transform_in_pandas(conn, watermark: Watermark = None) -> Watermark:
+    """Streams the new RIDES rows in TRANSFORM_CHUNK_ROWS chunks, joining each
+    with the users, cleaning it and writing it through COPY in the transform
+    transaction. The new watermark is found first, so the users and the rides
+    are read for exactly the same rows.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        watermark (Watermark): watermark of the rows already transformed,
+                               None to rebuild the table
+
+    Returns:
+        Watermark: watermark of the rows written, None if there were no new
+                   rows to transform
+    """
+    new_watermark = next_watermark(conn, watermark)
+    if new_watermark is None:
+        return None
+
+    users_df, junction_df = get_users_user_rides_data(watermark, new_watermark)
+    users_with_rides_df = join_users_user_rides(users_df, junction_df)
+
+    rebuild = watermark is None
+    table_name = prepare_production_table(conn, rebuild)
+    with get_engine().connect() as read_conn:
+        for rides_df in read_rides_chunks(
+            read_conn, watermark, chunk_rows, new_watermark
+        ):
+            joined_df = clean_chunk(users_with_rides_df.merge(rides_df))
+            ensure_partitions(
+                conn,
+                production_schema,
+                table_name,
+                partition_days(joined_df["time"]),
+            )
+            copy_frame(conn, production_schema, table_name, joined_df)
+
+    finish_production_write(conn, new_watermark, rebuild)
+    return new_watermark
+
+
+def handler(event, context):
+    """Transforms staging into the production table. Incremental runs append the
+    RIDES rows staged since the watermark; a full run, {"mode": "full"} or
+    TRANSFORM_MODE=full, rebuilds the table from every row. The watermark
+    follows the transactions that staged the rows rather than their event
+    time, so rows that reach staging late are picked up by the next run. Runs
+    hold an advisory lock on the watermark until they commit, so overlapping
+    runs wait for each other instead of appending the same rows twice.
+
+    RIDES is streamed in TRANSFORM_CHUNK_ROWS chunks, each joined with the
+    users, cleaned and written before the next is read, so memory depends on
+    the chunk size rather than the size of the table. Every chunk is written
+    through COPY in one transaction, which also moves the watermark on. A full
+    run loads a separate table and renames it over the old one at the end, so
+    readers never see the table empty or half written.
+
+    The production table is partitioned by day on time, so an incremental run
+    only writes to the partitions of the days it has rows for and the time
+    window queries of the dashboard and report only scan a day or two.
+    TRANSFORM_RETENTION_DAYS detaches the partitions of older days.
+
+    With {"engine": "sql"} or TRANSFORM_ENGINE=sql the join and cleaning run
+    inside aurora as a single INSERT ... SELECT instead of in pandas. With
+    {"workers": N} or TRANSFORM_WORKERS=N the pandas transform is split by
+    ride_id across N processes.
+
+    With SNAPSHOT_PATH set, a Parquet snapshot of the table is written there
+    after each run, for the readers to load instead of querying aurora.
+    """
+    event = event or {}
+    mode = event.get("mode", transform_mode)
+    workers = int(event.get("workers", transform_workers))
+
+    with get_engine().begin() as conn:
+        watermark = lock_watermark(conn, PRODUCTION_TABLE)
+        if mode == "full":
+            watermark = None
+        rebuild = watermark is None
+
+        if event.get("engine", transform_engine) == "sql":
+            new_watermark = transform_in_sql(conn, watermark)
+        elif workers > 1:
+            new_watermark = transform_in_parallel(conn, watermark, workers)
+        else:
+            new_watermark = transform_in_pandas(conn, watermark)
+
+    if new_watermark is None:
+        return "No new rides to transform"
+    refresh_snapshot(new_watermark, rebuild)
     return "Wrote clean data to production schema"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Transform staging into the production table, for backfills"
+    )
+    parser.add_argument("--mode", choices=["incremental", "full"], default=None)
+    parser.add_argument("--engine", choices=["pandas", "sql"], default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    options = {
+        option: value for option, value in vars(args).items() if value is not None
+    }
+    print(handler(options, None))
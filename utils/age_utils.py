@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+MS_PER_DAY = 86_400_000
+
+
+def ages_from_dob(dob, now: datetime = None) -> np.ndarray:
+    """Converts dates of birth in ms since 01/01/1970 to ages in whole years,
+       a year being 365 days, for a whole column at once
+
+    Args:
+        dob (Iterable): dates of birth in ms, as numbers or numeric strings,
+                        missing or unreadable values give NaN
+        now (datetime): time to measure ages at, the same for every row,
+                        defaults to the current time
+
+    Returns:
+        np.ndarray: ages as floats, NaN where the date of birth is missing
+    """
+    dob = pd.Series(dob, copy=False)
+    try:
+        dob_ms = dob.astype("float64").to_numpy()
+    except (TypeError, ValueError):
+        dob_ms = pd.to_numeric(dob, errors="coerce").to_numpy(dtype="float64")
+    missing = np.isnan(dob_ms)
+
+    if now is None:
+        now = datetime.now(timezone.utc)
+    now_ms = np.datetime64(int(now.timestamp() * 1000), "ms")
+
+    births = np.where(missing, 0, dob_ms).astype("int64").astype("datetime64[ms]")
+    days = (now_ms - births) // np.timedelta64(1, "D")
+    ages = (days // 365).astype("float64")
+    ages[missing] = np.nan
+    return ages
+
+
+def age_from_dob(dob, now: datetime = None):
+    """Converts a single date of birth in ms since 01/01/1970 to an age in years
+
+    Args:
+        dob (Union[int, str]): date of birth in ms
+        now (datetime): time to measure the age at, defaults to the current time
+
+    Returns:
+        Union[int, None]: age in years, None if the date of birth is missing
+    """
+    age = ages_from_dob([dob], now)[0]
+    if np.isnan(age):
+        return None
+    return int(age)
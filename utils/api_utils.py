@@ -1,40 +1,72 @@
 import os
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
-import sqlalchemy
 from dotenv import load_dotenv
 
+from utils.db import get_engine
+from utils.production_table import apply_production_dtypes
+from utils.ride_summaries import mean_by_user, read_ride_summaries
+from utils.snapshot import read_snapshot
+
 load_dotenv()
 
-user = os.environ["DB_USER"]
-password = os.environ["DB_PASSWORD"]
-hostname = os.environ["DB_HOST"]
-db_name = os.environ["DB_NAME"]
-port = os.environ["DB_PORT"]
 production_schema = os.environ["PRODUCTION_SCHEMA"]
+staging_schema = os.environ["STAGING_SCHEMA"]
+snapshot_path = os.environ.get("SNAPSHOT_PATH")
 
 
-def read_sql_table(table_name: str) -> pd.DataFrame:
+def read_sql_table(table_name: str, schema: str = production_schema) -> pd.DataFrame:
     """Connects to aurora and read the sql table, converts to pandas df
 
     Args:
         table_name (str): table name as a string to put into the connection command
+        schema (str): schema the table is in, production by default
 
     Returns:
         dataframe (pd.dataframe): dataframe from aurora table
     """
 
-    engine = sqlalchemy.create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
-    )
-
-    with engine.connect() as conn:
-        df = pd.read_sql_table(table_name, conn, schema=production_schema)
+    with get_engine().connect() as conn:
+        df = pd.read_sql_table(table_name, conn, schema=schema)
 
     return df
 
 
+def read_production_table() -> pd.DataFrame:
+    """Reads the production table from the Parquet snapshot at SNAPSHOT_PATH if
+    one has been written, otherwise from aurora
+
+    Returns:
+        pd.DataFrame: production rows with their compact types
+    """
+    if snapshot_path:
+        df = read_snapshot(snapshot_path)
+        if df is not None:
+            return df
+
+    return apply_production_dtypes(read_sql_table("EZ_PRODUCTION_TABLE"))
+
+
+def json_value(value):
+    """Turns a value from the production DataFrame into one jsonify can
+    serialise, numpy scalars into plain python values and missing values into None
+
+    Args:
+        value (Any): value from a DataFrame row
+
+    Returns:
+        Any: python value, None if missing
+    """
+    if pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
 def get_single_row_for_rides(df: pd.DataFrame):
     """Gets unique rides by taking only rows with a duration of 1
 
@@ -44,11 +76,11 @@ def get_single_row_for_rides(df: pd.DataFrame):
     Returns:
         _type_: _description_
     """
-    df_unique_rides = df[(df["time_elapsed"] == "1.0")]
+    df_unique_rides = df[(df["time_elapsed"] == 1)]
     return df_unique_rides
 
 
-main_ride_df = read_sql_table("EZ_PRODUCTION_TABLE")
+main_ride_df = read_production_table()
 unique_ride_df = get_single_row_for_rides(main_ride_df)
 
 
@@ -78,7 +110,7 @@ def format_ride(ride_df: pd.DataFrame) -> dict:
     }
 
 
-def make_rides_list(ride_d: pd.DataFrame) -> list:
+def make_rides_list(ride_df: pd.DataFrame) -> list:
     """Create list of rides with the information wanted
 
     Args:
@@ -104,12 +136,12 @@ def ride_dict_creator(ride: pd.Series) -> dict:
         dict: dictionary format for one ride
     """
     return {
-        "id": ride["user_id"],
-        "ride_id": ride["ride_id"],
-        "first_name": ride["first_name"],
-        "last_name": ride["last_name"],
+        "id": json_value(ride["user_id"]),
+        "ride_id": json_value(ride["ride_id"]),
+        "first_name": json_value(ride["first_name"]),
+        "last_name": json_value(ride["last_name"]),
         "time": str(ride["time"]),
-        "age": ride["age"],
+        "age": json_value(ride["age"]),
     }
 
 
@@ -176,22 +208,28 @@ def get_riders() -> list:
     return list_of_riders
 
 
-def convert_HR_column(x: str) -> int:
-    """Takes a value in a pandas column, converts str to int
-
-    Args:
-        x (str): heart rate value
+@lru_cache(maxsize=None)
+def get_avg_heart_rates() -> pd.DataFrame:
+    """Average heart rate of each user across all their rides, from the ride
+    summaries when they're first needed, falling back to the production rows
+    until RIDE_SUMMARY exists
 
     Returns:
-        x (int): heart rate as an int
+        pd.DataFrame: user_id and heart_rate, NaN for users with no readings
     """
-    if isinstance(x, str):
-        return int(x)
-    return x
+    summaries = read_ride_summaries(get_engine(), staging_schema)
+    if summaries is None:
+        return (
+            main_ride_df.groupby("user_id", observed=True)["heart_rate"]
+            .mean()
+            .reset_index()
+        )
+
+    return mean_by_user(summaries, "heart_rate")
 
 
 def get_avg_heart_rate(id: int) -> int:
-    """Gets the average heart rate of user, filters df for 1 user, and return average heart rate
+    """Gets the average heart rate of user across all their rides
 
     Args:
         id (int): user id that you need a heart rate for
@@ -199,16 +237,12 @@ def get_avg_heart_rate(id: int) -> int:
     Returns:
         int: average heart rate
     """
-    df = main_ride_df
-    df_user = df.loc[df["user_id"] == int(id)]
-    df_hr = df_user.copy()
-    df_hr["heart_rate"] = df_hr["heart_rate"].apply(lambda x: convert_HR_column(x))
-
-    avg_hr = (
-        df_hr["heart_rate"].astype(float).agg({"heart_rate": "mean"}).round().values[0]
-    )
+    heart_rates = get_avg_heart_rates()
+    heart_rate = heart_rates.loc[heart_rates["user_id"] == int(id), "heart_rate"]
+    if heart_rate.empty or pd.isna(heart_rate.iloc[0]):
+        return np.nan
 
-    return avg_hr
+    return round(heart_rate.iloc[0])
 
 
 def rider_dict_creator(ride: pd.Series) -> dict:
@@ -221,13 +255,13 @@ def rider_dict_creator(ride: pd.Series) -> dict:
         dict: dict of rider information
     """
     return {
-        "id": ride["user_id"],
-        "avg_heart_rate": get_avg_heart_rate(ride["user_id"]),
-        "first_name": ride["first_name"],
-        "last_name": ride["last_name"],
+        "id": json_value(ride["user_id"]),
+        "avg_heart_rate": json_value(get_avg_heart_rate(ride["user_id"])),
+        "first_name": json_value(ride["first_name"]),
+        "last_name": json_value(ride["last_name"]),
         "time": str(ride["time"]),
-        "age": ride["age"],
-        "email": ride["email"],
+        "age": json_value(ride["age"]),
+        "email": json_value(ride["email"]),
     }
 
 
@@ -286,15 +320,18 @@ def get_rides_for_day(date: str) -> dict:
     """Take a date as a string and filters all rides for rides on that date, if no date defaults to today
 
     Args:
-        date (str): date you want to get rides for
+        date (str): date you want to get rides for, as DD/MM/YYYY or YYYY-MM-DD
 
     Returns:
         dict: number of rides, rides in a list
     """
     if date is None:
-        date = datetime.today().strftime("%d/%m/%Y")
+        date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     else:
-        date = str(date)
+        try:
+            date = datetime.strptime(str(date), "%d/%m/%Y").strftime("%Y-%m-%d")
+        except ValueError:
+            date = str(date)
 
     rides = ride_json
     list_of_dates = []
@@ -1,12 +1,15 @@
-import math
 import os
-from datetime import datetime as dt
+from functools import lru_cache
 
 import boto3
 import pandas as pd
 from dotenv import load_dotenv
 from botocore.exceptions import ClientError
-from sqlalchemy import create_engine
+from sqlalchemy import inspect, text
+from sqlalchemy.sql.elements import TextClause
+
+from utils.age_utils import age_from_dob
+from utils.db import get_engine
 
 load_dotenv()
 
@@ -14,7 +17,71 @@ load_dotenv()
 sender = os.environ["SENDER"]
 
 
-def create_row(
+def ensure_current_ride_table(staging_schema: str):
+    """Creates the 'CURRENT_RIDE' table, one row per bike, if it doesn't exist.
+
+    The table used to be dropped and recreated with a single row on every
+    reading; a table left over from then has no BIKE_ID column and is
+    replaced, as it only ever held the last reading.
+
+    Args:
+        staging_schema (str): Staging schema name
+    """
+    table = f'"{staging_schema}"."CURRENT_RIDE"'
+    with get_engine().begin() as conn:
+        inspector = inspect(conn)
+        if inspector.has_table("CURRENT_RIDE", schema=staging_schema):
+            columns = inspector.get_columns("CURRENT_RIDE", schema=staging_schema)
+            if "BIKE_ID" not in {column["name"] for column in columns}:
+                conn.execute(text(f"DROP TABLE {table}"))
+
+        conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    "BIKE_ID" TEXT PRIMARY KEY,
+                    "RIDE_ID" BIGINT NOT NULL,
+                    "NAME" TEXT,
+                    "GENDER" TEXT,
+                    "AGE" INTEGER,
+                    "DURATION" DOUBLE PRECISION,
+                    "HEART RATE" INTEGER,
+                    "EMAIL" TEXT,
+                    "UPDATED_AT" TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """))
+
+
+@lru_cache(maxsize=None)
+def current_ride_upsert(staging_schema: str) -> TextClause:
+    """Builds the upsert of one bike's row in 'CURRENT_RIDE', once per schema,
+    so sqlalchemy reuses the compiled statement and only the parameters change
+
+    Args:
+        staging_schema (str): Staging schema name
+
+    Returns:
+        TextClause: statement taking the keys of `current_ride_row` as parameters
+    """
+    return text(f"""
+        INSERT INTO "{staging_schema}"."CURRENT_RIDE"
+            ("BIKE_ID", "RIDE_ID", "NAME", "GENDER", "AGE", "DURATION",
+             "HEART RATE", "EMAIL", "UPDATED_AT")
+        VALUES
+            (:bike_id, :ride_id, :name, :gender, :age, :duration,
+             :heart_rate, :email, now())
+        ON CONFLICT ("BIKE_ID") DO UPDATE SET
+            "RIDE_ID" = EXCLUDED."RIDE_ID",
+            "NAME" = EXCLUDED."NAME",
+            "GENDER" = EXCLUDED."GENDER",
+            "AGE" = EXCLUDED."AGE",
+            "DURATION" = EXCLUDED."DURATION",
+            "HEART RATE" = EXCLUDED."HEART RATE",
+            "EMAIL" = EXCLUDED."EMAIL",
+            "UPDATED_AT" = EXCLUDED."UPDATED_AT"
+        """)
+
+
+def current_ride_row(
+    bike_id: str,
     ride_id: int,
     first_name: str,
     last_name: str,
@@ -23,16 +90,11 @@ def create_row(
     duration: int,
     HR: int,
     email: str,
-    user: str,
-    password: str,
-    hostname: str,
-    port: int,
-    db_name: str,
-    staging_schema: str,
-):
-    """Creates a row in the 'CURRENT_RIDE' table with the latest ride information.
+) -> dict:
+    """Builds the parameters of a bike's row in the 'CURRENT_RIDE' table.
 
     Args:
+        bike_id (str): Bike the ride is on
         ride_id (int) : Current ride id
         first_name (str): First name of rider
         last_name (str): Last name of rider
@@ -40,91 +102,53 @@ def create_row(
         dob (str): Date of birth of rider
         duration (int): Current ride duration
         HR (int): Current heart rate of rider
-        user (str): Database username
         email (str): Riders email
-        password (str): Database password
-        hostname (str): Database hostname
-        port (int): Database port
-        db_name (str): Database name
-        staging_schema (str): Staging schema name
+
+    Returns:
+        dict: parameters for `current_ride_upsert`
     """
-    age = convert_dob_to_age(dob)
-    full_name = f"{first_name} {last_name}"
-
-    df = pd.DataFrame(
-        {
-            "RIDE_ID": [ride_id],
-            "NAME": [full_name],
-            "GENDER": [gender],
-            "AGE": [age],
-            "DURATION": [duration],
-            "HEART RATE": [HR],
-            "EMAIL": [email],
-        }
-    )
-
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
-    )
-    with engine.connect() as conn:
-        df.to_sql(
-            "CURRENT_RIDE",
-            conn,
-            schema=staging_schema,
-            if_exists="replace",
-            index=False,
-        )
+    return {
+        "bike_id": bike_id,
+        "ride_id": ride_id,
+        "name": f"{first_name} {last_name}",
+        "gender": gender,
+        "age": age_from_dob(dob),
+        "duration": duration,
+        "heart_rate": HR,
+        "email": email,
+    }
 
 
-def get_new_df(
-    table_name: str,
-    user: str,
-    password: str,
-    hostname: str,
-    port: int,
-    db_name: str,
-    staging_schema: str,
-) -> pd.DataFrame:
-    """Obtains DataFrame from specified table.
+def create_rows(rows: list, staging_schema: str):
+    """Upserts the latest ride information of each bike into the 'CURRENT_RIDE' table.
 
     Args:
-        table_name (str): Table name in question
-        user (str): Database username
-        password (str): Database password
-        hostname (str): Database hostname
-        port (int): Database port
-        db_name (str): Database name
+        rows (list): dicts from `current_ride_row`, one per bike
         staging_schema (str): Staging schema name
-
-    Returns:
-        pd.DataFrame: Returns pandas dataframe
     """
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
-    )
-    with engine.connect() as conn:
-        df = pd.read_sql_table(table_name, conn, schema=staging_schema)
-    return df
+    if rows:
+        with get_engine().begin() as conn:
+            conn.execute(current_ride_upsert(staging_schema), rows)
 
 
-def convert_dob_to_age(dob: str) -> int:
-    """Takes the dob in ms, and converts to age in years
+def get_current_ride(staging_schema: str) -> pd.DataFrame:
+    """Obtains the most recently updated ride from the 'CURRENT_RIDE' table.
 
     Args:
-        dob (int): ms from 01/01/1970
+        staging_schema (str): Staging schema name
 
     Returns:
-        int: Age in years
+        pd.DataFrame: Returns pandas dataframe
     """
-
-    if not math.isnan(float(dob)):
-        dob = int(dob)
-        epoch_in_seconds = dob / 1000
-        formatted_dob = dt.fromtimestamp(epoch_in_seconds)
-        epoch_age = dt.now() - formatted_dob
-        age = math.floor(epoch_age.days / 365)
-        return age
-    return dob
+    query = f"""
+            SELECT "RIDE_ID", "NAME", "GENDER", "AGE", "DURATION", "HEART RATE", "EMAIL"
+            FROM "{staging_schema}"."CURRENT_RIDE"
+            ORDER BY "UPDATED_AT" DESC
+            LIMIT 1
+            """
+    with get_engine().connect() as conn:
+        df = pd.read_sql_query(query, conn)
+    return df
 
 
 def send_email(BODY_TEXT: str, BODY_HTML: str, RECIPIENT: str, SUBJECT: str):
@@ -173,25 +197,11 @@ def send_email(BODY_TEXT: str, BODY_HTML: str, RECIPIENT: str, SUBJECT: str):
         print(response["MessageId"])
 
 
-def get_current_ride_data(
-    ride_id: int,
-    user: str,
-    password: str,
-    hostname: str,
-    port: int,
-    db_name: str,
-    schema: str,
-    table_name: str,
-) -> pd.DataFrame:
+def get_current_ride_data(ride_id: int, schema: str, table_name: str) -> pd.DataFrame:
     """Obtains dataframe based on current ride id.
 
     Args:
         ride_id (int): Current ride id
-        user (str): Database username
-        password (str): Database password
-        hostname (str): Database hostname
-        port (int): Database port
-        db_name (str): Database name
         schema (str): Staging schema name
         table_name (str): Table name in question
 
@@ -203,11 +213,7 @@ def get_current_ride_data(
             SELECT * FROM "{schema}"."{table_name}"
             WHERE ride_id={ride_id}
             """
-    engine = create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
-    )
-
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         df = pd.read_sql_query(query, conn)
 
     return df
@@ -0,0 +1,137 @@
+import csv
+import io
+import os
+import threading
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL, Engine
+
+load_dotenv()
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def env_flag(name: str, default: bool) -> bool:
+    """Reads a true/false setting from the environment
+
+    Args:
+        name (str): environment variable name
+        default (bool): value used when the variable is not set
+
+    Returns:
+        bool: value of the setting
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def database_url() -> URL:
+    """Builds the aurora connection url from the DB_* environment variables
+
+    Returns:
+        URL: sqlalchemy url for the postgres database
+    """
+    return URL.create(
+        "postgresql",
+        username=os.environ["DB_USER"],
+        password=os.environ["DB_PASSWORD"],
+        host=os.environ["DB_HOST"],
+        port=int(os.environ["DB_PORT"]),
+        database=os.environ["DB_NAME"],
+    )
+
+
+def get_engine() -> Engine:
+    """Returns the process-wide pooled engine, creating it on first use.
+
+    Pool behaviour can be tuned with DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_PRE_PING and DB_POOL_RECYCLE (seconds). A forked child process
+    gets its own engine rather than sharing the parent's connections.
+
+    Returns:
+        Engine: shared sqlalchemy engine
+    """
+    global _engine, _engine_pid
+
+    if _engine is None or _engine_pid != os.getpid():
+        with _engine_lock:
+            if _engine is not None and _engine_pid != os.getpid():
+                _engine.dispose(close=False)
+                _engine = None
+            if _engine is None:
+                _engine_pid = os.getpid()
+                _engine = create_engine(
+                    database_url(),
+                    pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+                    max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+                    pool_pre_ping=env_flag("DB_POOL_PRE_PING", True),
+                    pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+                )
+    return _engine
+
+
+def rows_to_csv(rows) -> io.StringIO:
+    """Writes rows out as the CSV payload of a COPY
+
+    Args:
+        rows (Iterable): rows to write
+
+    Returns:
+        io.StringIO: CSV text, positioned at the start
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+
+def copy_csv(conn, schema: str, table_name: str, columns: list, buffer):
+    """Streams a CSV payload into a table through PostgreSQL COPY
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection the write happens on
+        schema (str): schema of the table, None for the search path
+        table_name (str): table being written to
+        columns (list): column names, in the order the CSV fields are in
+        buffer (io.StringIO): CSV text, empty unquoted fields being NULL
+    """
+    column_names = ", ".join(f'"{column}"' for column in columns)
+    if schema:
+        table_name = f'"{schema}"."{table_name}"'
+    else:
+        table_name = f'"{table_name}"'
+
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table_name} ({column_names}) FROM STDIN WITH CSV", buffer
+        )
+
+
+def copy_rows(conn, schema: str, table_name: str, columns: list, rows):
+    """Streams rows into a table through PostgreSQL COPY
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection the write happens on
+        schema (str): schema of the table, None for the search path
+        table_name (str): table being written to
+        columns (list): column names, in the order the row values are in
+        rows (Iterable): rows to insert, None values are written as NULL
+    """
+    copy_csv(conn, schema, table_name, columns, rows_to_csv(rows))
+
+
+def copy_insert(table, conn, keys: list, data_iter):
+    """pandas `to_sql` insert method that streams the rows through PostgreSQL COPY
+
+    Args:
+        table (pandas.io.sql.SQLTable): table being written to
+        conn (sqlalchemy.engine.Connection): connection the write happens on
+        keys (list): column names
+        data_iter (Iterable): rows to insert
+    """
+    copy_rows(conn, table.schema, table.name, keys, data_iter)
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+
+from utils.metrics import Counter
+
+
+class DeadLetterFile:
+    """Quarantines messages the extractor can't use in an append-only JSONL file,
+    with the error and where the message was read from, so they can be looked
+    at and replayed later without holding up the consumer.
+
+    Records are collected per consumed batch and appended with a single write.
+    A count of quarantined messages is kept per error type.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.counts = {}
+
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def quarantine(self, message, error):
+        """Records a message that couldn't be decoded or parsed
+
+        Args:
+            message (cimpl.Message): kafka message
+            error (Union[Exception, KafkaError]): what went wrong with it
+        """
+        error_type = type(error).__name__
+        counter = self.counts.get(error_type)
+        if counter is None:
+            counter = self.counts[error_type] = Counter(
+                "extract_dead_letters",
+                "Messages quarantined instead of being written to staging",
+                {"error_type": error_type},
+            )
+        counter.inc()
+
+        value = message.value()
+        key = message.key()
+        record = {
+            "topic": message.topic(),
+            "partition": message.partition(),
+            "offset": message.offset(),
+            "timestamp": message.timestamp()[1],
+            "key": key.decode("utf-8", errors="replace") if key else None,
+            "value": value.decode("utf-8", errors="replace") if value else None,
+            "error_type": error_type,
+            "error": str(error),
+            "quarantined_at": time.time(),
+        }
+        with self._lock:
+            self._pending.append(record)
+
+    def flush(self):
+        """Appends every pending record to the file"""
+        with self._lock:
+            if not self._pending:
+                return
+            lines = "".join(
+                json.dumps(record, default=str) + "\n" for record in self._pending
+            )
+            self._pending = []
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+
+    def summary(self) -> str:
+        """Quarantined message counts by error type
+
+        Returns:
+            str: one line summary
+        """
+        counts = ", ".join(
+            f"{error_type}={counter.value}"
+            for error_type, counter in sorted(self.counts.items())
+        )
+        return f"dead letters: {counts or 'none'}"
@@ -0,0 +1,579 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from typing import NamedTuple
+
+from confluent_kafka import KafkaException, TopicPartition
+
+import utils.extract_utils as util
+from utils.dash_app_pages_live_utils import create_rows, current_ride_row
+from utils.message_sources import SourceExhausted
+from utils.metrics import LATENCY_BUCKETS, RATIO_BUCKETS, Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+batch_fill = Histogram(
+    "extract_batch_fill_ratio",
+    "Share of the requested batch size returned by each consume",
+    RATIO_BUCKETS,
+)
+batch_seconds = Histogram(
+    "extract_batch_seconds",
+    "Seconds spent decoding, parsing and pairing each batch",
+    LATENCY_BUCKETS,
+)
+STAGES = ["consume", "decode", "parse", "pair", "write", "live"]
+stage_seconds = {
+    stage: Histogram(
+        f"extract_{stage}_seconds",
+        f"Seconds spent per batch in {stage}",
+        LATENCY_BUCKETS,
+    )
+    for stage in STAGES
+}
+messages_consumed = Counter("extract_messages", "Messages taken off the topic")
+MESSAGE_TYPES = {
+    util.UserDetails: "system",
+    util.RideReading: "ride",
+    util.TelemetryReading: "telemetry",
+    type(None): "other",
+}
+messages_parsed = {
+    kind: Counter(
+        "extract_parsed_messages",
+        "Messages parsed, by message type",
+        {"type": kind},
+    )
+    for kind in MESSAGE_TYPES.values()
+}
+consumer_pauses = Counter(
+    "extract_consumer_pauses", "Times consumption was paused by a full queue"
+)
+paused_seconds = Histogram(
+    "extract_paused_seconds",
+    "Seconds consumption stayed paused each time a queue filled up",
+    LATENCY_BUCKETS,
+)
+
+
+def stage_report() -> list:
+    """Throughput and per-batch latency of every extract stage
+
+    Returns:
+        list: one line per stage
+    """
+    lines = []
+    for stage, histogram in stage_seconds.items():
+        rate = messages_consumed.value / histogram.sum if histogram.sum else 0
+        lines.append(
+            f"{stage:>8}: {rate:>12,.0f} msg/s | per batch mean "
+            f"{histogram.mean() * 1000:.3f} ms, max {histogram.max * 1000:.3f} ms"
+        )
+    lines.append(
+        f"  paused: {consumer_pauses.value} times, {paused_seconds.sum:.3f}s in total"
+    )
+    return lines
+
+
+# AttributeError: a message with no value, a tombstone, has nothing to decode
+DECODE_ERRORS = (UnicodeDecodeError, ValueError, KeyError, TypeError, AttributeError)
+
+
+class ParsedBatch(NamedTuple):
+    """Rows for the staging tables from one partition's messages in a consumed
+    batch, with the offsets they cover, how many partition revocations had
+    happened when the messages were consumed, and a copy of the ride state of
+    each bike the messages touched, None for a bike left without a ride"""
+
+    rows: dict
+    offsets: dict
+    partition: tuple = None
+    consumed_at: int = 0
+    states: dict = None
+
+
+def by_partition(messages: list) -> dict:
+    """Groups consumed messages by the partition they were read from, keeping
+    their order
+
+    Args:
+        messages (list): kafka messages
+
+    Returns:
+        dict: (topic, partition) to its messages
+    """
+    groups = {}
+    for message in messages:
+        groups.setdefault((message.topic(), message.partition()), []).append(message)
+    return groups
+
+
+class ExtractPipeline:
+    """Runs the extractor as asyncio stages joined by bounded queues:
+
+        consume -> parse -> staging write
+                        \\-> live update
+
+    Consuming and the database writes run in worker threads, so a slow write
+    overlaps with polling instead of stalling it. When the queue in front of
+    the staging write fills up, the consumer's partitions are paused until
+    there is room, so a backlog shows up as consumer lag rather than growing
+    in memory. The live stage only needs each bike's latest reading, so
+    readings waiting for it are merged rather than queued.
+
+    Each ride's RideSummary is updated with every reading, and the summaries
+    touched by a batch are written with it as RIDE_SUMMARY rows.
+
+    With `known_users`, a returning rider's USERS row is only written when
+    their details have changed. A rider is only remembered once their row has
+    been handed to the staging writer. With `dead_letters`, messages that can't be
+    decoded or parsed are quarantined and consuming carries on; their records
+    are written before the batch reaches the staging writer, so their offsets
+    are never committed ahead of them. A quarantined SYSTEM message still ends
+    the bike's current ride, so the next rider's readings are never recorded
+    under the previous rider's ride_id.
+
+    When partitions are revoked, the batches of theirs still in flight are
+    dropped, and their bikes' ride states are rolled back to the states
+    after the last batch the writer accepted, which is where the partitions'
+    committed offsets pick up again. `states` seeds the bikes' ride states, as
+    restored from the staging tables after a restart.
+    """
+
+    def __init__(
+        self,
+        consumer,
+        writer,
+        ride_ids,
+        topic: str,
+        staging_schema: str,
+        batch_size: int = 100,
+        batch_timeout: float = 0.5,
+        queue_size: int = 8,
+        update_live: bool = True,
+        known_users=None,
+        dead_letters=None,
+        log_sample_rate: float = 0.01,
+        lag_interval: float = 10,
+        states: dict = None,
+    ):
+        self.consumer = consumer
+        self.writer = writer
+        self.ride_ids = ride_ids
+        self.topic = topic
+        self.staging_schema = staging_schema
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.queue_size = queue_size
+        self.update_live = update_live
+        self.known_users = known_users
+        self.dead_letters = dead_letters
+        self.log_sample_rate = log_sample_rate
+        self.lag_interval = lag_interval
+
+        self.states = states if states is not None else {}
+        self._initial_states = {key: state.copy() for key, state in self.states.items()}
+        self._writer_lock = threading.Lock()
+        self._positions = {}
+        self._revocations = 0
+        self._revoked_at = {}
+        self._rolled_back_at = 0
+        self._partition_bikes = {}
+        self._accepted_states = {}
+        self._lag_gauges = {}
+        self._last_message_ms = None
+
+        Gauge(
+            "extract_last_message_age_seconds",
+            "Seconds since the timestamp of the newest message consumed",
+            function=self._last_message_age,
+        )
+
+    def run(self):
+        """Runs every stage until the source runs out or a stage fails"""
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self.consumer.subscribe([self.topic], on_revoke=self._on_revoke)
+
+        consumed = asyncio.Queue(self.queue_size)
+        parsed = asyncio.Queue(self.queue_size)
+        live = asyncio.Queue(1)
+
+        stages = [
+            self._consume(consumed),
+            self._parse(consumed, parsed, live),
+            self._write(parsed),
+        ]
+        if self.update_live:
+            stages.append(self._live(live))
+
+        tasks = [asyncio.create_task(stage) for stage in stages]
+        lag = asyncio.create_task(self._track_lag())
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION
+            )
+        finally:
+            for task in [*tasks, lag]:
+                task.cancel()
+            await asyncio.gather(*tasks, lag, return_exceptions=True)
+
+        for task in done:
+            task.result()
+
+    def _on_revoke(self, consumer, partitions: list):
+        """Flushes what has been buffered before partitions are handed to
+        another consumer, and forgets their uncommitted offsets. Batches from
+        those partitions still on their way through the stages are dropped
+        before they reach the writer, the new owner consuming them again."""
+        revoked = {(partition.topic, partition.partition) for partition in partitions}
+        with self._writer_lock:
+            self._revocations += 1
+            for key in revoked:
+                self._revoked_at[key] = self._revocations
+                self._positions.pop(key, None)
+            self.writer.flush()
+            self.writer.discard_offsets(revoked)
+
+    async def _consume(self, outbox: asyncio.Queue):
+        """Polls the consumer for batches of messages"""
+        try:
+            while True:
+                with stage_seconds["consume"].time():
+                    messages = await asyncio.to_thread(
+                        self.consumer.consume, self.batch_size, self.batch_timeout
+                    )
+
+                if not messages:
+                    logger.debug("Waiting for new messages")
+                    continue
+
+                messages_consumed.inc(len(messages))
+                batch_fill.observe(len(messages) / self.batch_size)
+
+                consumed = (messages, self._revocations)
+                if outbox.full():
+                    await self._put_paused(outbox, consumed)
+                else:
+                    outbox.put_nowait(consumed)
+        except SourceExhausted:
+            pass
+        await outbox.put(None)
+
+    async def _track_lag(self):
+        """Updates the consumer lag gauges every `lag_interval` seconds, beside
+        the stages, so a slow watermark lookup never holds up consuming"""
+        while True:
+            try:
+                await asyncio.to_thread(self._update_lag, dict(self._positions))
+            except KafkaException as error:
+                logger.warning(
+                    json.dumps({"event": "lag_update_failed", "error": str(error)})
+                )
+            await asyncio.sleep(self.lag_interval)
+
+    def _update_lag(self, positions: dict):
+        """Sets the consumer lag gauge of each assigned partition, from the end
+        of the partition and the next offset this consumer will read
+
+        Args:
+            positions (dict): (topic, partition) to the next offset to consume
+        """
+        for partition in self.consumer.assignment():
+            key = (partition.topic, partition.partition)
+            if key not in positions:
+                continue
+            _, high = self.consumer.get_watermark_offsets(
+                TopicPartition(*key), timeout=1
+            )
+            gauge = self._lag_gauges.get(key)
+            if gauge is None:
+                gauge = self._lag_gauges[key] = Gauge(
+                    "extract_consumer_lag",
+                    "Messages in the partition not yet consumed",
+                    {"topic": key[0], "partition": key[1]},
+                )
+            gauge.set(max(high - positions[key], 0))
+
+    def _last_message_age(self) -> float:
+        """Seconds since the timestamp of the newest message consumed, 0 before the first"""
+        if self._last_message_ms is None:
+            return 0.0
+        return time.time() - self._last_message_ms / 1000
+
+    def _log_sampled(self, message, msg: str):
+        """Logs a sample of the consumed messages as JSON
+
+        Args:
+            message (cimpl.Message): kafka message
+            msg (str): its log line
+        """
+        if random.random() < self.log_sample_rate:
+            logger.info(
+                json.dumps(
+                    {
+                        "event": "message",
+                        "topic": message.topic(),
+                        "partition": message.partition(),
+                        "offset": message.offset(),
+                        "log": msg.rstrip(),
+                    }
+                )
+            )
+
+    async def _put_paused(self, queue: asyncio.Queue, item):
+        """Pauses fetching from every assigned partition until `queue` has room for `item`
+
+        Args:
+            queue (asyncio.Queue): full queue
+            item (Any): item to put on the queue
+        """
+        partitions = self.consumer.assignment()
+        self.consumer.pause(partitions)
+        consumer_pauses.inc()
+        try:
+            with paused_seconds.time():
+                await queue.put(item)
+        finally:
+            self.consumer.resume(partitions)
+
+    async def _parse(
+        self, inbox: asyncio.Queue, outbox: asyncio.Queue, live: asyncio.Queue
+    ):
+        """Decodes and parses each batch, then pairs readings into rows per bike,
+        passing on a ParsedBatch per partition"""
+        while True:
+            consumed = await inbox.get()
+            if consumed is None:
+                await outbox.put(None)
+                await live.put(None)
+                return
+
+            messages, consumed_at = consumed
+            self._roll_back_revoked(consumed_at)
+            batch_start = time.perf_counter()
+            batches = []
+            live_rides = {}
+            for partition, partition_messages in by_partition(messages).items():
+                if self._revoked_at.get(partition, 0) > consumed_at:
+                    continue
+                batch, partition_live_rides = self._parse_batch(
+                    partition_messages, partition
+                )
+                batches.append(batch._replace(consumed_at=consumed_at))
+                live_rides.update(partition_live_rides)
+            batch_seconds.observe(time.perf_counter() - batch_start)
+
+            await outbox.put(batches)
+            if self.update_live and live_rides:
+                if live.full():
+                    live_rides = {**live.get_nowait(), **live_rides}
+                live.put_nowait(live_rides)
+
+    def _roll_back_revoked(self, consumed_at: int):
+        """Puts the bikes of partitions revoked since the last batch back in the
+        ride state the writer last accepted for them, once every batch consumed
+        before the revocation has been parsed
+
+        Args:
+            consumed_at (int): revocations that had happened when the next batch
+                               was consumed
+        """
+        if consumed_at <= self._rolled_back_at:
+            return
+        with self._writer_lock:
+            for partition, revoked_at in self._revoked_at.items():
+                if not self._rolled_back_at < revoked_at <= consumed_at:
+                    continue
+                accepted = self._accepted_states.get(partition, {})
+                for key in self._partition_bikes.pop(partition, ()):
+                    if key in accepted:
+                        state = accepted[key]
+                    else:
+                        state = self._initial_states.get(key)
+                    if state is None:
+                        self.states.pop(key, None)
+                    else:
+                        self.states[key] = state.copy()
+                self._partition_bikes[partition] = set(accepted)
+        self._rolled_back_at = consumed_at
+
+    def _parse_batch(self, messages: list, partition: tuple = None) -> tuple:
+        """Turns one partition's messages from a consumed batch into staging rows
+        and the latest reading per bike
+
+        Args:
+            messages (list): kafka messages
+            partition (tuple): (topic, partition) the messages were read from
+
+        Returns:
+            tuple: a ParsedBatch and a dict of bike key to CURRENT_RIDE parameters
+        """
+        with stage_seconds["decode"].time():
+            offsets = {}
+            logs = []
+            for message in messages:
+                if message.error():
+                    logger.warning(
+                        json.dumps(
+                            {"event": "consumer_error", "error": str(message.error())}
+                        )
+                    )
+                    self._quarantine(message, message.error())
+                    continue
+
+                offsets[(message.topic(), message.partition())] = message.offset() + 1
+                timestamp = message.timestamp()[1]
+                if timestamp > 0:
+                    self._last_message_ms = timestamp
+
+                try:
+                    msg = util.decode_message(message)["log"]
+                    if not isinstance(msg, str):
+                        raise TypeError(f"log is {type(msg).__name__}, not a str")
+                except DECODE_ERRORS as error:
+                    self._quarantine(message, error)
+                    continue
+
+                self._log_sampled(message, msg)
+
+                logs.append((message, msg))
+
+            self._positions.update(offsets)
+
+        with stage_seconds["parse"].time():
+            records = []
+            for message, msg in logs:
+                try:
+                    records.append((message, util.parse_message(msg)))
+                except util.MessageParseError as error:
+                    self._quarantine(message, error)
+                    if isinstance(error, util.UserDetailsError):
+                        records.append((message, error))
+
+        with stage_seconds["pair"].time():
+            rows = {"USER_RIDES": [], "USERS": [], "RIDES": []}
+            live_rides = {}
+            summaries = {}
+            touched = set()
+
+            for message, record in records:
+                if isinstance(record, util.UserDetailsError):
+                    # A new ride started that can't be attributed to anyone,
+                    # so its readings are dropped until the next SYSTEM message
+                    key = util.bike_key(message)
+                    self.states.pop(key, None)
+                    touched.add(key)
+                    continue
+
+                messages_parsed[MESSAGE_TYPES[type(record)]].inc()
+                if record is None:
+                    continue
+
+                key = util.bike_key(message)
+                touched.add(key)
+                state = self.states.get(key)
+                if state is None:
+                    state = self.states[key] = util.RideState()
+
+                if isinstance(record, util.UserDetails):
+                    state.start_ride(self.ride_ids.next_id(), record)
+                    user_ride_row, user_row = util.process_system_data(
+                        state.ride_id, record
+                    )
+
+                    rows["USER_RIDES"].append(user_ride_row)
+                    if self.known_users is None or self.known_users.is_new_or_changed(
+                        user_row
+                    ):
+                        rows["USERS"].append(user_row)
+                elif isinstance(record, util.RideReading):
+                    state.ride_reading = record
+                elif state.can_record():
+                    event_time = util.message_time(message)
+                    rows["RIDES"].append(
+                        util.process_ride_telemetry_data(
+                            state.ride_reading, record, state.ride_id, event_time
+                        )
+                    )
+                    state.summary.add(state.ride_reading, record, event_time)
+                    summaries[state.ride_id] = state.summary
+                    if self.update_live:
+                        live_rides[key] = current_ride_row(
+                            key,
+                            state.ride_id,
+                            state.user.first_name,
+                            state.user.last_name,
+                            state.user.gender,
+                            str(state.user.date_of_birth),
+                            state.ride_reading.duration,
+                            record.heart_rate,
+                            state.user.email,
+                        )
+
+            rows["RIDE_SUMMARY"] = [summary.row() for summary in summaries.values()]
+
+            states = {}
+            for key in touched:
+                state = self.states.get(key)
+                states[key] = state.copy() if state is not None else None
+            self._partition_bikes.setdefault(partition, set()).update(touched)
+
+        return ParsedBatch(rows, offsets, partition, states=states), live_rides
+
+    def _quarantine(self, message, error):
+        """Hands a bad message to the dead letter file, without one decode and
+        parse errors are raised as before"""
+        if self.dead_letters is not None:
+            self.dead_letters.quarantine(message, error)
+        elif isinstance(error, Exception):
+            raise error
+
+    def _add_batches(self, batches: list):
+        if self.dead_letters is not None:
+            self.dead_letters.flush()
+        with self._writer_lock:
+            for batch in batches:
+                if self._revoked_at.get(batch.partition, 0) > batch.consumed_at:
+                    continue
+                self.writer.add_batch(batch.rows, batch.offsets)
+                self._accepted_states.setdefault(batch.partition, {}).update(
+                    batch.states
+                )
+                if self.known_users is not None:
+                    self.known_users.remember(batch.rows["USERS"])
+
+    def _flush_if_due(self):
+        with self._writer_lock:
+            self.writer.flush_if_due()
+
+    async def _write(self, inbox: asyncio.Queue):
+        """Buffers rows in the staging writer, which flushes them to aurora in batches"""
+        while True:
+            try:
+                batches = await asyncio.wait_for(inbox.get(), self.batch_timeout)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._flush_if_due)
+                continue
+
+            if batches is None:
+                return
+
+            with stage_seconds["write"].time():
+                await asyncio.to_thread(self._add_batches, batches)
+
+    async def _live(self, inbox: asyncio.Queue):
+        """Upserts the latest reading of each bike into CURRENT_RIDE"""
+        while True:
+            live_rides = await inbox.get()
+            if live_rides is None:
+                return
+
+            with stage_seconds["live"].time():
+                await asyncio.to_thread(
+                    create_rows, list(live_rides.values()), self.staging_schema
+                )
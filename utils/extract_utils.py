@@ -1,7 +1,8 @@
+import ast
 import json
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import NamedTuple, Union
 
-import pandas as pd
 from confluent_kafka import cimpl
 
 
@@ -17,155 +18,430 @@ def decode_message(message_object: cimpl.Message) -> dict:
     return json.loads(message_object.value().decode("utf-8"))
 
 
-def extract_user_name(user_details):
-    """Takes in name from msg,
-       extracts first name and last name even if prefix is present
+def bike_key(message_object: cimpl.Message) -> str:
+    """Identifies the bike a kafka message came from, by its key if it has one,
+       otherwise by the partition it was read from
 
     Args:
-        user_data (dict): dict of all user details
+        message_object (cimpl.Message): kafka message
 
     Returns:
-        List: first name, last name
+        str: key for the bike's ride state
     """
+    key = message_object.key()
+    if key:
+        return key.decode("utf-8")
+    return f"{message_object.topic()}-{message_object.partition()}"
 
-    if len(user_details["name"].split(" ")) == 3:
-        return [user_details["name"].split(" ")[1], user_details["name"].split(" ")[2]]
 
-    elif len(user_details["name"].split(" ")) == 2:
-        return [user_details["name"].split(" ")[0], user_details["name"].split(" ")[1]]
+class UserDetails(NamedTuple):
+    """Rider details carried by a SYSTEM message"""
 
+    user_id: int
+    first_name: str
+    last_name: str
+    gender: str
+    date_of_birth: int
+    height: int
+    weight: int
+    email: str
 
-def process_system_message(message: str, ride_id: int) -> list:
-    """Takes a message and extracts the current bike user's data
 
-    Args:
-        message (str): kafka message decoded
-        ride_id (int): len of ride_df + 1
+class RideReading(NamedTuple):
+    """Values carried by a Ride message"""
 
-    Returns:
-        List: ride id, and user data
-    """
+    duration: float
+    resistance: int
 
-    user_details = eval(message.split("= ")[-1])
 
-    user_name = extract_user_name(user_details)
+class TelemetryReading(NamedTuple):
+    """Values carried by a Telemetry message"""
 
-    user_data = [
-        user_details["user_id"],
-        user_name[0],
-        user_name[1],
-        user_details["gender"],
-        user_details["date_of_birth"],
-        user_details["height_cm"],
-        user_details["weight_kg"],
-        user_details["email_address"],
-    ]
+    heart_rate: int
+    rotations_pm: int
+    power: float
 
-    user_ride_data = [ride_id, user_details["user_id"]]
 
-    return user_ride_data, user_data
+class RideSummaryRow(NamedTuple):
+    """A row of the RIDE_SUMMARY staging table"""
 
+    ride_id: int
+    user_id: int
+    started_at: datetime
+    last_reading_at: datetime
+    duration: float
+    readings: int
+    heart_rate_count: int
+    heart_rate_sum: int
+    heart_rate_min: int
+    heart_rate_max: int
+    power_count: int
+    power_sum: float
+    power_min: float
+    power_max: float
+    total_work: float
 
-def process_system_data(
-    user_ride_data: list, user_data: list
-) -> pd.DataFrame | pd.DataFrame:
-    """Takes the extracted data from message, and converts into a DataFrame
 
-    Args:
-        user_ride_data (list): list of values containing the ride_id and user_id
-        user_data (list): list of values containing user's: id, firstname, lastname, gender, DoB, height, weight, email address
+class RideSummary:
+    """Running aggregates of one ride, updated as each reading arrives.
 
-    Returns:
-        pd.DataFrame | pd.DataFrame: 2 DataFrames of a single containing the information of the args
+    Zero heart rate and power readings mean the sensor had nothing to report,
+    so they are left out of the heart rate and power aggregates, the same as
+    the zeroes the transform turns into nulls.
     """
-    user_ride_df = pd.DataFrame(
-        {"user_id": [user_ride_data[1]], "ride_id": [user_ride_data[0]]}
-    )
-    user_df = pd.DataFrame(
-        {
-            "user_id": user_data[0],
-            "first_name": [user_data[1]],
-            "last_name": [user_data[2]],
-            "gender": [user_data[3]],
-            "dob": [str(user_data[4])],
-            "height": [user_data[5]],
-            "weight": [user_data[6]],
-            "email": [user_data[7]],
-        }
+
+    __slots__ = (
+        "ride_id",
+        "user_id",
+        "started_at",
+        "last_reading_at",
+        "duration",
+        "readings",
+        "heart_rate_count",
+        "heart_rate_sum",
+        "heart_rate_min",
+        "heart_rate_max",
+        "power_count",
+        "power_sum",
+        "power_min",
+        "power_max",
+        "total_work",
     )
 
-    return user_ride_df, user_df
+    def __init__(self, ride_id: int, user_id: int):
+        self.ride_id = ride_id
+        self.user_id = user_id
+        self.started_at = None
+        self.last_reading_at = None
+        self.duration = 0.0
+        self.readings = 0
+        self.heart_rate_count = 0
+        self.heart_rate_sum = 0
+        self.heart_rate_min = None
+        self.heart_rate_max = None
+        self.power_count = 0
+        self.power_sum = 0.0
+        self.power_min = None
+        self.power_max = None
+        self.total_work = 0.0
+
+    def add(self, ride: RideReading, telemetry: TelemetryReading, time: datetime):
+        """Adds one paired reading to the summary
+
+        Args:
+            ride (RideReading): duration and resistance
+            telemetry (TelemetryReading): heart rate, rpm and power
+            time (datetime): event time of the telemetry message
+        """
+        if self.started_at is None:
+            self.started_at = time
+        self.last_reading_at = time
+
+        seconds = max(ride.duration - self.duration, 0.0)
+        self.duration = max(ride.duration, self.duration)
+        self.readings += 1
+
+        heart_rate = telemetry.heart_rate
+        if heart_rate:
+            self.heart_rate_count += 1
+            self.heart_rate_sum += heart_rate
+            if self.heart_rate_min is None or heart_rate < self.heart_rate_min:
+                self.heart_rate_min = heart_rate
+            if self.heart_rate_max is None or heart_rate > self.heart_rate_max:
+                self.heart_rate_max = heart_rate
+
+        power = telemetry.power
+        if power:
+            self.power_count += 1
+            self.power_sum += power
+            self.total_work += power * seconds
+            if self.power_min is None or power < self.power_min:
+                self.power_min = power
+            if self.power_max is None or power > self.power_max:
+                self.power_max = power
+
+    @classmethod
+    def from_row(cls, row: RideSummaryRow) -> "RideSummary":
+        """Carries on a summary from its RIDE_SUMMARY row
+
+        Args:
+            row (RideSummaryRow): row last written for the ride
+
+        Returns:
+            RideSummary: summary with the row's aggregates
+        """
+        summary = cls.__new__(cls)
+        for field, value in zip(cls.__slots__, row):
+            setattr(summary, field, value)
+        return summary
+
+    def copy(self) -> "RideSummary":
+        """Copy of the summary that later readings don't change
+
+        Returns:
+            RideSummary: summary with the same aggregates
+        """
+        summary = RideSummary.__new__(RideSummary)
+        for field in self.__slots__:
+            setattr(summary, field, getattr(self, field))
+        return summary
+
+    def row(self) -> RideSummaryRow:
+        """Current state of the summary as a RIDE_SUMMARY row
+
+        Returns:
+            RideSummaryRow: summary row
+        """
+        return RideSummaryRow(*(getattr(self, field) for field in self.__slots__))
+
+
+class RideState:
+    """What is known about the ride currently happening on one bike"""
+
+    __slots__ = ("ride_id", "user", "ride_reading", "summary")
+
+    def __init__(self):
+        self.ride_id = None
+        self.user = None
+        self.ride_reading = None
+        self.summary = None
+
+    def start_ride(self, ride_id: int, user: UserDetails):
+        """Begins a new ride on the bike, forgetting the previous ride's readings
+
+        Args:
+            ride_id (int): id of the new ride
+            user (UserDetails): rider from the SYSTEM message
+        """
+        self.ride_id = ride_id
+        self.user = user
+        self.ride_reading = None
+        self.summary = RideSummary(ride_id, user.user_id)
+
+    def copy(self) -> "RideState":
+        """Copy of the state that later messages don't change
+
+        Returns:
+            RideState: state of the same ride, with a copy of its summary
+        """
+        state = RideState()
+        state.ride_id = self.ride_id
+        state.user = self.user
+        state.ride_reading = self.ride_reading
+        state.summary = self.summary.copy() if self.summary is not None else None
+        return state
+
+    def can_record(self) -> bool:
+        """Whether a telemetry reading can be paired into a RIDES row
+
+        Returns:
+            bool: True once a ride has started and its first Ride message has arrived
+        """
+        return self.user is not None and self.ride_reading is not None
+
+
+class MessageParseError(ValueError):
+    """Raised when a SYSTEM, Ride or Telemetry log line can't be parsed"""
+
+
+class UserDetailsError(MessageParseError):
+    """Raised when the rider details of a SYSTEM log line can't be parsed"""
+
+
+SYSTEM_TAG = "[SYSTEM] data = "
+RIDE_TAG = "]: Ride - "
+TELEMETRY_TAG = "]: Telemetry - "
+# Heart rate and rpm readings are small, so looking them up is cheaper than int()
+SMALL_INTS = {str(number): number for number in range(1000)}
+# Builds a reading without going through its NamedTuple's Python level __new__
+new_reading = tuple.__new__
 
 
-def process_ride_message(msg: str) -> list:
-    """Takes a message and extracts the current ride data
+def extract_user_name(name: str) -> tuple:
+    """Takes in name from msg,
+       extracts first name and last name even if prefix is present
 
     Args:
-        message (str): kafka message decoded
+        name (str): full name of the rider, with or without a prefix
 
     Returns:
-        List: resistance, duration
+        tuple: first name, last name
     """
-    current_ride_info = msg.split("[INFO]: ")[1][:-1].split("= ")
+    parts = name.split()
+    if len(parts) == 3:
+        return parts[1], parts[2]
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    raise UserDetailsError(f"Can't split name into first and last name: {name!r}")
 
-    resistance = current_ride_info[-1]
-    duration = current_ride_info[1].split(";")[0]
 
-    ride_table_resistance_duration = [resistance, duration]
-    return ride_table_resistance_duration
+def parse_user_details(payload: str) -> UserDetails:
+    """Parses the user payload of a SYSTEM message without evaluating it
 
+    Args:
+        payload (str): JSON (or python literal) dict of user details
 
-def process_telemetry_message(msg: str) -> list:
-    """Takes a message and extracts the current telemetry data
+    Returns:
+        UserDetails: the rider's details
+    """
+    try:
+        user_details = json.loads(payload)
+    except json.JSONDecodeError:
+        try:
+            user_details = ast.literal_eval(payload)
+        except (ValueError, SyntaxError) as error:
+            raise UserDetailsError(f"Unreadable user payload: {error}") from error
+
+    try:
+        first_name, last_name = extract_user_name(user_details["name"])
+        return UserDetails(
+            user_details["user_id"],
+            first_name,
+            last_name,
+            user_details["gender"],
+            user_details["date_of_birth"],
+            user_details["height_cm"],
+            user_details["weight_kg"],
+            user_details["email_address"],
+        )
+    except (KeyError, TypeError, AttributeError) as error:
+        raise UserDetailsError(f"Incomplete user payload: {error!r}") from error
+
+
+def parse_message(message: str) -> Union[UserDetails, RideReading, TelemetryReading]:
+    """Parses a SYSTEM, Ride or Telemetry log line.
+
+    Ride and Telemetry lines, nearly all of the traffic, are recognised by their
+    tag and split once on their " = " separators. Each value is then followed by
+    the fixed "; <next field name>" text, which is sliced off before converting.
 
     Args:
         message (str): kafka message decoded
 
     Returns:
-        List: power, heart rate, rotations_pm
+        Union[UserDetails, RideReading, TelemetryReading]: typed record for the message,
+        None if the line is not one of the three message kinds
+    """
+    try:
+        if TELEMETRY_TAG in message:
+            # "... hrt", "120; rpm", "80; power", "150.5"
+            _, hrt, rpm, power = message.split(" = ")
+            hrt = hrt[:-5]
+            rpm = rpm[:-7]
+            return new_reading(
+                TelemetryReading,
+                (
+                    SMALL_INTS.get(hrt) or int(hrt),
+                    SMALL_INTS.get(rpm) or int(rpm),
+                    float(power),
+                ),
+            )
+        if RIDE_TAG in message:
+            # "... duration", "12.0; resistance", "50"
+            _, duration, resistance = message.split(" = ")
+            return new_reading(RideReading, (float(duration[:-12]), int(resistance)))
+    except ValueError as error:
+        raise MessageParseError(f"Malformed message: {message!r}") from error
+
+    start = message.find(SYSTEM_TAG)
+    if start == -1:
+        return None
+    return parse_user_details(message[start + len(SYSTEM_TAG) :])
+
+
+class UserRideRow(NamedTuple):
+    """A row of the USER_RIDES staging table"""
+
+    user_id: int
+    ride_id: int
+
+
+class UserRow(NamedTuple):
+    """A row of the USERS staging table"""
+
+    user_id: int
+    first_name: str
+    last_name: str
+    gender: str
+    dob: str
+    height: int
+    weight: int
+    email: str
+
+
+class RideRow(NamedTuple):
+    """A row of the RIDES staging table"""
+
+    ride_id: int
+    duration: float
+    resistance: int
+    heart_rate: int
+    rotations_pm: int
+    power: float
+    time: datetime
+
+
+def message_time(message_object: cimpl.Message) -> datetime:
+    """Event time of a kafka message, from its timestamp
+
+    Args:
+        message_object (cimpl.Message): kafka message
+
+    Returns:
+        datetime: UTC time the message was produced, or now if it has no timestamp
     """
-    current_telemetry_info = msg.split("[INFO]: ")[1][:-1].split("= ")
+    timestamp = message_object.timestamp()[1]
+    if timestamp > 0:
+        return datetime.fromtimestamp(timestamp / 1000, timezone.utc)
+    return datetime.now(timezone.utc)
 
-    power = current_telemetry_info[-1]
-    hrt = current_telemetry_info[1].split(";")[0]
-    rotations_pm = current_telemetry_info[2].split(";")[0]
 
-    ride_table_power_hrt_rpm = [power, hrt, rotations_pm]
-    return ride_table_power_hrt_rpm
+def process_system_data(ride_id: int, user: UserDetails) -> tuple:
+    """Takes the extracted data from message, and converts into rows for the staging tables
+
+    Args:
+        ride_id (int): id of the ride the user has started
+        user (UserDetails): user's id, firstname, lastname, gender, DoB, height, weight, email address
+
+    Returns:
+        tuple: a UserRideRow and a UserRow
+    """
+    user_ride_row = UserRideRow(user.user_id, ride_id)
+    user_row = UserRow(
+        user.user_id,
+        user.first_name,
+        user.last_name,
+        user.gender,
+        str(user.date_of_birth),
+        user.height,
+        user.weight,
+        user.email,
+    )
+
+    return user_ride_row, user_row
 
 
 def process_ride_telemetry_data(
-    resistance_duration: list, power_hrt_rpm: list, ride_id: int
-) -> pd.DataFrame:
-    """Takes the two lists containing values for ride resistance, duration, power, heart rate, rpm and the ride_id,
-    to create a DataFrame with one row to add to database
+    ride: RideReading, telemetry: TelemetryReading, ride_id: int, time: datetime
+) -> RideRow:
+    """Takes the latest ride and telemetry readings and the ride_id,
+    to create a RIDES row to add to database
 
     Args:
-        resistance_duration (list): List with two values, resistance and duration
-        power_hrt_rpm (list): List with three values, power, heart rate and rpm
+        ride (RideReading): duration and resistance
+        telemetry (TelemetryReading): heart rate, rpm and power
         ride_id (int): Current ride_id
+        time (datetime): event time of the telemetry message
 
     Returns:
-        pd.DataFrame: DataFrame with one row containing all ride data for the current second of the ride
+        RideRow: all ride data for the current second of the ride
     """
-    ride_row = [
+    return RideRow(
         ride_id,
-        resistance_duration[1],
-        resistance_duration[0],
-        power_hrt_rpm[1],
-        power_hrt_rpm[2],
-        power_hrt_rpm[0],
-    ]
-    time_now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    ride_df = pd.DataFrame(
-        {
-            "ride_id": [ride_row[0]],
-            "duration": [ride_row[1]],
-            "resistance": [ride_row[2]],
-            "heart_rate": [ride_row[3]],
-            "rotations_pm": [ride_row[4]],
-            "power": [ride_row[5]],
-            "time": time_now,
-        }
+        ride.duration,
+        ride.resistance,
+        telemetry.heart_rate,
+        telemetry.rotations_pm,
+        telemetry.power,
+        time,
     )
-    return ride_df
@@ -0,0 +1,115 @@
+import hashlib
+from collections import OrderedDict
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from utils.extract_utils import UserRow
+
+
+def user_hash(user: UserRow) -> bytes:
+    """Hashes every column of a USERS row, so a changed detail changes the hash
+
+    Args:
+        user (UserRow): USERS row
+
+    Returns:
+        bytes: 8 byte digest
+    """
+    return hashlib.blake2b(repr(tuple(user)).encode(), digest_size=8).digest()
+
+
+class KnownUsers:
+    """Bounded LRU of the users already in the USERS staging table, with a hash
+    of their details, so a returning rider's row is only written again when
+    something about them has changed.
+
+    Forgetting a user only costs an upsert that changes nothing, so the cache
+    can be much smaller than the table.
+    """
+
+    def __init__(self, engine: Engine, schema: str, max_size: int = 100000):
+        self.engine = engine
+        self.schema = schema
+        self.max_size = max_size
+
+        self._hashes = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def ensure_table(self):
+        """Creates USERS keyed on user_id if it doesn't exist.
+
+        A USERS table from before the key existed has a row per ride; it is
+        cut down to one row per user before the key is added.
+        """
+        table = f'"{self.schema}"."USERS"'
+        with self.engine.begin() as conn:
+            inspector = inspect(conn)
+            if not inspector.has_table("USERS", schema=self.schema):
+                conn.execute(text(f"""
+                        CREATE TABLE {table} (
+                            user_id BIGINT PRIMARY KEY,
+                            first_name TEXT,
+                            last_name TEXT,
+                            gender TEXT,
+                            dob TEXT,
+                            height BIGINT,
+                            weight BIGINT,
+                            email TEXT
+                        )
+                        """))
+                return
+
+            key = inspector.get_pk_constraint("USERS", schema=self.schema)
+            if not key["constrained_columns"]:
+                conn.execute(text(f"""
+                        DELETE FROM {table} AS older
+                        USING {table} AS newer
+                        WHERE older.user_id = newer.user_id
+                            AND older.ctid < newer.ctid
+                        """))
+                conn.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (user_id)"))
+
+    def warm(self):
+        """Loads up to `max_size` users from the USERS table into the cache"""
+        with self.engine.connect() as conn:
+            result = conn.execute(
+                text(
+                    f"SELECT {', '.join(UserRow._fields)} "
+                    f'FROM "{self.schema}"."USERS" LIMIT :limit'
+                ),
+                {"limit": self.max_size},
+            )
+            for row in result:
+                self._remember(UserRow(*row))
+
+    def _remember(self, user: UserRow) -> bytes:
+        digest = user_hash(user)
+        self._hashes[user.user_id] = digest
+        self._hashes.move_to_end(user.user_id)
+        if len(self._hashes) > self.max_size:
+            self._hashes.popitem(last=False)
+        return digest
+
+    def is_new_or_changed(self, user: UserRow) -> bool:
+        """Checks a USERS row against the cache, without remembering it
+
+        Args:
+            user (UserRow): USERS row from a SYSTEM message
+
+        Returns:
+            bool: whether the row needs writing
+        """
+        return self._hashes.get(user.user_id) != user_hash(user)
+
+    def remember(self, users: list):
+        """Remembers USERS rows once they have been handed to the staging
+        writer, so a row dropped before then is written when it comes again
+
+        Args:
+            users (list): UserRow rows
+        """
+        for user in users:
+            self._remember(user)
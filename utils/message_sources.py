@@ -0,0 +1,297 @@
+import bz2
+import gzip
+import json
+import lzma
+import random
+import time
+from datetime import datetime
+
+OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class SourceExhausted(Exception):
+    """Raised by an offline source once every message has been consumed"""
+
+
+class ReplayMessage:
+    """Stand-in for a kafka message, exposing the parts the extractor reads"""
+
+    __slots__ = ("_value", "_key", "_topic", "_partition", "_offset", "_timestamp")
+
+    def __init__(
+        self,
+        value: bytes,
+        key: bytes,
+        topic: str,
+        partition: int,
+        offset: int,
+        timestamp: int,
+    ):
+        self._value = value
+        self._key = key
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._timestamp = timestamp
+
+    def value(self) -> bytes:
+        return self._value
+
+    def key(self) -> bytes:
+        return self._key
+
+    def topic(self) -> str:
+        return self._topic
+
+    def partition(self) -> int:
+        return self._partition
+
+    def offset(self) -> int:
+        return self._offset
+
+    def timestamp(self) -> tuple:
+        return (1, self._timestamp)
+
+    def error(self):
+        return None
+
+
+class OfflineSource:
+    """Serves prepared messages through the part of the kafka Consumer API the
+    extractor uses, either as fast as possible or at their recorded pace
+    """
+
+    def __init__(self, messages, realtime: bool = False):
+        self._messages = iter(messages)
+        self.realtime = realtime
+        self.committed = {}
+
+        self._pending = None
+        self._first_timestamp = None
+        self._started_at = None
+
+    def subscribe(self, topics: list, on_revoke=None):
+        pass
+
+    def consume(self, num_messages: int = 1, timeout: float = -1) -> list:
+        """Returns up to `num_messages` messages. When replaying in real time,
+        messages arrive no earlier than they were recorded, and once `timeout`
+        expires the messages that have arrived are returned, like Consumer.consume
+
+        Args:
+            num_messages (int): most messages to return
+            timeout (float): most seconds to wait when replaying in real time,
+                             -1 to wait until `num_messages` have arrived
+
+        Returns:
+            list: messages, empty if none arrived before the timeout
+        """
+        deadline = time.monotonic() + timeout if timeout >= 0 else None
+        batch = []
+        while len(batch) < num_messages:
+            message = self._next_message()
+            if message is None:
+                break
+            if self.realtime and not self._wait_for(message.timestamp()[1], deadline):
+                self._pending = message
+                break
+            batch.append(message)
+
+        if not batch and self._pending is None:
+            raise SourceExhausted()
+        return batch
+
+    def _next_message(self):
+        """Takes the message held back by the last timeout, or the next one
+
+        Returns:
+            ReplayMessage: next message, None once every message has been served
+        """
+        message, self._pending = self._pending, None
+        if message is None:
+            message = next(self._messages, None)
+        return message
+
+    def _wait_for(self, timestamp: int, deadline: float = None) -> bool:
+        """Sleeps until the recorded time of a message, relative to the first
+        message, or until the deadline if that comes first
+
+        Args:
+            timestamp (int): message timestamp in ms
+            deadline (float): time.monotonic() to stop waiting at, None for no limit
+
+        Returns:
+            bool: True if the message is due, False if the deadline came first
+        """
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+            self._started_at = time.monotonic()
+            return True
+
+        due = self._started_at + (timestamp - self._first_timestamp) / 1000
+        if deadline is not None and due > deadline:
+            time.sleep(max(deadline - time.monotonic(), 0))
+            return False
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def assignment(self) -> list:
+        return []
+
+    def pause(self, partitions: list):
+        pass
+
+    def resume(self, partitions: list):
+        pass
+
+    def commit(self, offsets: list = None, asynchronous: bool = True):
+        for topic_partition in offsets or []:
+            key = (topic_partition.topic, topic_partition.partition)
+            self.committed[key] = topic_partition.offset
+
+    def close(self):
+        pass
+
+
+def log_timestamp(log: str) -> int:
+    """Reads the time at the start of a log line
+
+    Args:
+        log (str): log line, e.g. '2022-10-13 13:00:00.123456 mendoza v9: [INFO]: ...'
+
+    Returns:
+        int: ms since 01/01/1970, None if the line has no readable time
+    """
+    try:
+        return int(datetime.strptime(log[:26], LOG_TIME_FORMAT).timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+def read_recording(path: str, topic: str = "replay") -> list:
+    """Reads recorded kafka messages from a JSONL file, optionally gzip, bz2 or xz
+    compressed.
+
+    Each line is either a message value, {"log": "..."}, or a message with its
+    metadata, {"value": {"log": "..."}, "timestamp": ms, "partition": 0, "key": "..."}.
+
+    Args:
+        path (str): path to the recording
+        topic (str): topic name to give the messages
+
+    Returns:
+        list: ReplayMessage objects in recorded order
+    """
+    opener = next(
+        (opener for suffix, opener in OPENERS.items() if path.endswith(suffix)), open
+    )
+    messages = []
+    with opener(path, "rt", encoding="utf-8") as f:
+        for offset, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            value = record.get("value", record)
+            timestamp = record.get("timestamp") or log_timestamp(value.get("log", ""))
+            key = record.get("key")
+            messages.append(
+                ReplayMessage(
+                    json.dumps(value).encode("utf-8"),
+                    key.encode("utf-8") if key else None,
+                    topic,
+                    record.get("partition", 0),
+                    offset,
+                    timestamp or 0,
+                )
+            )
+    return messages
+
+
+def generate_ride_lines(
+    rides: int = 50, seconds_per_ride: int = 200, seed: int = 1, first_user_id: int = 0
+) -> list:
+    """Generates log lines for whole rides, in the format the bikes send them
+
+    Args:
+        rides (int): number of rides to generate
+        seconds_per_ride (int): ride length, one Ride and one Telemetry line per second
+        seed (int): random seed, the same seed gives the same lines
+        first_user_id (int): user id of the first ride's rider, the rest follow on
+
+    Returns:
+        list: log lines
+    """
+    rng = random.Random(seed)
+    prefix = "2022-10-13 13:00:00.000000 mendoza v9:"
+    lines = []
+    for user_id in range(first_user_id, first_user_id + rides):
+        user = {
+            "user_id": user_id,
+            "name": rng.choice(["Mr Jack Jones", "Ann Smith", "Dr Eve Brown"]),
+            "gender": rng.choice(["male", "female"]),
+            "address": "1 Long Road,London,N1 1AA",
+            "date_of_birth": rng.randint(-600000000000, 900000000000),
+            "email_address": f"rider{user_id}@example.com",
+            "height_cm": rng.randint(150, 200),
+            "weight_kg": rng.randint(50, 100),
+            "account_create_date": 1600000000000,
+            "bike_serial": "SN0000",
+            "original_source": "offline",
+        }
+        lines.append(f"{prefix} [SYSTEM] data = {json.dumps(user)}\n")
+        for second in range(1, seconds_per_ride + 1):
+            lines.append(
+                f"{prefix} [INFO]: Ride - duration = {second}.0; "
+                f"resistance = {rng.randint(0, 100)}\n"
+            )
+            lines.append(
+                f"{prefix} [INFO]: Telemetry - hrt = {rng.randint(0, 180)}; "
+                f"rpm = {rng.randint(0, 120)}; power = {rng.uniform(0, 300)}\n"
+            )
+    return lines
+
+
+def synthetic_messages(
+    bikes: int = 4,
+    rides_per_bike: int = 5,
+    seconds_per_ride: int = 200,
+    topic: str = "synthetic",
+) -> list:
+    """Local stand-in for the bike producers: several bikes riding at once, each
+    on its own partition, with their messages interleaved and sent every half second
+
+    Args:
+        bikes (int): number of bikes
+        rides_per_bike (int): rides each bike sends
+        seconds_per_ride (int): ride length in seconds
+        topic (str): topic name to give the messages
+
+    Returns:
+        list: ReplayMessage objects in send order
+    """
+    start = int(time.time() * 1000)
+    per_bike = [
+        generate_ride_lines(
+            rides_per_bike, seconds_per_ride, seed=bike, first_user_id=bike * 1000
+        )
+        for bike in range(bikes)
+    ]
+
+    messages = []
+    for position in range(max(len(lines) for lines in per_bike)):
+        for bike, lines in enumerate(per_bike):
+            if position < len(lines):
+                messages.append(
+                    ReplayMessage(
+                        json.dumps({"log": lines[position]}).encode("utf-8"),
+                        None,
+                        topic,
+                        bike,
+                        position,
+                        start + position * 500,
+                    )
+                )
+    return messages
@@ -0,0 +1,256 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Registry:
+    """Every metric created in the process, for exposition in Prometheus text format.
+
+    A metric replaces an earlier one with the same name and labels.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds a metric to the registry
+
+        Args:
+            metric (Union[Counter, Gauge, Histogram]): metric to expose
+        """
+        key = (metric.name, tuple(sorted(metric.labels.items())))
+        with self._lock:
+            self._metrics[key] = metric
+
+    def render(self) -> str:
+        """Renders every registered metric in the Prometheus text format
+
+        Returns:
+            str: exposition text
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+
+        lines = []
+        described = set()
+        for (name, _), metric in metrics:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {metric.description}")
+                lines.append(f"# TYPE {name} {metric.TYPE}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def format_labels(labels: dict) -> str:
+    """Formats labels for a Prometheus sample line
+
+    Args:
+        labels (dict): label names to values
+
+    Returns:
+        str: e.g. '{error_type="KeyError"}', empty when there are no labels
+    """
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """A monotonically increasing count, safe to share between threads.
+
+    Counters sharing a name can be told apart by their `labels`.
+    """
+
+    TYPE = "counter"
+
+    def __init__(self, name: str, description: str, labels: dict = None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount: int = 1):
+        """Increase the counter
+
+        Args:
+            amount (int): value to add to the counter
+        """
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> list:
+        """Prometheus sample lines for the counter
+
+        Returns:
+            list: sample lines
+        """
+        return [f"{self.name}_total{format_labels(self.labels)} {self.value}"]
+
+
+class Gauge:
+    """A value that can go up and down, either set directly or read from
+    `function` whenever the metrics are rendered"""
+
+    TYPE = "gauge"
+
+    def __init__(self, name: str, description: str, labels: dict = None, function=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.function = function
+        self.value = 0.0
+        registry.register(self)
+
+    def set(self, value: float):
+        """Set the gauge
+
+        Args:
+            value (float): new value
+        """
+        self.value = value
+
+    def samples(self) -> list:
+        """Prometheus sample lines for the gauge
+
+        Returns:
+            list: sample lines
+        """
+        value = self.function() if self.function is not None else self.value
+        return [f"{self.name}{format_labels(self.labels)} {value}"]
+
+
+class Histogram:
+    """Records observations into buckets, keeping a running sum and count"""
+
+    TYPE = "histogram"
+
+    def __init__(
+        self, name: str, description: str, buckets: tuple, labels: dict = None
+    ):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.labels = labels or {}
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value: float):
+        """Add one observation to the histogram
+
+        Args:
+            value (float): observed value, e.g. a latency in seconds or a row count
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if index < len(self.buckets):
+                self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    @contextmanager
+    def time(self):
+        """Context manager that observes the wall-clock seconds spent inside it"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def mean(self) -> float:
+        """Average of all observations, 0 if nothing has been observed
+
+        Returns:
+            float: mean observation
+        """
+        return self.sum / self.count if self.count else 0.0
+
+    def summary(self) -> str:
+        """One line description of the histogram for log output
+
+        Returns:
+            str: count, mean and max of the observations
+        """
+        return (
+            f"{self.name}: count={self.count} mean={self.mean():.4f} max={self.max:.4f}"
+        )
+
+    def samples(self) -> list:
+        """Prometheus sample lines for the histogram, with cumulative buckets
+
+        Returns:
+            list: sample lines
+        """
+        with self._lock:
+            bucket_counts = list(self.bucket_counts)
+            count = self.count
+            total = self.sum
+
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            labels = format_labels({**self.labels, "le": bound})
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels({**self.labels, "le": "+Inf"})
+        lines.append(f"{self.name}_bucket{labels} {count}")
+        lines.append(f"{self.name}_sum{format_labels(self.labels)} {total}")
+        lines.append(f"{self.name}_count{format_labels(self.labels)} {count}")
+        return lines
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the registry on /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def serve_metrics(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serves the metrics on http://host:port/metrics from a background thread
+
+    Args:
+        port (int): port to listen on
+        host (str): address to listen on
+
+    Returns:
+        ThreadingHTTPServer: the running server
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,400 @@
+import io
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from utils.db import copy_csv
+from utils.staging_tables import retype_columns
+
+PRODUCTION_COLUMNS = {
+    "user_id": "BIGINT",
+    "first_name": "TEXT",
+    "last_name": "TEXT",
+    "gender": "TEXT",
+    "age": "SMALLINT",
+    "height": "SMALLINT",
+    "weight": "SMALLINT",
+    "email": "TEXT",
+    "ride_id": "BIGINT",
+    "time_elapsed": "REAL",
+    "resistance": "SMALLINT",
+    "heart_rate": "SMALLINT",
+    "rotations_pm": "SMALLINT",
+    "power": "REAL",
+    "time": "TIMESTAMPTZ",
+}
+PRODUCTION_DTYPES = {
+    "user_id": "Int64",
+    "first_name": "category",
+    "last_name": "category",
+    "gender": pd.CategoricalDtype(ordered=True),
+    "age": "Int16",
+    "height": "Int16",
+    "weight": "Int16",
+    "email": "category",
+    "ride_id": "Int64",
+    "time_elapsed": "Float32",
+    "resistance": "Int16",
+    "heart_rate": "Int16",
+    "rotations_pm": "Int16",
+    "power": "Float32",
+}
+READING_COLUMNS = ["resistance", "heart_rate", "rotations_pm", "power"]
+PRODUCTION_INDEXES = ("time", "ride_id", "user_id")
+
+
+def apply_production_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Gives the production columns of a DataFrame their compact types: nullable
+    small ints and float32 for the numbers, categoricals for the user details
+    repeated on every reading, and NA in place of zero readings
+
+    Args:
+        df (pd.DataFrame): production rows, as joined by the transform or read
+                           back from aurora
+
+    Returns:
+        pd.DataFrame: the same DataFrame with its columns retyped
+    """
+    for column, dtype in PRODUCTION_DTYPES.items():
+        if column not in df:
+            continue
+        if isinstance(dtype, str) and dtype != "category":
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+
+    for column in READING_COLUMNS:
+        if column in df:
+            df[column] = df[column].mask(df[column] == 0)
+
+    return df
+
+
+def create_production_table(conn, schema: str, table_name: str):
+    """Drops and recreates a production table with its typed columns, range
+    partitioned by day on time. Partitions are added as rows arrive for them.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        schema (str): production schema name
+        table_name (str): production table name
+    """
+    table = f'"{schema}"."{table_name}"'
+    columns = ", ".join(
+        f'"{column}" {column_type}'
+        for column, column_type in PRODUCTION_COLUMNS.items()
+    )
+    conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+    conn.execute(text(f'CREATE TABLE {table} ({columns}) PARTITION BY RANGE ("time")'))
+
+
+def table_kind(conn, schema: str, table_name: str) -> str:
+    """Looks up what kind of relation a table is
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection to aurora
+        schema (str): schema name
+        table_name (str): table name
+
+    Returns:
+        str: 'p' for a partitioned table, 'r' for a plain one, None if missing
+    """
+    return conn.execute(
+        text("""
+            SELECT c.relkind FROM pg_class AS c
+            JOIN pg_namespace AS n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema AND c.relname = :table_name
+            """),
+        {"schema": schema, "table_name": table_name},
+    ).scalar()
+
+
+def ensure_production_table(conn, schema: str, table_name: str):
+    """Makes sure the production table exists partitioned by day, so new rows
+    can be appended to it.
+
+    A plain table from before partitioning has its columns typed, then its rows
+    moved into a new partitioned table. Rows without a time can't be placed in
+    a partition, so they are kept in the old table, renamed to
+    `<table_name>_unpartitioned` along with its indexes. The old table is only dropped when every row
+    has been moved.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        schema (str): production schema name
+        table_name (str): production table name
+    """
+    kind = table_kind(conn, schema, table_name)
+    if kind == "p":
+        return
+    if kind is None:
+        create_production_table(conn, schema, table_name)
+        return
+
+    retype_columns(conn, schema, table_name, PRODUCTION_COLUMNS)
+    legacy = f"{table_name}_unpartitioned"
+    conn.execute(text(f'ALTER TABLE "{schema}"."{table_name}" RENAME TO "{legacy}"'))
+    rename_production_indexes(conn, schema, table_name, legacy)
+    create_production_table(conn, schema, table_name)
+
+    days = conn.execute(
+        text(
+            """SELECT DISTINCT ("time" AT TIME ZONE 'UTC')::date """
+            f'FROM "{schema}"."{legacy}" WHERE "time" IS NOT NULL'
+        )
+    ).scalars()
+    ensure_partitions(conn, schema, table_name, days)
+
+    columns = ", ".join(f'"{column}"' for column in PRODUCTION_COLUMNS)
+    conn.execute(
+        text(
+            f'INSERT INTO "{schema}"."{table_name}" ({columns}) '
+            f'SELECT {columns} FROM "{schema}"."{legacy}" WHERE "time" IS NOT NULL'
+        )
+    )
+    untimed = conn.execute(
+        text(f'SELECT count(*) FROM "{schema}"."{legacy}" WHERE "time" IS NULL')
+    ).scalar()
+    if untimed:
+        conn.execute(
+            text(f'DELETE FROM "{schema}"."{legacy}" WHERE "time" IS NOT NULL')
+        )
+        print(f"Kept {untimed} rows without a time in {legacy}")
+    else:
+        conn.execute(text(f'DROP TABLE "{schema}"."{legacy}"'))
+
+
+def partition_name(table_name: str, day: date) -> str:
+    """Names the partition of a production table holding one UTC day
+
+    Args:
+        table_name (str): production table name
+        day (date): day the partition holds
+
+    Returns:
+        str: partition table name
+    """
+    return f"{table_name}_p{day:%Y%m%d}"
+
+
+def partition_days(times: pd.Series) -> list:
+    """Finds the UTC days a column of times falls on
+
+    Args:
+        times (pd.Series): timezone aware times
+
+    Returns:
+        list: distinct days, as dates
+    """
+    days = times.dropna().dt.tz_convert("UTC").dt.floor("D").unique()
+    return [day.date() for day in days]
+
+
+def ensure_partitions(conn, schema: str, table_name: str, days):
+    """Creates the daily partitions of a production table that don't exist yet.
+    Each partition gets the indexes of the partitioned table.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        schema (str): production schema name
+        table_name (str): partitioned table name
+        days (Iterable[date]): UTC days rows are about to be written for
+    """
+    for day in days:
+        conn.execute(
+            text(
+                f'CREATE TABLE IF NOT EXISTS "{schema}"."{partition_name(table_name, day)}" '
+                f'PARTITION OF "{schema}"."{table_name}" '
+                f"FOR VALUES FROM ('{day.isoformat()} 00:00:00+00') "
+                f"TO ('{(day + timedelta(days=1)).isoformat()} 00:00:00+00')"
+            )
+        )
+
+
+def list_partitions(conn, schema: str, table_name: str) -> list:
+    """Lists the partitions attached to a partitioned table
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection to aurora
+        schema (str): schema name
+        table_name (str): partitioned table name
+
+    Returns:
+        list: partition table names
+    """
+    return list(
+        conn.execute(
+            text("""
+                SELECT child.relname FROM pg_inherits AS i
+                JOIN pg_class AS child ON child.oid = i.inhrelid
+                JOIN pg_class AS parent ON parent.oid = i.inhparent
+                JOIN pg_namespace AS n ON n.oid = parent.relnamespace
+                WHERE n.nspname = :schema AND parent.relname = :table_name
+                ORDER BY child.relname
+                """),
+            {"schema": schema, "table_name": table_name},
+        ).scalars()
+    )
+
+
+def detach_partitions_before(conn, schema: str, table_name: str, cutoff: date) -> list:
+    """Detaches the daily partitions holding days before `cutoff`. The detached
+    tables are kept, to be archived or dropped separately.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        schema (str): production schema name
+        table_name (str): partitioned table name
+        cutoff (date): first day to keep attached
+
+    Returns:
+        list: names of the detached partitions
+    """
+    oldest_kept = partition_name(table_name, cutoff)
+    detached = [
+        partition
+        for partition in list_partitions(conn, schema, table_name)
+        if partition < oldest_kept
+    ]
+    for partition in detached:
+        conn.execute(
+            text(
+                f'ALTER TABLE "{schema}"."{table_name}" '
+                f'DETACH PARTITION "{schema}"."{partition}"'
+            )
+        )
+    return detached
+
+
+def load_table_name(table_name: str) -> str:
+    """Names the table a production table is rebuilt in before being swapped in
+
+    Args:
+        table_name (str): production table name
+
+    Returns:
+        str: load table name
+    """
+    return f"{table_name}_load"
+
+
+def csv_timestamps(times: pd.Series) -> pd.Series:
+    """Formats timezone aware times as UTC ISO strings for a COPY payload,
+    which numpy does several times faster than `to_csv` formats timestamps
+
+    Args:
+        times (pd.Series): timezone aware times
+
+    Returns:
+        pd.Series: ISO strings, NaN where the time is missing
+    """
+    utc = times.dt.tz_convert("UTC").dt.tz_localize(None)
+    strings = np.char.add(
+        np.datetime_as_string(utc.to_numpy(dtype="datetime64[us]"), unit="us"), "+00"
+    )
+    return pd.Series(strings, index=times.index).where(utc.notna())
+
+
+def frame_to_csv(df: pd.DataFrame) -> io.StringIO:
+    """Writes a DataFrame out as the CSV payload of a COPY
+
+    Args:
+        df (pd.DataFrame): rows to write, missing values are written as NULL
+
+    Returns:
+        io.StringIO: CSV text, positioned at the start
+    """
+    payload = df.copy(deep=False)
+    for column in payload.select_dtypes(include="datetimetz").columns:
+        payload[column] = csv_timestamps(payload[column])
+
+    buffer = io.StringIO()
+    payload.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    return buffer
+
+
+def copy_frame(conn, schema: str, table_name: str, df: pd.DataFrame):
+    """Bulk loads a DataFrame of production rows through COPY
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        schema (str): production schema name
+        table_name (str): table being written to
+        df (pd.DataFrame): rows to write, missing values are written as NULL
+    """
+    copy_csv(conn, schema, table_name, list(df.columns), frame_to_csv(df))
+
+
+def create_production_indexes(conn, schema: str, table_name: str):
+    """Indexes a production table on time, ride_id and user_id, if it isn't
+    already. Indexes on the partitioned table are built on every partition,
+    and on partitions created later.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        schema (str): production schema name
+        table_name (str): table name
+    """
+    for column in PRODUCTION_INDEXES:
+        conn.execute(
+            text(
+                f'CREATE INDEX IF NOT EXISTS "{table_name}_{column}_idx" '
+                f'ON "{schema}"."{table_name}" ("{column}")'
+            )
+        )
+
+
+def rename_production_indexes(conn, schema: str, old_name: str, new_name: str):
+    """Renames the indexes `create_production_indexes` made for a table to the
+    names it would make for `new_name`, after the table has been renamed
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection of the transform transaction
+        schema (str): production schema name
+        old_name (str): name the indexes were made for
+        new_name (str): table name the indexes are renamed for
+    """
+    for column in PRODUCTION_INDEXES:
+        conn.execute(
+            text(
+                f'ALTER INDEX IF EXISTS "{schema}"."{old_name}_{column}_idx" '
+                f'RENAME TO "{new_name}_{column}_idx"'
+            )
+        )
+
+
+def swap_production_table(conn, schema: str, table_name: str):
+    """Indexes a fully loaded load table and renames it, and its partitions,
+    over the production table. Readers keep using the old table until the
+    transaction commits and are only blocked for the renames, never seeing an
+    empty or partial table.
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection the load table was
+                                             written on
+        schema (str): production schema name
+        table_name (str): production table name
+    """
+    load_name = load_table_name(table_name)
+    create_production_indexes(conn, schema, load_name)
+
+    conn.execute(
+        text(
+            f'ALTER TABLE IF EXISTS "{schema}"."{table_name}" '
+            f'RENAME TO "{table_name}_old"'
+        )
+    )
+    conn.execute(text(f'ALTER TABLE "{schema}"."{load_name}" RENAME TO "{table_name}"'))
+    conn.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{table_name}_old"'))
+
+    rename_production_indexes(conn, schema, load_name, table_name)
+    for partition in list_partitions(conn, schema, table_name):
+        conn.execute(
+            text(
+                f'ALTER TABLE "{schema}"."{partition}" '
+                f'RENAME TO "{partition.replace(load_name, table_name, 1)}"'
+            )
+        )
@@ -0,0 +1,104 @@
+import itertools
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+
+class RideIdAllocator:
+    """Hands out new ride ids from a sequence in the staging schema.
+
+    The sequence increments by `block_size`, so a single `nextval` reserves a
+    whole block of ids which are then handed out in-process. Starting a ride
+    costs one database round trip per block, and consumers running side by side
+    can never be given the same id as long as they share a block size. Ids left
+    in a block on shutdown are skipped.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        schema: str,
+        block_size: int = 20,
+        sequence_name: str = "RIDE_ID_SEQ",
+    ):
+        self.engine = engine
+        self.schema = schema
+        self.block_size = block_size
+        self.sequence = f'"{schema}"."{sequence_name}"'
+
+        self._next_id = 0
+        self._block_end = 0
+        self._lock = threading.Lock()
+
+    def ensure_sequence(self):
+        """Creates the sequence if it doesn't exist, starting it after the
+        highest ride id already in USER_RIDES so existing rides are not reused
+        """
+        with self.engine.begin() as conn:
+            exists = conn.execute(
+                text("SELECT to_regclass(:name)"), {"name": self.sequence}
+            ).scalar()
+
+            if exists is None:
+                start = 1
+                user_rides = f'"{self.schema}"."USER_RIDES"'
+                has_user_rides = conn.execute(
+                    text("SELECT to_regclass(:name)"), {"name": user_rides}
+                ).scalar()
+                if has_user_rides is not None:
+                    start = conn.execute(
+                        text(f"SELECT COALESCE(MAX(ride_id), 0) + 1 FROM {user_rides}")
+                    ).scalar()
+
+                conn.execute(
+                    text(
+                        f"CREATE SEQUENCE IF NOT EXISTS {self.sequence} "
+                        f"START WITH {int(start)} INCREMENT BY {self.block_size}"
+                    )
+                )
+            else:
+                conn.execute(
+                    text(
+                        f"ALTER SEQUENCE {self.sequence} INCREMENT BY {self.block_size}"
+                    )
+                )
+
+    def _reserve_block(self):
+        """Reserves the next block of ids from the database sequence"""
+        with self.engine.begin() as conn:
+            block_start = conn.execute(
+                text("SELECT nextval(:name)"), {"name": self.sequence}
+            ).scalar()
+
+        self._next_id = block_start
+        self._block_end = block_start + self.block_size
+
+    def next_id(self) -> int:
+        """Gets the id for a new ride
+
+        Returns:
+            int: unused ride id
+        """
+        with self._lock:
+            if self._next_id >= self._block_end:
+                self._reserve_block()
+
+            ride_id = self._next_id
+            self._next_id += 1
+            return ride_id
+
+
+class LocalRideIdAllocator:
+    """In-process ride ids for offline dry runs that never touch the database"""
+
+    def __init__(self, start: int = 1):
+        self._ids = itertools.count(start)
+
+    def next_id(self) -> int:
+        """Gets the id for a new ride
+
+        Returns:
+            int: unused ride id
+        """
+        return next(self._ids)
@@ -0,0 +1,74 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from utils.extract_utils import RideState, RideSummary, RideSummaryRow, UserDetails
+
+
+def stored_date_of_birth(dob: str):
+    """Turns the dob text of a USERS row back into the value the SYSTEM message
+    carried, ms since 01/01/1970, leaving anything else as it is
+
+    Args:
+        dob (str): dob column of a USERS row
+
+    Returns:
+        Union[int, str]: date of birth
+    """
+    try:
+        return int(dob)
+    except (TypeError, ValueError):
+        return dob
+
+
+def load_ride_states(engine: Engine, schema: str) -> dict:
+    """Rebuilds the ride state of each bike from the staging tables, so readings
+    replayed after a restart are recorded under the ride they belong to rather
+    than dropped until the bike's next SYSTEM message.
+
+    Each bike's ride comes from CURRENT_RIDE, and only rides whose USER_RIDES
+    and USERS rows have been staged are restored. Their summary carries on from
+    the ride's RIDE_SUMMARY row. The last Ride reading isn't staged on its own,
+    so a bike's readings are recorded again from its next Ride message.
+
+    Args:
+        engine (Engine): sqlalchemy engine
+        schema (str): staging schema name
+
+    Returns:
+        dict: bike key to its RideState
+    """
+    tables = [f'"{schema}"."{table}"' for table in ("CURRENT_RIDE", "USER_RIDES")]
+    with engine.connect() as conn:
+        for table in tables:
+            exists = conn.execute(
+                text("SELECT to_regclass(:name)"), {"name": table}
+            ).scalar()
+            if exists is None:
+                return {}
+
+        summary_columns = ", ".join(
+            f's."{column}"' for column in RideSummaryRow._fields
+        )
+        result = conn.execute(text(f"""
+                SELECT c."BIKE_ID", c."RIDE_ID", u.user_id, u.first_name,
+                    u.last_name, u.gender, u.dob, u.height, u.weight, u.email,
+                    {summary_columns}
+                FROM "{schema}"."CURRENT_RIDE" AS c
+                JOIN (
+                    SELECT DISTINCT ride_id, user_id FROM "{schema}"."USER_RIDES"
+                ) AS r ON r.ride_id = c."RIDE_ID"
+                JOIN "{schema}"."USERS" AS u ON u.user_id = r.user_id
+                LEFT JOIN "{schema}"."RIDE_SUMMARY" AS s ON s.ride_id = c."RIDE_ID"
+                """))
+
+        states = {}
+        for row in result:
+            bike_key, ride_id = row[:2]
+            user = UserDetails(*row[2:10])
+            user = user._replace(date_of_birth=stored_date_of_birth(user.date_of_birth))
+            state = states[bike_key] = RideState()
+            state.start_ride(ride_id, user)
+            summary_row = RideSummaryRow(*row[10:])
+            if summary_row.ride_id is not None:
+                state.summary = RideSummary.from_row(summary_row)
+    return states
@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from utils.age_utils import ages_from_dob
+
+
+def read_ride_summaries(
+    engine: Engine, schema: str, since: datetime = None
+) -> pd.DataFrame:
+    """Reads the RIDE_SUMMARY rows, one per ride, each with its rider's gender
+    and age from USERS, so readers aggregate a row per ride rather than a row
+    per reading
+
+    Args:
+        engine (Engine): sqlalchemy engine
+        schema (str): staging schema name
+        since (datetime): only rides with a reading after this time,
+                          every ride by default
+
+    Returns:
+        pd.DataFrame: ride summaries with gender and age columns, None if
+                      RIDE_SUMMARY or USERS hasn't been created yet
+    """
+    with engine.connect() as conn:
+        for table in ("RIDE_SUMMARY", "USERS"):
+            exists = conn.execute(
+                text("SELECT to_regclass(:name)"), {"name": f'"{schema}"."{table}"'}
+            ).scalar()
+            if exists is None:
+                return None
+
+        query = f"""
+                SELECT s.*, u.gender, u.dob
+                FROM "{schema}"."RIDE_SUMMARY" AS s
+                LEFT JOIN "{schema}"."USERS" AS u ON u.user_id = s.user_id
+                """
+        params = {}
+        if since is not None:
+            query += " WHERE s.last_reading_at > :since"
+            params["since"] = since
+        df = pd.read_sql_query(text(query), conn, params=params)
+
+    df["age"] = ages_from_dob(df.pop("dob"))
+    return df
+
+
+def mean_by_user(summaries: pd.DataFrame, column: str) -> pd.DataFrame:
+    """Averages a reading over all of each rider's rides, weighting every ride
+    by how many readings it had rather than counting each ride once
+
+    Args:
+        summaries (pd.DataFrame): ride summaries
+        column (str): heart_rate or power
+
+    Returns:
+        pd.DataFrame: user_id and the rider's mean reading in `column`, NaN for
+                      riders with no non-zero readings
+    """
+    totals = summaries.groupby("user_id")[[f"{column}_sum", f"{column}_count"]].sum()
+    means = totals[f"{column}_sum"] / totals[f"{column}_count"].where(
+        totals[f"{column}_count"] > 0
+    )
+    return means.rename(column).reset_index()
+
+
+def overall_mean(summaries: pd.DataFrame, column: str) -> float:
+    """Averages a reading over every ride, the same as the mean of all the
+    non-zero readings the rides were summarised from
+
+    Args:
+        summaries (pd.DataFrame): ride summaries
+        column (str): heart_rate or power
+
+    Returns:
+        float: mean reading, NaN if there were no non-zero readings
+    """
+    count = summaries[f"{column}_count"].sum()
+    if not count:
+        return np.nan
+
+    return summaries[f"{column}_sum"].sum() / count
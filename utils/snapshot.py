@@ -0,0 +1,226 @@
+import os
+import shutil
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from utils.production_table import (
+    PRODUCTION_COLUMNS,
+    apply_production_dtypes,
+    list_partitions,
+)
+
+CURRENT_FILE = "CURRENT"
+WATERMARK_FILE = "WATERMARK"
+DAY_FIELD = pa.field("day", pa.date32())
+DAY_PARTITIONING = ds.partitioning(pa.schema([DAY_FIELD]), flavor="hive")
+TEXT = pa.dictionary(pa.int32(), pa.string())
+SNAPSHOT_SCHEMA = pa.schema(
+    [
+        ("user_id", pa.int64()),
+        ("first_name", TEXT),
+        ("last_name", TEXT),
+        ("gender", pa.dictionary(pa.int32(), pa.string(), ordered=True)),
+        ("age", pa.int16()),
+        ("height", pa.int16()),
+        ("weight", pa.int16()),
+        ("email", TEXT),
+        ("ride_id", pa.int64()),
+        ("time_elapsed", pa.float32()),
+        ("resistance", pa.int16()),
+        ("heart_rate", pa.int16()),
+        ("rotations_pm", pa.int16()),
+        ("power", pa.float32()),
+        ("time", pa.timestamp("us", tz="UTC")),
+    ]
+)
+
+
+def current_snapshot(path: str) -> str:
+    """Finds the snapshot version the CURRENT file points at
+
+    Args:
+        path (str): directory the snapshot versions are kept in
+
+    Returns:
+        str: directory of the current version, None if there isn't one yet
+    """
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as current:
+            version = current.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(path, version)
+
+
+def snapshot_watermark(version_path: str) -> int:
+    """Reads the transform watermark a snapshot version was written at
+
+    Args:
+        version_path (str): snapshot version directory
+
+    Returns:
+        int: staged_txid of the watermark, None if the version doesn't record one
+    """
+    try:
+        with open(os.path.join(version_path, WATERMARK_FILE)) as watermark_file:
+            return int(watermark_file.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def day_directory(version_path: str, day) -> str:
+    """Names the hive style directory holding one UTC day of a snapshot
+
+    Args:
+        version_path (str): snapshot version directory
+        day (date): day of the partition
+
+    Returns:
+        str: partition directory
+    """
+    return os.path.join(version_path, f"day={day.isoformat()}")
+
+
+def export_day(conn, schema: str, partition: str, day_path: str, chunk_rows: int):
+    """Writes one day partition of the production table to a zstd compressed
+    Parquet file, a row group per chunk in time order, so the min/max
+    statistics of each row group let readers skip the ones outside a window
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection to read on
+        schema (str): production schema name
+        partition (str): partition table name
+        day_path (str): directory to write the file to
+        chunk_rows (int): rows per chunk and row group
+    """
+    chunks = pd.read_sql_query(
+        text(f'SELECT * FROM "{schema}"."{partition}" ORDER BY "time"'),
+        conn.execution_options(stream_results=True),
+        chunksize=chunk_rows,
+    )
+
+    writer = None
+    for chunk in chunks:
+        chunk = apply_production_dtypes(chunk)[list(PRODUCTION_COLUMNS)]
+        if writer is None:
+            os.makedirs(day_path, exist_ok=True)
+            writer = pq.ParquetWriter(
+                os.path.join(day_path, "part-0.parquet"),
+                SNAPSHOT_SCHEMA,
+                compression="zstd",
+                write_statistics=True,
+            )
+        writer.write_table(
+            pa.Table.from_pandas(chunk, schema=SNAPSHOT_SCHEMA, preserve_index=False)
+        )
+    if writer is not None:
+        writer.close()
+
+
+def write_snapshot(
+    engine: Engine,
+    schema: str,
+    table_name: str,
+    path: str,
+    watermark: int,
+    changed_days=None,
+    chunk_rows: int = 50000,
+    keep_versions: int = 3,
+) -> str:
+    """Writes a new version of the Parquet snapshot of a production table,
+    partitioned by day like the table, then points CURRENT at it.
+
+    Days that haven't changed since the current version are hard linked from
+    it rather than read from aurora again. Days whose partitions have been
+    detached are left out. Only the newest `keep_versions` versions are kept.
+
+    Args:
+        engine (Engine): sqlalchemy engine
+        schema (str): production schema name
+        table_name (str): partitioned production table name
+        path (str): directory the snapshot versions are kept in
+        watermark (int): staged_txid of the transform watermark the table is at
+        changed_days (Iterable[date]): days written since the current version,
+                                       None to export every day again
+        chunk_rows (int): rows per chunk and row group
+        keep_versions (int): number of versions to keep
+
+    Returns:
+        str: directory of the new version
+    """
+    previous = current_snapshot(path)
+    if changed_days is not None:
+        changed_days = set(changed_days)
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    version_path = os.path.join(path, version)
+
+    with engine.connect() as conn:
+        for partition in list_partitions(conn, schema, table_name):
+            day = datetime.strptime(partition.rsplit("_p", 1)[1], "%Y%m%d").date()
+            day_path = day_directory(version_path, day)
+            unchanged = changed_days is not None and day not in changed_days
+            if previous and unchanged and os.path.isdir(day_directory(previous, day)):
+                shutil.copytree(
+                    day_directory(previous, day), day_path, copy_function=os.link
+                )
+            else:
+                export_day(conn, schema, partition, day_path, chunk_rows)
+    os.makedirs(version_path, exist_ok=True)
+    with open(os.path.join(version_path, WATERMARK_FILE), "w") as watermark_file:
+        watermark_file.write(str(watermark))
+
+    pointer = os.path.join(path, f"{CURRENT_FILE}.tmp")
+    with open(pointer, "w") as current:
+        current.write(version)
+    os.replace(pointer, os.path.join(path, CURRENT_FILE))
+
+    versions = sorted(
+        entry for entry in os.listdir(path) if os.path.isdir(os.path.join(path, entry))
+    )
+    for old_version in versions[:-keep_versions]:
+        shutil.rmtree(os.path.join(path, old_version), ignore_errors=True)
+
+    return version_path
+
+
+def read_snapshot(path: str, columns: list = None, since: datetime = None):
+    """Reads the current snapshot version through memory mapped files, loading
+    only the columns asked for, and with `since` only the day partitions and
+    row groups that can hold rows from then on
+
+    Args:
+        path (str): directory the snapshot versions are kept in
+        columns (list): production columns to load, None for all of them
+        since (datetime): timezone aware time to load rows from, None for all rows
+
+    Returns:
+        pd.DataFrame: rows with the production column types, None if no
+                      snapshot has been written yet
+    """
+    version_path = current_snapshot(path)
+    if version_path is None:
+        return None
+
+    dataset = ds.dataset(
+        version_path,
+        schema=SNAPSHOT_SCHEMA.append(DAY_FIELD),
+        format="parquet",
+        partitioning=DAY_PARTITIONING,
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+    row_filter = None
+    if since is not None:
+        since = pd.Timestamp(since).tz_convert("UTC")
+        row_filter = (ds.field("day") >= since.date()) & (ds.field("time") >= since)
+
+    table = dataset.to_table(
+        columns=columns or SNAPSHOT_SCHEMA.names, filter=row_filter
+    )
+    return apply_production_dtypes(table.to_pandas())
@@ -0,0 +1,175 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+RIDES_COLUMNS = {
+    "ride_id": "BIGINT",
+    "duration": "DOUBLE PRECISION",
+    "resistance": "INTEGER",
+    "heart_rate": "INTEGER",
+    "rotations_pm": "INTEGER",
+    "power": "DOUBLE PRECISION",
+    "time": "TIMESTAMPTZ",
+}
+POSTGRES_TYPES = {
+    "BIGINT": "bigint",
+    "INTEGER": "integer",
+    "SMALLINT": "smallint",
+    "REAL": "real",
+    "TEXT": "text",
+    "DOUBLE PRECISION": "double precision",
+    "TIMESTAMPTZ": "timestamp with time zone",
+}
+LEGACY_TIME_FORMAT = "DD/MM/YYYY HH24:MI:SS"
+STAGED_TXID_COLUMN = '"staged_txid" BIGINT NOT NULL DEFAULT txid_current()'
+
+
+def convert_column(column: str, column_type: str) -> str:
+    """Builds the USING expression that converts a legacy text column to its type
+
+    Args:
+        column (str): column name
+        column_type (str): type it is converted to
+
+    Returns:
+        str: SQL expression
+    """
+    if column_type == "TIMESTAMPTZ":
+        return f"to_timestamp(\"{column}\"::text, '{LEGACY_TIME_FORMAT}')"
+    if column_type in ("BIGINT", "INTEGER", "SMALLINT"):
+        return f"round(NULLIF(\"{column}\"::text, '')::numeric)::{column_type}"
+    return f"NULLIF(\"{column}\"::text, '')::{column_type}"
+
+
+def retype_columns(conn, schema: str, table_name: str, columns: dict) -> bool:
+    """Converts the columns of an existing table whose type differs from `columns`
+    in place, in a single ALTER TABLE
+
+    Args:
+        conn (sqlalchemy.engine.Connection): connection to aurora
+        schema (str): schema name
+        table_name (str): table name
+        columns (dict): column name to the type it should have
+
+    Returns:
+        bool: whether the table exists
+    """
+    existing = dict(
+        conn.execute(
+            text("""
+                SELECT column_name, data_type FROM information_schema.columns
+                WHERE table_schema = :schema AND table_name = :table_name
+                """),
+            {"schema": schema, "table_name": table_name},
+        ).all()
+    )
+    if not existing:
+        return False
+
+    changes = [
+        f'ALTER COLUMN "{column}" TYPE {column_type} '
+        f"USING {convert_column(column, column_type)}"
+        for column, column_type in columns.items()
+        if column in existing and existing[column] != POSTGRES_TYPES[column_type]
+    ]
+    if changes:
+        conn.execute(
+            text(f'ALTER TABLE "{schema}"."{table_name}" {", ".join(changes)}')
+        )
+    return True
+
+
+def ensure_rides_table(engine: Engine, schema: str):
+    """Creates RIDES with numeric readings and a timestamptz event time, indexed
+    on time and ride_id, if it doesn't exist.
+
+    Every row also records the id of the transaction that staged it, in
+    staged_txid, which the transform's watermark follows so rows that arrive
+    late are still picked up.
+
+    A RIDES table from before the columns were typed has its text columns
+    converted in place, the 'DD/MM/YYYY HH24:MI:SS' time strings included.
+    Rows staged before staged_txid existed get 0 for it.
+
+    Args:
+        engine (Engine): sqlalchemy engine
+        schema (str): staging schema name
+    """
+    table = f'"{schema}"."RIDES"'
+    with engine.begin() as conn:
+        if retype_columns(conn, schema, "RIDES", RIDES_COLUMNS):
+            conn.execute(
+                text(
+                    f"ALTER TABLE {table} "
+                    'ADD COLUMN IF NOT EXISTS "staged_txid" BIGINT NOT NULL DEFAULT 0'
+                )
+            )
+            conn.execute(
+                text(
+                    f'ALTER TABLE {table} ALTER COLUMN "staged_txid" '
+                    "SET DEFAULT txid_current()"
+                )
+            )
+        else:
+            columns = ", ".join(
+                f'"{column}" {column_type}'
+                for column, column_type in RIDES_COLUMNS.items()
+            )
+            conn.execute(
+                text(f"CREATE TABLE {table} ({columns}, {STAGED_TXID_COLUMN})")
+            )
+
+        conn.execute(
+            text(f'CREATE INDEX IF NOT EXISTS "RIDES_time_idx" ON {table} ("time")')
+        )
+        conn.execute(
+            text(
+                f'CREATE INDEX IF NOT EXISTS "RIDES_ride_id_idx" ON {table} ("ride_id")'
+            )
+        )
+        conn.execute(
+            text(
+                f'CREATE INDEX IF NOT EXISTS "RIDES_staged_txid_idx" '
+                f'ON {table} ("staged_txid")'
+            )
+        )
+
+
+RIDE_SUMMARY_COLUMNS = {
+    "ride_id": "BIGINT PRIMARY KEY",
+    "user_id": "BIGINT",
+    "started_at": "TIMESTAMPTZ",
+    "last_reading_at": "TIMESTAMPTZ",
+    "duration": "DOUBLE PRECISION",
+    "readings": "INTEGER",
+    "heart_rate_count": "INTEGER",
+    "heart_rate_sum": "BIGINT",
+    "heart_rate_min": "INTEGER",
+    "heart_rate_max": "INTEGER",
+    "power_count": "INTEGER",
+    "power_sum": "DOUBLE PRECISION",
+    "power_min": "DOUBLE PRECISION",
+    "power_max": "DOUBLE PRECISION",
+    "total_work": "DOUBLE PRECISION",
+}
+
+
+def ensure_ride_summary_table(engine: Engine, schema: str):
+    """Creates RIDE_SUMMARY, one row per ride keyed on ride_id, if it doesn't exist
+
+    Args:
+        engine (Engine): sqlalchemy engine
+        schema (str): staging schema name
+    """
+    table = f'"{schema}"."RIDE_SUMMARY"'
+    columns = ", ".join(
+        f'"{column}" {column_type}'
+        for column, column_type in RIDE_SUMMARY_COLUMNS.items()
+    )
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table} ({columns})"))
+        conn.execute(
+            text(
+                f'CREATE INDEX IF NOT EXISTS "RIDE_SUMMARY_user_id_idx" '
+                f'ON {table} ("user_id")'
+            )
+        )
@@ -0,0 +1,267 @@
+import time
+
+import pandas as pd
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from utils.db import copy_insert, copy_rows, rows_to_csv
+from utils.metrics import LATENCY_BUCKETS, SIZE_BUCKETS, Histogram
+
+
+class TableBuffer:
+    """Rows waiting to be written to one staging table.
+
+    Rows are kept as the tuples they arrive as, and only become a COPY
+    payload, or a DataFrame when the table has to be created, on flush.
+    """
+
+    __slots__ = ("columns", "rows")
+
+    def __init__(self, columns: tuple):
+        self.columns = columns
+        self.rows = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def extend(self, rows: list):
+        """Adds rows to the buffer
+
+        Args:
+            rows (list): tuples with a value for each column
+        """
+        self.rows.extend(rows)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Builds a DataFrame of the buffered rows
+
+        Returns:
+            pd.DataFrame: one column per buffered column
+        """
+        return pd.DataFrame.from_records(self.rows, columns=self.columns)
+
+    def latest_rows(self, keys: tuple) -> list:
+        """The last buffered row for each key, in the order the keys first arrived
+
+        Args:
+            keys (tuple): key column names
+
+        Returns:
+            list: one row per key
+        """
+        positions = [self.columns.index(key) for key in keys]
+        latest = {tuple(row[i] for i in positions): row for row in self.rows}
+        return list(latest.values())
+
+
+class StagingWriter:
+    """Buffers rows destined for the staging tables and writes them to aurora in batches.
+
+    A flush happens once `max_rows` rows are buffered or the oldest buffered row
+    is `max_seconds` old, whichever comes first. Every table is written in the
+    same transaction, and the buffer is only cleared once that transaction commits.
+
+    Kafka offsets handed in alongside the rows are passed to `on_flush` after the
+    rows they cover have been committed, so offsets are never committed ahead of
+    the data they stand for. When `on_flush` returns False the offsets are kept
+    and handed to it again with the next flush.
+
+    Tables named in `upsert_keys` are upserted on their key columns rather than
+    appended to: the rows are copied into a temporary table and merged with
+    INSERT ... ON CONFLICT, the last buffered row for a key winning.
+
+    With `dry_run` the rows are buffered and combined as normal but never sent
+    to the database, for load testing the extractor offline.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        schema: str,
+        max_rows: int = 500,
+        max_seconds: float = 5,
+        on_flush=None,
+        dry_run: bool = False,
+        upsert_keys: dict = None,
+    ):
+        self.engine = engine
+        self.schema = schema
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.on_flush = on_flush
+        self.dry_run = dry_run
+        self.upsert_keys = upsert_keys or {}
+
+        self._buffers = {}
+        self._buffered_rows = 0
+        self._offsets = {}
+        self._oldest_pending_at = None
+        self._existing_tables = set()
+
+        self.flush_rows = Histogram(
+            "staging_flush_rows", "Rows written per staging flush", SIZE_BUCKETS
+        )
+        self.flush_seconds = Histogram(
+            "staging_flush_seconds", "Seconds taken per staging flush", LATENCY_BUCKETS
+        )
+
+    def add(self, table_name: str, rows: list):
+        """Buffer rows for one table, flushing if a limit has been reached
+
+        Args:
+            table_name (str): name of the staging table the rows belong to
+            rows (list): NamedTuple rows to write
+        """
+        self.add_batch({table_name: rows})
+
+    def add_batch(self, rows: dict, offsets: dict = None):
+        """Buffer the rows for several tables as one unit, flushing if a limit has been reached
+
+        Args:
+            rows (dict): staging table name to a list of NamedTuple rows for it
+            offsets (dict): (topic, partition) to the next offset to consume,
+                            for the messages the rows came from
+        """
+        for table_name, table_rows in rows.items():
+            if table_rows:
+                buffer = self._buffers.get(table_name)
+                if buffer is None:
+                    buffer = self._buffers[table_name] = TableBuffer(
+                        table_rows[0]._fields
+                    )
+                buffer.extend(table_rows)
+                self._buffered_rows += len(table_rows)
+
+        if offsets:
+            self._offsets.update(offsets)
+
+        if self._oldest_pending_at is None and (self._buffered_rows or self._offsets):
+            self._oldest_pending_at = time.monotonic()
+
+        self.flush_if_due()
+
+    def flush_if_due(self) -> bool:
+        """Flush the buffer if either the row or the time limit has been reached
+
+        Returns:
+            bool: whether a flush happened
+        """
+        if self._oldest_pending_at is None:
+            return False
+
+        too_many = self._buffered_rows >= self.max_rows
+        too_old = time.monotonic() - self._oldest_pending_at >= self.max_seconds
+        if too_many or too_old:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """Write every buffered row to the staging schema in a single transaction,
+        then hand the offsets those rows came from to `on_flush`
+        """
+        if self._buffered_rows:
+            start = time.perf_counter()
+            if self.dry_run:
+                for table_name, buffer in self._buffers.items():
+                    keys = self.upsert_keys.get(table_name)
+                    rows_to_csv(buffer.latest_rows(keys) if keys else buffer.rows)
+            else:
+                with self.engine.begin() as conn:
+                    for table_name, buffer in self._buffers.items():
+                        self._write(conn, table_name, buffer)
+
+            self.flush_seconds.observe(time.perf_counter() - start)
+            self.flush_rows.observe(self._buffered_rows)
+
+        offsets = self._offsets
+        self._buffers = {}
+        self._buffered_rows = 0
+        self._offsets = {}
+        self._oldest_pending_at = None
+
+        if offsets and self.on_flush is not None:
+            if self.on_flush(offsets) is False:
+                self._offsets = {**offsets, **self._offsets}
+                self._oldest_pending_at = time.monotonic()
+
+    def discard_offsets(self, partitions: set):
+        """Forgets the offsets waiting to be handed to `on_flush` for partitions
+        this consumer no longer owns, so they can't be committed over the new
+        owner's
+
+        Args:
+            partitions (set): (topic, partition) pairs
+        """
+        for partition in partitions:
+            self._offsets.pop(partition, None)
+
+    def _write(self, conn, table_name: str, buffer: TableBuffer):
+        """COPY a buffer into its table, letting pandas create the table the
+        first time it is written to
+
+        Args:
+            conn (sqlalchemy.engine.Connection): connection of the flush transaction
+            table_name (str): staging table name
+            buffer (TableBuffer): rows to write
+        """
+        if table_name in self.upsert_keys:
+            self._upsert(conn, table_name, buffer, self.upsert_keys[table_name])
+            return
+
+        if table_name not in self._existing_tables:
+            if not inspect(conn).has_table(table_name, schema=self.schema):
+                buffer.to_frame().to_sql(
+                    table_name,
+                    conn,
+                    schema=self.schema,
+                    if_exists="append",
+                    index=False,
+                    method=copy_insert,
+                )
+                self._existing_tables.add(table_name)
+                return
+            self._existing_tables.add(table_name)
+
+        copy_rows(conn, self.schema, table_name, buffer.columns, buffer.rows)
+
+    def _upsert(self, conn, table_name: str, buffer: TableBuffer, keys: tuple):
+        """COPY a buffer into a temporary table, then merge it into its table on `keys`
+
+        Args:
+            conn (sqlalchemy.engine.Connection): connection of the flush transaction
+            table_name (str): staging table name, which must already exist with
+                              a unique constraint on `keys`
+            buffer (TableBuffer): rows to write
+            keys (tuple): key column names
+        """
+        table = f'"{self.schema}"."{table_name}"'
+        temporary = f'"{table_name}_upsert"'
+        columns = ", ".join(f'"{column}"' for column in buffer.columns)
+        updates = ", ".join(
+            f'"{column}" = EXCLUDED."{column}"'
+            for column in buffer.columns
+            if column not in keys
+        )
+        key_columns = ", ".join(f'"{key}"' for key in keys)
+
+        conn.execute(
+            text(
+                f"CREATE TEMPORARY TABLE {temporary} "
+                f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+        )
+        copy_rows(
+            conn, None, f"{table_name}_upsert", buffer.columns, buffer.latest_rows(keys)
+        )
+        conn.execute(
+            text(
+                f"INSERT INTO {table} ({columns}) "
+                f"SELECT {columns} FROM {temporary} "
+                f"ON CONFLICT ({key_columns}) DO UPDATE SET {updates}"
+            )
+        )
+
+    def close(self):
+        """Flush whatever is left in the buffer, used on shutdown"""
+        self.flush()